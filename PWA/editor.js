@@ -0,0 +1,290 @@
+// Workflow editor for AirComfy. Each node is a group that is patched in
+// place; a group's input fields only exist while it is in or near view,
+// so large workflows open quickly and toggling keeps focus and scroll.
+(function () {
+    // Height estimates (px) for groups whose fields have not been measured
+    const FIELDS_PADDING = 32;
+    const FIELD_HEIGHT = 52;
+    const TEXTAREA_HEIGHT = 96;
+
+    function isTextArea(field) {
+        return field === 'text' || field === 'prompt';
+    }
+
+    // Inputs connected to other nodes are `[node_id, slot]` and are not editable
+    function editableFields(node) {
+        return Object.entries(node.inputs || {}).filter(([, value]) => !Array.isArray(value));
+    }
+
+    class WorkflowEditor {
+        constructor(container, { onFieldChange, onToggle, onShowAll, onHideAll, margin = 800 } = {}) {
+            this.container = container;
+            this.callbacks = { onFieldChange, onToggle, onShowAll, onHideAll };
+            this.margin = margin;
+            this.nodes = {};
+            this.hidden = {};
+            // nodeId -> { element, button, body, materialized, height }
+            this.groups = new Map();
+            this.near = new Set();
+            this.observer = new IntersectionObserver(entries => this.onIntersect(entries), {
+                root: container,
+                rootMargin: `${margin}px 0px`
+            });
+            this.handleClick = this.handleClick.bind(this);
+            this.handleChange = this.handleChange.bind(this);
+            container.addEventListener('click', this.handleClick);
+            container.addEventListener('change', this.handleChange);
+        }
+
+        destroy() {
+            this.observer.disconnect();
+            this.container.removeEventListener('click', this.handleClick);
+            this.container.removeEventListener('change', this.handleChange);
+            this.groups.clear();
+            this.near.clear();
+        }
+
+        // Build every group header; fields are added as groups come into view
+        render(nodes, hidden) {
+            this.observer.disconnect();
+            this.groups.clear();
+            this.near.clear();
+            this.nodes = nodes;
+            this.hidden = hidden;
+
+            const controls = document.createElement('div');
+            controls.className = 'editor-controls';
+            controls.append(
+                this.button('Show All Hidden Nodes', 'secondary-btn', 'show-all'),
+                this.button('Hide All Nodes', 'secondary-btn', 'hide-all')
+            );
+
+            const fragment = document.createDocumentFragment();
+            fragment.append(controls);
+            // Fill the first screen right away instead of waiting for the observer
+            let budget = (this.container.clientHeight || window.innerHeight) + this.margin;
+            for (const [nodeId, node] of Object.entries(nodes)) {
+                const group = this.createGroup(nodeId, node);
+                fragment.append(group.element);
+                if (budget > 0) {
+                    this.near.add(nodeId);
+                    budget -= 64 + (this.hidden[nodeId] ? 0 : this.estimateHeight(node));
+                }
+                this.patch(nodeId);
+            }
+            this.container.replaceChildren(fragment);
+            for (const group of this.groups.values()) {
+                this.observer.observe(group.element);
+            }
+        }
+
+        // Re-sync one group with hidden[nodeId]
+        update(nodeId) {
+            if (this.groups.has(nodeId)) {
+                this.patch(nodeId);
+            }
+        }
+
+        updateAll() {
+            for (const nodeId of this.groups.keys()) {
+                this.patch(nodeId);
+            }
+        }
+
+        button(label, className, action) {
+            const button = document.createElement('button');
+            button.type = 'button';
+            button.className = className;
+            button.dataset.action = action;
+            button.textContent = label;
+            return button;
+        }
+
+        createGroup(nodeId, node) {
+            const element = document.createElement('div');
+            element.className = 'node-group';
+            element.dataset.nodeId = nodeId;
+
+            const header = document.createElement('div');
+            header.className = 'node-header';
+            const title = document.createElement('h4');
+            title.textContent = `Node ${nodeId}: ${node.class_type}`;
+            const button = this.button('', 'toggle-btn', 'toggle');
+            header.append(title, button);
+            element.append(header);
+
+            const group = { element, button, body: null, materialized: false, height: null };
+            this.groups.set(nodeId, group);
+            return group;
+        }
+
+        patch(nodeId) {
+            const group = this.groups.get(nodeId);
+            const isHidden = !!this.hidden[nodeId];
+            const label = isHidden ? '👁️ Show' : '🙈 Hide';
+            if (group.button.textContent !== label) {
+                group.button.textContent = label;
+            }
+
+            if (isHidden) {
+                if (group.body) {
+                    group.body.remove();
+                    group.body = null;
+                    group.materialized = false;
+                }
+            } else if (!group.body) {
+                if (this.near.has(nodeId)) {
+                    this.materialize(nodeId);
+                } else {
+                    this.placeholder(nodeId);
+                }
+            }
+        }
+
+        estimateHeight(node) {
+            let height = FIELDS_PADDING;
+            for (const [field] of editableFields(node)) {
+                height += isTextArea(field) ? TEXTAREA_HEIGHT : FIELD_HEIGHT;
+            }
+            return height + Object.keys(node.large || {}).length * FIELD_HEIGHT;
+        }
+
+        placeholder(nodeId) {
+            const group = this.groups.get(nodeId);
+            const body = document.createElement('div');
+            body.className = 'node-fields-placeholder';
+            body.style.height = `${group.height ?? this.estimateHeight(this.nodes[nodeId])}px`;
+            this.replaceBody(group, body);
+            group.materialized = false;
+        }
+
+        materialize(nodeId) {
+            const group = this.groups.get(nodeId);
+            if (group.materialized || this.hidden[nodeId]) return;
+
+            const body = document.createElement('div');
+            body.className = 'node-fields';
+            const node = this.nodes[nodeId];
+            for (const [field, value] of editableFields(node)) {
+                body.append(this.createField(nodeId, field, value));
+            }
+            // Inputs too large to send to the page (embedded images and the like) are listed, not edited
+            for (const [field, size] of Object.entries(node.large || {})) {
+                body.append(this.createLargeField(field, size));
+            }
+            this.replaceBody(group, body);
+            group.materialized = true;
+        }
+
+        // Swap materialized fields back for a placeholder of the same height
+        release(nodeId) {
+            const group = this.groups.get(nodeId);
+            if (!group.materialized || group.body.contains(document.activeElement)) return;
+            group.height = group.body.offsetHeight;
+            this.placeholder(nodeId);
+        }
+
+        replaceBody(group, body) {
+            if (group.body) {
+                group.body.replaceWith(body);
+            } else {
+                group.element.append(body);
+            }
+            group.body = body;
+        }
+
+        createField(nodeId, field, value) {
+            const fieldId = `node-${nodeId}-${field}`;
+            const wrapper = document.createElement('div');
+            wrapper.className = 'field-group';
+
+            const label = document.createElement('label');
+            label.htmlFor = fieldId;
+            label.className = 'field-label';
+            label.textContent = `${field}:`;
+
+            let input;
+            if (typeof value === 'boolean') {
+                input = document.createElement('input');
+                input.type = 'checkbox';
+                input.checked = value;
+                input.className = 'field-checkbox';
+                input.dataset.type = 'boolean';
+            } else if (typeof value === 'number') {
+                input = document.createElement('input');
+                input.type = 'number';
+                input.step = 'any';
+                input.value = value;
+                input.className = 'field-input';
+                input.dataset.type = 'number';
+            } else if (isTextArea(field)) {
+                input = document.createElement('textarea');
+                input.rows = 3;
+                input.value = value ?? '';
+                input.className = 'field-textarea';
+                input.dataset.type = 'string';
+            } else {
+                input = document.createElement('input');
+                input.type = 'text';
+                input.value = value ?? '';
+                input.className = 'field-input';
+                input.dataset.type = 'string';
+            }
+            input.id = fieldId;
+            input.dataset.field = field;
+            wrapper.append(label, input);
+            return wrapper;
+        }
+
+        createLargeField(field, size) {
+            const wrapper = document.createElement('div');
+            wrapper.className = 'field-group';
+            const label = document.createElement('span');
+            label.className = 'field-label';
+            label.textContent = `${field}:`;
+            const note = document.createElement('span');
+            note.className = 'field-note';
+            note.textContent = `${size.toLocaleString()} characters, not editable here`;
+            wrapper.append(label, note);
+            return wrapper;
+        }
+
+        onIntersect(entries) {
+            for (const entry of entries) {
+                const nodeId = entry.target.dataset.nodeId;
+                if (!this.groups.has(nodeId)) continue;
+                if (entry.isIntersecting) {
+                    this.near.add(nodeId);
+                    if (!this.hidden[nodeId]) this.materialize(nodeId);
+                } else {
+                    this.near.delete(nodeId);
+                    this.release(nodeId);
+                }
+            }
+        }
+
+        handleClick(event) {
+            const target = event.target.closest('[data-action]');
+            if (!target || !this.container.contains(target)) return;
+            const action = target.dataset.action;
+            if (action === 'toggle') {
+                const nodeId = target.closest('.node-group').dataset.nodeId;
+                this.callbacks.onToggle?.(nodeId);
+            } else if (action === 'show-all') {
+                this.callbacks.onShowAll?.();
+            } else if (action === 'hide-all') {
+                this.callbacks.onHideAll?.();
+            }
+        }
+
+        handleChange(event) {
+            const input = event.target;
+            if (!input.dataset.field) return;
+            const nodeId = input.closest('.node-group').dataset.nodeId;
+            const value = input.dataset.type === 'boolean' ? input.checked : input.value;
+            this.callbacks.onFieldChange?.(nodeId, input.dataset.field, value, input.dataset.type);
+        }
+    }
+
+    window.WorkflowEditor = WorkflowEditor;
+})();
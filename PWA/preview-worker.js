@@ -0,0 +1,57 @@
+// Decodes ComfyUI's binary live-preview frames off the main thread. Only the
+// newest frame is decoded: frames that arrive while one is being decoded
+// replace each other, so a slow device skips frames instead of falling behind.
+
+// Binary event types from ComfyUI's server.py
+const PREVIEW_IMAGE = 1;
+const PREVIEW_IMAGE_WITH_METADATA = 4;
+const IMAGE_TYPES = { 1: 'image/jpeg', 2: 'image/png', 3: 'image/webp' };
+
+const decoder = new TextDecoder();
+
+let pending = null;
+let decoding = false;
+
+// `[event][image type][image]` or `[event][metadata length][metadata JSON][image]`
+async function decode(buffer) {
+    const view = new DataView(buffer);
+    const event = view.getUint32(0);
+    let metadata = {};
+    let type;
+    let offset;
+    if (event === PREVIEW_IMAGE) {
+        type = IMAGE_TYPES[view.getUint32(4)] || 'image/jpeg';
+        offset = 8;
+    } else if (event === PREVIEW_IMAGE_WITH_METADATA) {
+        const length = view.getUint32(4);
+        metadata = JSON.parse(decoder.decode(new Uint8Array(buffer, 8, length)));
+        type = metadata.image_type || 'image/jpeg';
+        offset = 8 + length;
+    } else {
+        return null;
+    }
+    const bitmap = await createImageBitmap(new Blob([new Uint8Array(buffer, offset)], { type }));
+    return { bitmap, promptId: metadata.prompt_id, node: metadata.node_id };
+}
+
+async function drain() {
+    decoding = true;
+    while (pending) {
+        const { epoch, buffer } = pending;
+        pending = null;
+        try {
+            const frame = await decode(buffer);
+            if (frame) {
+                self.postMessage({ epoch, ...frame }, [frame.bitmap]);
+            }
+        } catch (error) {
+            // Truncated or unsupported image; the next frame replaces it anyway
+        }
+    }
+    decoding = false;
+}
+
+self.onmessage = ({ data }) => {
+    pending = data;
+    if (!decoding) drain();
+};
@@ -1,12 +1,28 @@
-const CACHE_NAME = 'aircomfy-v1';
+const CACHE_NAME = 'aircomfy-v6';
 const CACHE_URLS = [
     './',
     './index.html',
     './style.css',
+    './editor.js',
+    './workflow-worker.js',
+    './preview-worker.js',
     './manifest.json',
     './icon-192.png'
 ];
 
+// Runtime caches outlive app shell versions
+const RESULTS_CACHE = 'aircomfy-results';
+const API_CACHE = 'aircomfy-api';
+const RUNTIME_CACHES = [RESULTS_CACHE, API_CACHE];
+
+// Byte budget for cached /view outputs and /history entries; least recently used go first
+const RESULTS_MAX_BYTES = 200 * 1024 * 1024;
+// Sizes and last use of each cached result, stored alongside them
+const RESULTS_INDEX_URL = '/__aircomfy/results-index';
+
+// Node schemas and model lists: served from cache, refreshed in the background
+const SCHEMA_PATHS = ['/object_info', '/embeddings', '/extensions'];
+
 self.addEventListener('install', event => {
     event.waitUntil(
         caches.open(CACHE_NAME)
@@ -21,7 +37,7 @@ self.addEventListener('activate', event => {
             .then(cacheNames => {
                 return Promise.all(
                     cacheNames.map(cacheName => {
-                        if (cacheName !== CACHE_NAME) {
+                        if (cacheName !== CACHE_NAME && !RUNTIME_CACHES.includes(cacheName)) {
                             return caches.delete(cacheName);
                         }
                     })
@@ -33,9 +49,17 @@ self.addEventListener('activate', event => {
 
 self.addEventListener('fetch', event => {
     const { request } = event;
-    const url = new URL(request.url);
+    // Mutations (/prompt, /queue, /interrupt, uploads) always go straight to the network
+    if (request.method !== 'GET') return;
 
-    if (url.origin === location.origin) {
+    const url = new URL(request.url);
+    if (url.pathname === '/view' && isSavedOutput(url)) {
+        event.respondWith(revalidatedResult(event, request));
+    } else if (SCHEMA_PATHS.some(path => url.pathname === path || url.pathname.startsWith(`${path}/`))) {
+        event.respondWith(staleWhileRevalidate(event, request));
+    } else if (/^\/history\/[^/]+$/.test(url.pathname)) {
+        event.respondWith(finishedHistory(event, request));
+    } else if (url.origin === location.origin) {
         event.respondWith(
             caches.match(request)
                 .then(response => {
@@ -46,4 +70,149 @@ self.addEventListener('fetch', event => {
                 })
         );
     }
-});
\ No newline at end of file
+});
+
+// Saved outputs are kept; temp previews and inputs are replaced too often to be worth it
+function isSavedOutput(url) {
+    return (url.searchParams.get('type') || 'output') === 'output';
+}
+
+let resultsIndex = null;
+let indexLoad = null;
+let indexFlush = null;
+
+function loadResultsIndex(cache) {
+    if (!indexLoad) {
+        indexLoad = readResultsIndex(cache).catch(error => {
+            indexLoad = null;
+            throw error;
+        });
+    }
+    return indexLoad;
+}
+
+async function readResultsIndex(cache) {
+    const stored = await cache.match(RESULTS_INDEX_URL);
+    const index = stored ? await stored.json() : {};
+    // Reconcile with the cache, in case the worker stopped before saving the index
+    const urls = new Set();
+    for (const key of await cache.keys()) {
+        if (key.url.endsWith(RESULTS_INDEX_URL)) continue;
+        urls.add(key.url);
+        if (!index[key.url]) {
+            const response = await cache.match(key);
+            index[key.url] = { size: (await response.blob()).size, used: 0 };
+        }
+    }
+    for (const url of Object.keys(index)) {
+        if (!urls.has(url)) delete index[url];
+    }
+    resultsIndex = index;
+    return index;
+}
+
+function saveResultsIndexSoon(event, cache) {
+    // One write per burst of hits, kept alive by the event that caused it
+    if (!indexFlush) {
+        indexFlush = new Promise(resolve => setTimeout(resolve, 1000))
+            .then(() => cache.put(RESULTS_INDEX_URL, new Response(JSON.stringify(resultsIndex), {
+                headers: { 'Content-Type': 'application/json' }
+            })))
+            .finally(() => { indexFlush = null; });
+    }
+    event.waitUntil(indexFlush);
+}
+
+async function evictResults(cache, index) {
+    let total = Object.values(index).reduce((sum, entry) => sum + entry.size, 0);
+    if (total <= RESULTS_MAX_BYTES) return;
+    const oldest = Object.entries(index).sort((a, b) => a[1].used - b[1].used);
+    for (const [url, entry] of oldest) {
+        if (total <= RESULTS_MAX_BYTES) break;
+        await cache.delete(url);
+        delete index[url];
+        total -= entry.size;
+    }
+}
+
+// Cached result for request, marked as just used, or undefined
+async function matchResult(event, cache, index, request) {
+    const cached = await cache.match(request);
+    if (cached && index[request.url]) {
+        index[request.url].used = Date.now();
+        saveResultsIndexSoon(event, cache);
+    }
+    return cached;
+}
+
+async function storeResult(event, cache, index, request, response) {
+    const size = (await response.clone().blob()).size;
+    await cache.put(request, response.clone());
+    index[request.url] = { size, used: Date.now() };
+    await evictResults(cache, index);
+    saveResultsIndexSoon(event, cache);
+}
+
+// ComfyUI can write an output again under the same name (its counter restarts
+// after files are deleted), so a cached copy is revalidated by ETag before use.
+// Offline, it is served as it is.
+async function revalidatedResult(event, request) {
+    const cache = await caches.open(RESULTS_CACHE);
+    const index = await loadResultsIndex(cache);
+    const cached = await matchResult(event, cache, index, request);
+    const etag = cached && cached.headers.get('ETag');
+
+    let response;
+    try {
+        if (etag) {
+            const headers = new Headers(request.headers);
+            headers.set('If-None-Match', etag);
+            response = await fetch(new Request(request, { headers }));
+        } else {
+            response = await fetch(request);
+        }
+    } catch (error) {
+        if (cached) return cached;
+        throw error;
+    }
+    if (response.status === 304 && cached) return cached;
+    // Opaque (no-cors) responses hide their status and size, so only readable successes are kept
+    if (response.ok) {
+        event.waitUntil(storeResult(event, cache, index, request, response));
+    }
+    return response;
+}
+
+async function staleWhileRevalidate(event, request) {
+    const cache = await caches.open(API_CACHE);
+    const cached = await cache.match(request);
+    const network = fetch(request).then(response => {
+        if (response.ok) {
+            return cache.put(request, response.clone()).then(() => response);
+        }
+        return response;
+    });
+    if (cached) {
+        event.waitUntil(network.catch(() => {}));
+        return cached;
+    }
+    return network;
+}
+
+// A history entry only exists once its prompt has finished, and then it no longer changes.
+// Entries share the outputs' budget, so a long session cannot grow the cache without bound.
+async function finishedHistory(event, request) {
+    const cache = await caches.open(RESULTS_CACHE);
+    const index = await loadResultsIndex(cache);
+    const cached = await matchResult(event, cache, index, request);
+    if (cached) return cached;
+
+    const response = await fetch(request);
+    if (response.ok) {
+        const entry = await response.clone().json().catch(() => ({}));
+        if (Object.keys(entry).length > 0) {
+            await storeResult(event, cache, index, request, response);
+        }
+    }
+    return response;
+}
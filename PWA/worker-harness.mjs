@@ -0,0 +1,257 @@
+#!/usr/bin/env node
+// Local harness for worker.js: runs it against a stub ComfyUI and checks the
+// edge cache and, for a built worker, its static files. Uses Miniflare (the local Workers runtime) when it is installed,
+// otherwise a small emulation of the service-worker globals on Node 18+.
+// Usage: node PWA/worker-harness.mjs [path/to/worker.js]
+//   e.g. node PWA/worker-harness.mjs PWA/dist/worker.js   (after build_pwa.py)
+
+import { readFileSync } from 'node:fs';
+import { gunzipSync } from 'node:zlib';
+import { createServer } from 'node:http';
+import { fileURLToPath } from 'node:url';
+
+const workerPath = process.argv[2] || fileURLToPath(new URL('./worker.js', import.meta.url));
+
+// Stub ComfyUI that counts the requests reaching it
+const hits = {};
+// How many times each output was written; its ETag changes with it, like a FileResponse's
+const writes = {};
+function startComfyUI() {
+  const server = createServer((req, res) => {
+    const url = new URL(req.url, 'http://stub');
+    const key = `${req.method} ${url.pathname}`;
+    hits[key] = (hits[key] || 0) + 1;
+    if (url.pathname === '/view') {
+      const filename = url.searchParams.get('filename');
+      if (filename === 'missing.png') {
+        res.writeHead(404).end();
+      } else {
+        const etag = `"${filename}-${writes[filename] || 0}"`;
+        if (req.headers['if-none-match'] === etag) {
+          res.writeHead(304, { ETag: etag }).end();
+        } else {
+          const body = writes[filename] ? `image:${filename}:${writes[filename]}` : `image:${filename}`;
+          res.writeHead(200, { 'Content-Type': 'image/png', ETag: etag }).end(body);
+        }
+      }
+    } else if (url.pathname === '/object_info') {
+      res.writeHead(200, { 'Content-Type': 'application/json' }).end(JSON.stringify({ calls: hits[key] }));
+    } else if (url.pathname.startsWith('/history/')) {
+      res.writeHead(200, { 'Content-Type': 'application/json' }).end('{}');
+    } else if (url.pathname === '/aircomfy/health') {
+      res.writeHead(200, { 'Content-Type': 'application/json' }).end(JSON.stringify({ calls: hits[key] }));
+    } else if (url.pathname === '/prompt' && req.method === 'POST') {
+      res.writeHead(200, { 'Content-Type': 'application/json' }).end('{"prompt_id": "p1"}');
+    } else {
+      res.writeHead(404).end();
+    }
+  });
+  return new Promise(resolve => server.listen(0, '127.0.0.1', () => resolve(server)));
+}
+
+// caches.default for the emulated runtime: keyed by URL, expired by max-age
+class EdgeCache {
+  constructor(now) {
+    this.now = now;
+    this.entries = new Map();
+  }
+
+  async match(request) {
+    const entry = this.entries.get(typeof request === 'string' ? request : request.url);
+    if (!entry || entry.expires <= this.now()) return undefined;
+    return new Response(entry.body, { status: entry.status, headers: entry.headers });
+  }
+
+  async put(request, response) {
+    const maxAge = /max-age=(\d+)/.exec(response.headers.get('Cache-Control') || '');
+    if (!maxAge) return;
+    this.entries.set(typeof request === 'string' ? request : request.url, {
+      body: await response.arrayBuffer(),
+      status: response.status,
+      headers: [...response.headers],
+      expires: this.now() + Number(maxAge[1]) * 1000
+    });
+  }
+}
+
+function emulatedRuntime(source) {
+  let clock = Date.now();
+  const listeners = {};
+  const globals = {
+    addEventListener: (type, listener) => { listeners[type] = listener; },
+    caches: { default: new EdgeCache(() => clock) },
+    // Workers stream request bodies without Node's `duplex` option
+    Request: class extends Request {
+      constructor(input, init = {}) {
+        super(input, init.body ? { duplex: 'half', ...init } : init);
+      }
+    }
+  };
+  new Function(...Object.keys(globals), source)(...Object.values(globals));
+
+  return {
+    name: 'emulated service-worker runtime',
+    // Responses come back with the bytes the worker sent
+    decodesBodies: false,
+    async dispatch(url, init) {
+      let responded;
+      const pending = [];
+      listeners.fetch({
+        request: new Request(url, init),
+        respondWith: response => { responded = response; },
+        waitUntil: promise => pending.push(promise)
+      });
+      const response = await responded;
+      await Promise.all(pending);
+      return response;
+    },
+    advance(seconds) {
+      clock += seconds * 1000;
+    },
+    async close() {}
+  };
+}
+
+async function miniflareRuntime(source) {
+  const { Miniflare } = await import('miniflare');
+  const mf = new Miniflare({ script: source, compatibilityDate: '2023-12-01' });
+  return {
+    name: 'Miniflare',
+    decodesBodies: true,
+    async dispatch(url, init) {
+      const response = await mf.dispatchFetch(url, init);
+      // cache.put runs in waitUntil, after the response
+      await new Promise(resolve => setTimeout(resolve, 50));
+      return response;
+    },
+    advance: null,
+    close: () => mf.dispose()
+  };
+}
+
+const checks = [];
+function check(label, condition, detail = '') {
+  checks.push(condition);
+  console.log(`${condition ? 'ok  ' : 'FAIL'} ${label}${condition ? '' : `  ${detail}`}`);
+}
+
+async function staticChecks(runtime, base, response) {
+  const decoded = runtime.decodesBodies ? await response.text()
+                                        : gunzipSync(Buffer.from(await response.arrayBuffer())).toString();
+  const etag = response.headers.get('ETag');
+  check('index.html is served gzip when br is refused',
+        response.headers.get('Content-Encoding') === 'gzip' && decoded.startsWith('<!DOCTYPE html>'),
+        response.headers.get('Content-Encoding'));
+  check('static files carry a strong ETag and Vary', /^"[0-9a-f]+-gzip"$/.test(etag)
+        && response.headers.get('Vary') === 'Accept-Encoding', etag);
+
+  response = await runtime.dispatch(`${base}/`, { headers: { 'Accept-Encoding': 'gzip', 'If-None-Match': etag } });
+  check('a matching If-None-Match gets 304', response.status === 304, response.status);
+  response = await runtime.dispatch(`${base}/`, { headers: { 'Accept-Encoding': 'identity', 'If-None-Match': etag } });
+  const plain = await response.text();
+  check('clients without gzip get the plain file', response.status === 200 && plain === decoded
+        && !response.headers.get('Content-Encoding') && response.headers.get('ETag') !== etag);
+
+  const asset = plain.match(/src="(assets\/app\.[0-9a-f]+\.js)"/);
+  response = await runtime.dispatch(`${base}/${asset && asset[1]}`, { method: 'HEAD', headers: { 'Accept-Encoding': 'br, gzip' } });
+  check('hashed assets are immutable', response.status === 200
+        && /immutable/.test(response.headers.get('Cache-Control')), response.status);
+  response = await runtime.dispatch(`${base}/icon-192.png`, { headers: { 'Accept-Encoding': 'gzip' } });
+  check('images are served as they are', !response.headers.get('Content-Encoding')
+        && Buffer.from(await response.arrayBuffer()).subarray(1, 4).toString() === 'PNG');
+}
+
+async function main() {
+  const comfyui = await startComfyUI();
+  const stubUrl = `http://127.0.0.1:${comfyui.address().port}`;
+  const source = readFileSync(workerPath, 'utf8')
+    .replace(/^const COMFYUI_SERVER = .*$/m, `const COMFYUI_SERVER = '${stubUrl}';`);
+
+  let runtime;
+  try {
+    runtime = await miniflareRuntime(source);
+  } catch (error) {
+    runtime = emulatedRuntime(source);
+  }
+  console.log(`${workerPath} on ${runtime.name}, ComfyUI stub at ${stubUrl}\n`);
+
+  const base = 'http://aircomfy.test';
+  const get = path => runtime.dispatch(`${base}${path}`);
+  const status = response => response.headers.get('X-AirComfy-Cache');
+
+  let response = await get('/view?filename=a.png&subfolder=&type=output');
+  check('output is fetched and stored', status(response) === 'MISS' && await response.text() === 'image:a.png',
+        status(response));
+  check('outputs are revalidated, not immutable', response.headers.get('Cache-Control') === 'no-cache',
+        response.headers.get('Cache-Control'));
+  response = await get('/view?type=output&subfolder=&filename=a.png&rand=0.123');
+  check('reordered params and cache busters revalidate the same entry',
+        status(response) === 'REVALIDATED' && await response.text() === 'image:a.png' && hits['GET /view'] === 2,
+        `${status(response)}, ${hits['GET /view']} upstream`);
+  check('cached responses keep CORS headers', response.headers.get('Access-Control-Allow-Origin') !== null);
+  check('cache status is readable cross-origin',
+        /X-AirComfy-Cache/.test(response.headers.get('Access-Control-Expose-Headers') || ''));
+
+  await get('/view?filename=t.png&type=temp');
+  response = await get('/view?filename=t.png&type=temp');
+  check('temp files are not cached', status(response) === 'BYPASS' && hits['GET /view'] === 4, status(response));
+
+  await get('/view?filename=missing.png');
+  response = await get('/view?filename=missing.png');
+  check('errors are not cached', response.status === 404 && hits['GET /view'] === 6, `${hits['GET /view']} upstream`);
+
+  response = await runtime.dispatch(`${base}/view?filename=a.png`, { headers: { Range: 'bytes=0-3' } });
+  check('range requests bypass the cache', status(response) === 'BYPASS', status(response));
+
+  response = await runtime.dispatch(`${base}/view?filename=a.png&subfolder=`, { headers: { 'If-None-Match': '"a.png-0"' } });
+  check('a browser holding the same bytes gets 304', response.status === 304 && status(response) === 'REVALIDATED',
+        `${response.status} ${status(response)}`);
+  writes['a.png'] = 1;
+  response = await get('/view?filename=a.png&subfolder=');
+  check('an output written again under its name is fetched again',
+        status(response) === 'MISS' && await response.text() === 'image:a.png:1', status(response));
+  response = await get('/view?filename=a.png&subfolder=');
+  check('and its new bytes are kept', status(response) === 'REVALIDATED' && await response.text() === 'image:a.png:1',
+        status(response));
+
+  response = await get('/object_info');
+  const first = await response.json();
+  response = await get('/object_info');
+  check('schemas are cached', status(response) === 'HIT' && (await response.json()).calls === first.calls,
+        status(response));
+  if (runtime.advance) {
+    runtime.advance(61);
+    response = await get('/object_info');
+    check('schemas expire after their TTL', status(response) === 'MISS' && hits['GET /object_info'] === 2,
+          status(response));
+  }
+
+  await get('/history/p1');
+  response = await get('/history/p1');
+  check('history is always fetched', status(response) === 'BYPASS' && hits['GET /history/p1'] === 2);
+
+  await get('/aircomfy/health');
+  response = await get('/aircomfy/health');
+  const health = response.headers.get('Content-Type') === 'application/json' ? await response.json() : {};
+  check('proxy endpoints are forwarded and never cached',
+        status(response) === 'BYPASS' && health.calls === 2 && hits['GET /aircomfy/health'] === 2,
+        `${status(response)}, ${hits['GET /aircomfy/health']} upstream`);
+
+  response = await runtime.dispatch(`${base}/prompt`, { method: 'POST', body: '{}' });
+  check('mutations are never cached', status(response) === 'BYPASS' && hits['POST /prompt'] === 1);
+
+  response = await runtime.dispatch(`${base}/`, { headers: { 'Accept-Encoding': 'gzip, br;q=0' } });
+  if (response.status === 404) {
+    console.log('\n(no static files embedded; run build_pwa.py and pass PWA/dist/worker.js to check them)');
+  } else {
+    await staticChecks(runtime, base, response);
+  }
+
+  await runtime.close();
+  comfyui.close();
+  const failed = checks.filter(ok => !ok).length;
+  console.log(`\n${checks.length - failed} passed, ${failed} failed`);
+  process.exit(failed ? 1 : 0);
+}
+
+main();
@@ -12,326 +12,31 @@ const ALLOWED_ORIGINS = [
   // 'http://localhost:3000',  // For local development
 ];
 
-// PWA static files - base64 encoded or raw text
+// ComfyUI paths forwarded to COMFYUI_SERVER, plus the AirComfy proxy's own endpoints
+const API_PATHS = ['/system_stats', '/prompt', '/history', '/view', '/ws',
+                   '/object_info', '/embeddings', '/extensions', '/aircomfy/'];
+// Proxy endpoints (templates, queue, bulk history, metrics) answer per client and per moment
+const UNCACHED_PATHS = ['/aircomfy/'];
+
+// Edge cache (caches.default). ComfyUI can write an output again under the same
+// name (its counter restarts after files are deleted), so a kept output is
+// revalidated by ETag on every use and only its bytes are saved.
+const OUTPUT_MAX_AGE = 31536000;
+// Node schemas and model lists only change when nodes or models are installed
+const SCHEMA_MAX_AGE = 60;
+const SCHEMA_PATHS = ['/object_info', '/embeddings', '/extensions'];
+// /view parameters that change the bytes served; others, like cache busters, are left out of the key
+const VIEW_KEY_PARAMS = ['filename', 'subfolder', 'type', 'preview', 'channel'];
+
+// Static PWA files, generated by build_pwa.py into PWA/dist/worker.js.
+// STATIC_FILES maps URL paths to files. Each file has its content type, a
+// strong ETag and its body as base64: precompressed (br, gzip) for text,
+// as-is otherwise.
 const STATIC_FILES = {
-  '/': 'index.html',
-  '/index.html': 'index.html',
-  '/style.css': 'style.css',
-  '/manifest.json': 'manifest.json',
-  '/sw.js': 'sw.js',
-  '/icon-192.png': 'icon-192.png'
+  '/': 'index.html'
 };
 
-// File contents will be served from these
 const PWA_FILES = {
-  'index.html': `<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>AirComfy</title>
-    <link rel="stylesheet" href="style.css">
-    <link rel="manifest" href="manifest.json">
-    <meta name="theme-color" content="#2196F3">
-    <meta name="description" content="Minimal PWA for ComfyUI workflow execution">
-</head>
-<body>
-    <header>
-        <h1>AirComfy</h1>
-        <div class="connection-status" id="connectionStatus">Disconnected</div>
-    </header>
-
-    <main>
-        <section class="config-section">
-            <h2>ComfyUI Configuration</h2>
-            <div class="input-group">
-                <label for="serverUrl">Server URL:</label>
-                <input type="url" id="serverUrl" placeholder="Leave empty to use proxy" value="">
-            </div>
-            <button id="connectBtn" class="primary-btn">Connect</button>
-        </section>
-
-        <section class="workflow-section">
-            <h2>Workflow</h2>
-            <div class="input-group">
-                <label for="workflowInput">JSON Workflow:</label>
-                <textarea id="workflowInput" placeholder="Paste your ComfyUI workflow JSON here..." rows="10"></textarea>
-            </div>
-            <div class="workflow-actions">
-                <button id="validateBtn" class="secondary-btn">Validate</button>
-                <button id="executeBtn" class="primary-btn" disabled>Execute</button>
-            </div>
-        </section>
-
-        <section class="results-section">
-            <h2>Results</h2>
-            <div id="status" class="status-display"></div>
-            <div id="progress" class="progress-display"></div>
-            <div id="results" class="results-display"></div>
-        </section>
-    </main>
-
-    <script>
-        class AirComfy {
-            constructor() {
-                this.serverUrl = '';
-                this.clientId = this.generateClientId();
-                this.websocket = null;
-                this.currentPromptId = null;
-                this.init();
-            }
-
-            init() {
-                this.bindEvents();
-                this.loadSettings();
-                this.registerServiceWorker();
-            }
-
-            bindEvents() {
-                document.getElementById('connectBtn').addEventListener('click', () => this.connect());
-                document.getElementById('validateBtn').addEventListener('click', () => this.validateWorkflow());
-                document.getElementById('executeBtn').addEventListener('click', () => this.executeWorkflow());
-                document.getElementById('serverUrl').addEventListener('input', (e) => this.saveSettings());
-            }
-
-            generateClientId() {
-                return Math.random().toString(36).substring(2) + Date.now().toString(36);
-            }
-
-            loadSettings() {
-                const saved = localStorage.getItem('aircomfy-settings');
-                if (saved) {
-                    const settings = JSON.parse(saved);
-                    document.getElementById('serverUrl').value = settings.serverUrl || '';
-                }
-            }
-
-            saveSettings() {
-                const settings = {
-                    serverUrl: document.getElementById('serverUrl').value
-                };
-                localStorage.setItem('aircomfy-settings', JSON.stringify(settings));
-            }
-
-            async connect() {
-                const serverUrl = document.getElementById('serverUrl').value.trim();
-
-                // Use proxy if no server URL specified
-                this.serverUrl = serverUrl || window.location.origin;
-                this.saveSettings();
-
-                try {
-                    const response = await fetch(\`\${this.serverUrl}/system_stats\`);
-                    if (response.ok) {
-                        this.updateConnectionStatus('Connected');
-                        this.connectWebSocket();
-                        document.getElementById('executeBtn').disabled = false;
-                        this.updateStatus('Connected to ComfyUI server', 'success');
-                    } else {
-                        throw new Error(\`Server responded with \${response.status}\`);
-                    }
-                } catch (error) {
-                    this.updateConnectionStatus('Disconnected');
-                    document.getElementById('executeBtn').disabled = true;
-                    this.updateStatus(\`Connection failed: \${error.message}\`, 'error');
-                }
-            }
-
-            connectWebSocket() {
-                const wsUrl = this.serverUrl.replace('http', 'ws') + \`/ws?clientId=\${this.clientId}\`;
-
-                if (this.websocket) {
-                    this.websocket.close();
-                }
-
-                this.websocket = new WebSocket(wsUrl);
-
-                this.websocket.onopen = () => {
-                    this.updateStatus('WebSocket connected', 'success');
-                };
-
-                this.websocket.onmessage = (event) => {
-                    const data = JSON.parse(event.data);
-                    this.handleWebSocketMessage(data);
-                };
-
-                this.websocket.onclose = () => {
-                    this.updateStatus('WebSocket disconnected', 'warning');
-                };
-
-                this.websocket.onerror = (error) => {
-                    this.updateStatus('WebSocket error occurred', 'error');
-                };
-            }
-
-            handleWebSocketMessage(data) {
-                if (data.type === 'status') {
-                    this.updateProgress(\`Queue: \${data.data.status.exec_info.queue_remaining}\`);
-                } else if (data.type === 'progress') {
-                    const progress = Math.round((data.data.value / data.data.max) * 100);
-                    this.updateProgress(\`Progress: \${progress}% (\${data.data.node})\`);
-                } else if (data.type === 'executed') {
-                    this.handleExecutionComplete(data.data);
-                }
-            }
-
-            validateWorkflow() {
-                const workflowText = document.getElementById('workflowInput').value.trim();
-
-                if (!workflowText) {
-                    this.updateStatus('Please enter a workflow', 'error');
-                    return false;
-                }
-
-                try {
-                    const workflow = JSON.parse(workflowText);
-                    if (typeof workflow !== 'object' || !workflow) {
-                        throw new Error('Invalid workflow format');
-                    }
-                    this.updateStatus('Workflow validation passed', 'success');
-                    return true;
-                } catch (error) {
-                    this.updateStatus(\`Workflow validation failed: \${error.message}\`, 'error');
-                    return false;
-                }
-            }
-
-            async executeWorkflow() {
-                if (!this.validateWorkflow()) return;
-                if (!this.serverUrl) {
-                    this.updateStatus('Please connect to server first', 'error');
-                    return;
-                }
-
-                const workflowText = document.getElementById('workflowInput').value.trim();
-                const workflow = JSON.parse(workflowText);
-
-                const promptData = {
-                    prompt: workflow,
-                    client_id: this.clientId
-                };
-
-                try {
-                    this.updateStatus('Submitting workflow...', 'info');
-                    const response = await fetch(\`\${this.serverUrl}/prompt\`, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify(promptData)
-                    });
-
-                    if (response.ok) {
-                        const result = await response.json();
-                        this.currentPromptId = result.prompt_id;
-                        this.updateStatus(\`Workflow submitted. Prompt ID: \${this.currentPromptId}\`, 'success');
-                    } else {
-                        throw new Error(\`Server error: \${response.status}\`);
-                    }
-                } catch (error) {
-                    this.updateStatus(\`Execution failed: \${error.message}\`, 'error');
-                }
-            }
-
-            async handleExecutionComplete(data) {
-                if (data.prompt_id === this.currentPromptId) {
-                    this.updateStatus('Workflow execution completed', 'success');
-                    this.updateProgress('Complete');
-
-                    try {
-                        const historyResponse = await fetch(\`\${this.serverUrl}/history/\${this.currentPromptId}\`);
-                        if (historyResponse.ok) {
-                            const history = await historyResponse.json();
-                            this.displayResults(history);
-                        }
-                    } catch (error) {
-                        this.updateStatus(\`Failed to fetch results: \${error.message}\`, 'error');
-                    }
-                }
-            }
-
-            displayResults(history) {
-                const resultsDiv = document.getElementById('results');
-                resultsDiv.innerHTML = '';
-
-                for (const [promptId, promptData] of Object.entries(history)) {
-                    if (promptData.outputs) {
-                        for (const [nodeId, nodeOutput] of Object.entries(promptData.outputs)) {
-                            if (nodeOutput.images) {
-                                nodeOutput.images.forEach(image => {
-                                    const img = document.createElement('img');
-                                    img.src = \`\${this.serverUrl}/view?filename=\${image.filename}&subfolder=\${image.subfolder}&type=\${image.type}\`;
-                                    img.alt = \`Generated image from node \${nodeId}\`;
-                                    img.className = 'result-image';
-                                    resultsDiv.appendChild(img);
-                                });
-                            }
-                        }
-                    }
-                }
-
-                if (resultsDiv.innerHTML === '') {
-                    resultsDiv.innerHTML = '<p>No images generated</p>';
-                }
-            }
-
-            updateConnectionStatus(status) {
-                const element = document.getElementById('connectionStatus');
-                element.textContent = status;
-                element.className = \`connection-status \${status.toLowerCase()}\`;
-            }
-
-            updateStatus(message, type = 'info') {
-                const element = document.getElementById('status');
-                element.textContent = message;
-                element.className = \`status-display \${type}\`;
-            }
-
-            updateProgress(message) {
-                document.getElementById('progress').textContent = message;
-            }
-
-            async registerServiceWorker() {
-                if ('serviceWorker' in navigator) {
-                    try {
-                        await navigator.serviceWorker.register('./sw.js');
-                    } catch (error) {
-                        console.warn('Service Worker registration failed');
-                    }
-                }
-            }
-        }
-
-        document.addEventListener('DOMContentLoaded', () => {
-            new AirComfy();
-        });
-    </script>
-</body>
-</html>`,
-
-  'style.css': `/* CSS content from original style.css */`,
-  'manifest.json': `{
-    "name": "AirComfy",
-    "short_name": "AirComfy",
-    "description": "Minimal PWA for ComfyUI workflow execution",
-    "start_url": "./",
-    "display": "standalone",
-    "background_color": "#ffffff",
-    "theme_color": "#2196F3",
-    "orientation": "portrait-primary",
-    "scope": "./",
-    "lang": "en",
-    "categories": ["productivity", "utilities"],
-    "icons": [
-        {
-            "src": "icon-192.png",
-            "sizes": "192x192",
-            "type": "image/png",
-            "purpose": "maskable any"
-        }
-    ]
-}`,
-  'sw.js': `/* Service worker content */`
 };
 
 function isOriginAllowed(origin, request) {
@@ -359,20 +64,108 @@ function addCorsHeaders(response, origin, request) {
   response.headers.set('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS');
   response.headers.set('Access-Control-Allow-Headers', 'Content-Type, Authorization');
   response.headers.set('Access-Control-Allow-Credentials', 'false');
+  // Let the PWA read the edge cache status alongside the proxy's own headers
+  response.headers.set('Access-Control-Expose-Headers',
+                       'X-AirComfy-Cache, X-AirComfy-Prompt-Reduction, Server-Timing');
   return response;
 }
 
-async function handleRequest(request) {
+function isApiPath(path) {
+  return API_PATHS.some(prefix => path.startsWith(prefix));
+}
+
+// Cache key and lifetime for a shareable GET, or null when it must go to ComfyUI
+function edgeCachePolicy(request, url) {
+  if (request.method !== 'GET' || request.headers.has('Range')) return null;
+  if (UNCACHED_PATHS.some(prefix => url.pathname.startsWith(prefix))) return null;
+
+  if (url.pathname === '/view') {
+    // Temp files and inputs can be replaced under the same name
+    const type = url.searchParams.get('type') || 'output';
+    if (type !== 'output' || !url.searchParams.get('filename')) return null;
+    const key = new URL('/view', url.origin);
+    for (const name of VIEW_KEY_PARAMS) {
+      const value = name === 'type' ? type : url.searchParams.get(name);
+      if (value !== null) key.searchParams.set(name, value);
+    }
+    return { key: key.toString(), cacheControl: `public, max-age=${OUTPUT_MAX_AGE}`, revalidate: true };
+  }
+
+  if (SCHEMA_PATHS.some(prefix => url.pathname === prefix || url.pathname.startsWith(`${prefix}/`))) {
+    const key = new URL(url.pathname, url.origin);
+    const params = [...url.searchParams].sort(([a], [b]) => (a < b ? -1 : a > b ? 1 : 0));
+    for (const [name, value] of params) key.searchParams.append(name, value);
+    return { key: key.toString(), cacheControl: `public, max-age=${SCHEMA_MAX_AGE}` };
+  }
+  return null;
+}
+
+// Copy of a response with mutable headers and X-AirComfy-Cache set
+function withCacheStatus(response, status) {
+  const copy = new Response(response.body, response);
+  copy.headers.set('X-AirComfy-Cache', status);
+  return copy;
+}
+
+async function fetchComfyUI(request, url) {
+  const proxyRequest = new Request(COMFYUI_SERVER + url.pathname + url.search, {
+    method: request.method,
+    headers: request.headers,
+    body: request.body
+  });
+  const response = await fetch(proxyRequest);
+  return new Response(response.body, {
+    status: response.status,
+    statusText: response.statusText,
+    headers: response.headers
+  });
+}
+
+async function fetchEdgeCached(request, url, policy, event) {
+  const cache = caches.default;
+  const cached = await cache.match(policy.key);
+  if (cached && !policy.revalidate) {
+    return withCacheStatus(cached, 'HIT');
+  }
+
+  let response;
+  const etag = cached && cached.headers.get('ETag');
+  if (etag) {
+    // ComfyUI answers 304 while the file still has the bytes the edge holds
+    const headers = new Headers(request.headers);
+    headers.set('If-None-Match', etag);
+    response = await fetchComfyUI(new Request(request, { headers }), url);
+    if (response.status === 304) {
+      const status = ifNoneMatch(request, etag) ? new Response(null, { status: 304, headers: { ETag: etag } })
+                                                : cached;
+      return clientCopy(withCacheStatus(status, 'REVALIDATED'), policy);
+    }
+  } else {
+    response = await fetchComfyUI(request, url);
+  }
+  if (response.status !== 200) {
+    return withCacheStatus(response, 'BYPASS');
+  }
+  // The edge keeps the copy for as long as its Cache-Control allows
+  response.headers.set('Cache-Control', policy.cacheControl);
+  response.headers.delete('Set-Cookie');
+  event.waitUntil(cache.put(policy.key, response.clone()));
+  return clientCopy(withCacheStatus(response, 'MISS'), policy);
+}
+
+// Browsers revalidate outputs too, rather than keeping a copy the edge would refresh
+function clientCopy(response, policy) {
+  if (policy.revalidate) response.headers.set('Cache-Control', 'no-cache');
+  return response;
+}
+
+async function handleRequest(request, event) {
   const url = new URL(request.url);
   const path = url.pathname;
   const origin = request.headers.get('Origin');
 
   // Check if origin is allowed (for API endpoints only, not static files)
-  const isApiRequest = path.startsWith('/system_stats') ||
-                      path.startsWith('/prompt') ||
-                      path.startsWith('/history') ||
-                      path.startsWith('/view') ||
-                      path.startsWith('/ws');
+  const isApiRequest = isApiPath(path);
 
   if (isApiRequest && !isOriginAllowed(origin, request)) {
     return new Response('Origin not allowed', {
@@ -387,46 +180,28 @@ async function handleRequest(request) {
   }
 
   // Serve static PWA files
-  if (STATIC_FILES[path]) {
-    const filename = STATIC_FILES[path];
-    if (PWA_FILES[filename]) {
-      const contentType = getContentType(filename);
-      const response = new Response(PWA_FILES[filename], {
-        headers: { 'Content-Type': contentType }
-      });
-      return addCorsHeaders(response, origin, request);
-    }
+  if (STATIC_FILES[path] && PWA_FILES[STATIC_FILES[path]]) {
+    return addCorsHeaders(serveStatic(STATIC_FILES[path], request), origin, request);
   }
 
   // Proxy to ComfyUI API
-  if (path.startsWith('/system_stats') ||
-      path.startsWith('/prompt') ||
-      path.startsWith('/history') ||
-      path.startsWith('/view') ||
-      path.startsWith('/ws')) {
+  if (isApiRequest) {
 
     // WebSocket upgrade
     if (request.headers.get('Upgrade') === 'websocket') {
       return handleWebSocket(request);
     }
 
-    // Regular HTTP proxy
-    const targetUrl = COMFYUI_SERVER + path + url.search;
-
-    const proxyRequest = new Request(targetUrl, {
-      method: request.method,
-      headers: request.headers,
-      body: request.body
-    });
-
     try {
-      const response = await fetch(proxyRequest);
-      const newResponse = new Response(response.body, {
-        status: response.status,
-        statusText: response.statusText,
-        headers: response.headers
-      });
-      return addCorsHeaders(newResponse, origin, request);
+      const policy = edgeCachePolicy(request, url);
+      let response;
+      if (policy) {
+        response = await fetchEdgeCached(request, url, policy, event);
+      } else {
+        response = await fetchComfyUI(request, url);
+        response.headers.set('X-AirComfy-Cache', 'BYPASS');
+      }
+      return addCorsHeaders(response, origin, request);
     } catch (error) {
       return addCorsHeaders(new Response(JSON.stringify({ error: error.message }), {
         status: 500,
@@ -436,10 +211,13 @@ async function handleRequest(request) {
   }
 
   // Default: serve index.html
-  const response = new Response(PWA_FILES['index.html'], {
-    headers: { 'Content-Type': 'text/html' }
-  });
-  return addCorsHeaders(response, origin, request);
+  if (!PWA_FILES['index.html']) {
+    return new Response('No PWA files embedded; deploy PWA/dist/worker.js from build_pwa.py', {
+      status: 404,
+      headers: { 'Content-Type': 'text/plain' }
+    });
+  }
+  return addCorsHeaders(serveStatic('index.html', request), origin, request);
 }
 
 async function handleWebSocket(request) {
@@ -467,16 +245,69 @@ async function handleWebSocket(request) {
   return new Response(null, { status: 101, webSocket: client });
 }
 
-function getContentType(filename) {
-  if (filename.endsWith('.html')) return 'text/html';
-  if (filename.endsWith('.css')) return 'text/css';
-  if (filename.endsWith('.js')) return 'application/javascript';
-  if (filename.endsWith('.json')) return 'application/json';
-  if (filename.endsWith('.png')) return 'image/png';
-  return 'text/plain';
+// Encodings the client accepts, from Accept-Encoding (q=0 excludes)
+function acceptedEncodings(header) {
+  const accepted = new Set();
+  for (const part of (header || '').toLowerCase().split(',')) {
+    const [name, ...params] = part.split(';').map(token => token.trim());
+    const quality = params.find(param => param.startsWith('q='));
+    if (name && !(quality && parseFloat(quality.slice(2)) === 0)) {
+      accepted.add(name);
+    }
+  }
+  return accepted;
+}
+
+function ifNoneMatch(request, etag) {
+  const header = request.headers.get('If-None-Match');
+  if (!header) return false;
+  return header.trim() === '*' || header.split(',').some(tag => tag.trim().replace(/^W\//, '') === etag);
+}
+
+// Base64 bodies are decoded once per isolate
+const decodedBodies = new Map();
+
+function fileBytes(filename, encoding) {
+  const key = `${filename}:${encoding}`;
+  if (!decodedBodies.has(key)) {
+    decodedBodies.set(key, Uint8Array.from(atob(PWA_FILES[filename][encoding]), c => c.charCodeAt(0)));
+  }
+  return decodedBodies.get(key);
+}
+
+// A file from the generated table, negotiated by Accept-Encoding and revalidated by ETag
+function serveStatic(filename, request) {
+  const file = PWA_FILES[filename];
+  const accepted = acceptedEncodings(request.headers.get('Accept-Encoding'));
+  const encoding = ['br', 'gzip'].find(name => file[name] && (accepted.has(name) || accepted.has('*'))) || 'identity';
+  // Each encoding is a different byte sequence, so it gets its own strong ETag
+  const etag = encoding === 'identity' ? file.etag : `${file.etag.slice(0, -1)}-${encoding}"`;
+  const headers = {
+    'Content-Type': file.type,
+    // build_pwa.py names assets by content hash, so they never need revalidating
+    'Cache-Control': filename.startsWith('assets/') ? 'public, max-age=31536000, immutable' : 'no-cache',
+    'ETag': etag,
+    'Vary': 'Accept-Encoding'
+  };
+  if (ifNoneMatch(request, etag)) {
+    return new Response(null, { status: 304, headers });
+  }
+
+  let body;
+  if (encoding !== 'identity') {
+    headers['Content-Encoding'] = encoding;
+    body = fileBytes(filename, encoding);
+  } else if (file.identity) {
+    body = fileBytes(filename, 'identity');
+  } else {
+    // Text is only stored compressed; the rare client without gzip gets it inflated here
+    body = new Response(fileBytes(filename, 'gzip')).body.pipeThrough(new DecompressionStream('gzip'));
+  }
+  // `manual` sends the precompressed bytes as they are instead of encoding them again
+  return new Response(request.method === 'HEAD' ? null : body, { headers, encodeBody: 'manual' });
 }
 
 // Cloudflare Worker event listener
 addEventListener('fetch', event => {
-  event.respondWith(handleRequest(event.request));
+  event.respondWith(handleRequest(event.request, event));
 });
\ No newline at end of file
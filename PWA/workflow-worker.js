@@ -0,0 +1,180 @@
+// Holds the loaded workflow off the main thread. Parsing, node extraction,
+// validation and request serialization happen here; the page only receives
+// a compact summary of each node and ready-to-send request bodies, passed
+// as transferred ArrayBuffers rather than copied strings.
+
+// Inputs longer than this (base64 images, long prompt lists) stay out of the summary
+const LARGE_VALUE = 4096;
+const PREVIEW_CHARS = 64 * 1024;
+
+const encoder = new TextEncoder();
+const decoder = new TextDecoder();
+
+// The document as loaded: a bare graph or a wrapped /prompt payload
+let workflow = null;
+// Graph last uploaded as a proxy template, to diff later runs against
+let template = null;
+let uploading = null;
+
+function graph() {
+    return workflow.prompt || workflow;
+}
+
+function isLink(value) {
+    return Array.isArray(value) && value.length === 2
+        && (typeof value[0] === 'string' || typeof value[0] === 'number') && Number.isInteger(value[1]);
+}
+
+function encode(value) {
+    return encoder.encode(JSON.stringify(value)).buffer;
+}
+
+function summarize() {
+    const nodes = {};
+    for (const [nodeId, node] of Object.entries(graph())) {
+        if (typeof node !== 'object' || node === null) continue;
+        const inputs = {};
+        const large = {};
+        for (const [name, value] of Object.entries(node.inputs || {})) {
+            if (isLink(value) || value === null || typeof value === 'number' || typeof value === 'boolean') {
+                inputs[name] = value;
+            } else if (typeof value === 'string' && value.length <= LARGE_VALUE) {
+                inputs[name] = value;
+            } else {
+                large[name] = typeof value === 'string' ? value.length : JSON.stringify(value).length;
+            }
+        }
+        nodes[nodeId] = { class_type: node.class_type || 'Unknown', inputs };
+        if (Object.keys(large).length > 0) nodes[nodeId].large = large;
+    }
+    return nodes;
+}
+
+function preview() {
+    const text = JSON.stringify(workflow, (key, value) => {
+        if (typeof value === 'string' && value.length > LARGE_VALUE) {
+            return `${value.slice(0, 64)}… (${value.length} characters)`;
+        }
+        return value;
+    }, 2);
+    if (text.length <= PREVIEW_CHARS) return text;
+    return `${text.slice(0, PREVIEW_CHARS)}\n… (${text.length - PREVIEW_CHARS} more characters)`;
+}
+
+function validate() {
+    const nodes = graph();
+    const errors = [];
+    if (typeof nodes !== 'object' || nodes === null || Array.isArray(nodes)) {
+        return { ok: false, errors: ['Invalid workflow format'] };
+    }
+    const ids = Object.keys(nodes);
+    if (ids.length === 0) errors.push('Workflow has no nodes');
+    for (const nodeId of ids) {
+        const node = nodes[nodeId];
+        if (typeof node !== 'object' || node === null) {
+            errors.push(`Node ${nodeId} is not an object`);
+            continue;
+        }
+        if (!node.class_type) errors.push(`Node ${nodeId} has no class_type`);
+        for (const [name, value] of Object.entries(node.inputs || {})) {
+            if (isLink(value) && !(String(value[0]) in nodes)) {
+                errors.push(`Node ${nodeId} input ${name} links to missing node ${value[0]}`);
+            }
+        }
+    }
+    return { ok: errors.length === 0, errors };
+}
+
+function payload(clientId) {
+    // A saved /prompt payload keeps its extra fields; a bare graph gets wrapped
+    if (workflow.prompt && workflow.client_id) {
+        return { ...workflow, client_id: clientId };
+    }
+    return { prompt: workflow, client_id: clientId };
+}
+
+// Inputs changed since the template was uploaded, or null when the graph's structure differs
+function overrides(hash) {
+    if (!template || template.hash !== hash) return null;
+    const nodes = graph();
+    const base = template.base;
+    if (Object.keys(nodes).length !== Object.keys(base).length) return null;
+
+    const changed = {};
+    for (const [nodeId, node] of Object.entries(nodes)) {
+        const previous = base[nodeId];
+        if (!previous || previous.class_type !== node.class_type) return null;
+        const inputs = node.inputs || {};
+        const previousInputs = previous.inputs || {};
+        if (Object.keys(previousInputs).some(name => !(name in inputs))) return null;
+        for (const [name, value] of Object.entries(inputs)) {
+            if (JSON.stringify(value) !== JSON.stringify(previousInputs[name])) {
+                (changed[nodeId] = changed[nodeId] || {})[name] = value;
+            }
+        }
+    }
+    return changed;
+}
+
+const handlers = {
+    load({ buffer }) {
+        const parsed = JSON.parse(decoder.decode(buffer));
+        if (typeof parsed !== 'object' || !parsed) {
+            throw new Error('Invalid JSON format');
+        }
+        workflow = parsed;
+        const nodes = summarize();
+        return {
+            nodes,
+            preview: preview(),
+            nodeCount: Object.keys(nodes).length,
+            bytes: buffer.byteLength
+        };
+    },
+
+    update({ nodeId, field, value }) {
+        graph()[nodeId].inputs[field] = value;
+    },
+
+    validate() {
+        return validate();
+    },
+
+    // The /prompt body, the bare graph (for a template upload) or the document as loaded
+    serialize({ part, clientId }) {
+        if (part === 'payload') return encode(payload(clientId));
+        if (part === 'prompt') {
+            // Snapshot what is uploaded, so edits made meanwhile still show up as overrides
+            uploading = structuredClone(graph());
+            return encode(uploading);
+        }
+        return encode(workflow);
+    },
+
+    overrides({ hash, clientId }) {
+        const { prompt, ...rest } = payload(clientId);
+        return { overrides: overrides(hash), rest };
+    },
+
+    remember({ hash }) {
+        template = { hash, base: uploading };
+        uploading = null;
+    },
+
+    clear() {
+        workflow = null;
+    }
+};
+
+self.onmessage = ({ data }) => {
+    const { id, type, ...args } = data;
+    try {
+        if (workflow === null && !['load', 'clear', 'remember'].includes(type)) {
+            throw new Error('No workflow loaded');
+        }
+        const result = handlers[type](args);
+        self.postMessage({ id, result }, result instanceof ArrayBuffer ? [result] : []);
+    } catch (error) {
+        self.postMessage({ id, error: error.message });
+    }
+};
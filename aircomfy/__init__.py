@@ -0,0 +1,7 @@
+"""
+Python client for ComfyUI and the AirComfy proxy.
+"""
+
+from .client import Client, ComfyError, PromptFailed, apply_overrides, output_files
+
+__all__ = ['Client', 'ComfyError', 'PromptFailed', 'apply_overrides', 'output_files']
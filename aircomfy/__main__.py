@@ -0,0 +1,52 @@
+"""
+Command line entry point.
+Usage: python -m aircomfy run workflow.json jobs.jsonl [--url http://localhost:8080] [--out outputs]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from .batch import BatchRunner, load_workflow, read_jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='aircomfy', description='AirComfy command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Render every job of a JSONL file; rerun to resume')
+    run.add_argument('workflow', help='API-format workflow JSON, e.g. SD15-basicT2I.json')
+    run.add_argument('jobs', help='JSONL of per-job overrides: {"id": ..., "overrides": {"3": {"seed": 1}}}')
+    run.add_argument('--url', default='http://localhost:8080',
+                     help='ComfyUI or AirComfy proxy URL (default: http://localhost:8080)')
+    run.add_argument('--out', default='outputs',
+                     help='Directory for downloaded outputs (default: outputs)')
+    run.add_argument('--results',
+                     help='Results JSONL, also the resume checkpoint (default: <out>/results.jsonl)')
+    run.add_argument('--concurrency', type=int, default=4,
+                     help='Jobs in flight at once (default: 4)')
+    run.add_argument('--no-download', action='store_true',
+                     help='Record output file names without downloading them')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    runner = BatchRunner(args.url, load_workflow(args.workflow), args.out, results_path=args.results,
+                         concurrency=args.concurrency, download=not args.no_download)
+    try:
+        summary = asyncio.run(runner.run(read_jobs(args.jobs)))
+    except KeyboardInterrupt:
+        print(f"Interrupted; run the same command again to resume from {runner.results_path}", file=sys.stderr)
+        sys.exit(130)
+
+    print(json.dumps(summary))
+    rate = summary.get('sustained_jobs_per_minute', summary['jobs_per_minute'])
+    print(f"{summary['done']} done, {summary['failed']} failed, {summary['skipped']} already done "
+          f"in {summary['seconds']}s: {rate} jobs/minute", file=sys.stderr)
+    sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Headless batch rendering: one workflow, a JSONL file of per-job overrides.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import aiohttp
+
+from .client import Client, ComfyError, output_files
+
+logger = logging.getLogger(__name__)
+
+
+def load_workflow(path):
+    with open(path) as f:
+        workflow = json.load(f)
+    # Accept a saved /prompt payload as well as a bare API-format graph
+    if isinstance(workflow, dict) and isinstance(workflow.get('prompt'), dict):
+        workflow = workflow['prompt']
+    return workflow
+
+
+def read_jobs(path):
+    """(job_id, overrides) for each line: {"id": ..., "overrides": {...}} or a bare overrides object"""
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if 'overrides' in job:
+                yield str(job.get('id', line_number)), job['overrides']
+            else:
+                yield str(line_number), job
+
+
+def safe_name(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def output_path(item, taken):
+    """
+    Where an output file goes inside its job's directory: its subfolder,
+    sanitized, then its filename. A name already in taken (e.g. the same
+    file as output and temp) gets a numbered suffix.
+    """
+    parts = [safe_name(part) for part in re.split(r'[\\/]', item.get('subfolder') or '')
+             if part not in ('', '.', '..')]
+    name = os.path.basename(item['filename'].replace('\\', '/'))
+    stem, ext = os.path.splitext(name if name not in ('', '.', '..') else 'output')
+    path = os.path.join(*parts, stem + ext)
+    counter = 1
+    while path in taken:
+        path = os.path.join(*parts, f"{stem}_{counter}{ext}")
+        counter += 1
+    taken.add(path)
+    return path
+
+
+def read_records(path):
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    pass
+    return records
+
+
+class BatchRunner:
+    """
+    Streams jobs through ComfyUI with at most `concurrency` in flight.
+    Finished jobs go to results_path; submitted ones to results_path +
+    '.pending', so a rerun skips the former and waits for the latter.
+    """
+
+    def __init__(self, url, workflow, out_dir, results_path=None, concurrency=4, download=True):
+        self.url = url
+        self.workflow = workflow
+        self.out_dir = out_dir
+        self.results_path = results_path or os.path.join(out_dir, 'results.jsonl')
+        self.pending_path = self.results_path + '.pending'
+        self.concurrency = concurrency
+        self.download = download
+        # Stable per results file, so a resumed run still receives its prompts' events
+        digest = hashlib.sha1(os.path.abspath(self.results_path).encode()).hexdigest()[:12]
+        self.client_id = f"aircomfy-batch-{digest}"
+        self.stats = {'done': 0, 'failed': 0, 'skipped': 0, 'resumed': 0}
+        self.finish_times = []
+
+    def write(self, path, record):
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    async def run(self, jobs):
+        os.makedirs(self.out_dir, exist_ok=True)
+        done = {r['id'] for r in read_records(self.results_path) if r.get('status') == 'ok'}
+        submitted = {r['id']: r['prompt_id'] for r in read_records(self.pending_path)}
+        started = time.monotonic()
+
+        async with Client(self.url, client_id=self.client_id,
+                          max_connections=max(self.concurrency, 4)) as client:
+            template = await client.register(self.workflow)
+            jobs = iter(jobs)
+
+            async def worker():
+                for job_id, overrides in jobs:
+                    if job_id in done:
+                        self.stats['skipped'] += 1
+                        continue
+                    await self.run_job(client, template, job_id, overrides, submitted.get(job_id))
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        return self.summary(time.monotonic() - started)
+
+    async def run_job(self, client, template, job_id, overrides, prompt_id=None):
+        started = time.monotonic()
+        try:
+            if prompt_id is not None and await self.still_known(client, prompt_id):
+                self.stats['resumed'] += 1
+            else:
+                if template is not None:
+                    prompt_id = await client.submit(None, template=template, overrides=overrides)
+                else:
+                    prompt_id = await client.submit(self.workflow, overrides=overrides)
+                self.write(self.pending_path, {'id': job_id, 'prompt_id': prompt_id})
+
+            outputs = await client.result(prompt_id)
+            files = []
+            if self.download:
+                job_dir = os.path.join(self.out_dir, safe_name(job_id))
+                taken = set()
+                for item in output_files(outputs):
+                    path = os.path.join(job_dir, output_path(item, taken))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    await client.download(item, path)
+                    files.append(os.path.relpath(path, self.out_dir))
+            record = {'id': job_id, 'prompt_id': prompt_id, 'status': 'ok', 'outputs': files}
+            self.stats['done'] += 1
+            self.finish_times.append(time.monotonic())
+        except (ComfyError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            # A dropped connection or a full disk fails this job only; a rerun retries it
+            error = str(e) or type(e).__name__
+            record = {'id': job_id, 'prompt_id': prompt_id, 'status': 'failed', 'error': error}
+            self.stats['failed'] += 1
+            logger.warning(f"Job {job_id} failed: {error}")
+        record['seconds'] = round(time.monotonic() - started, 3)
+        self.write(self.results_path, record)
+
+    async def still_known(self, client, prompt_id):
+        """Whether a prompt from an earlier run is still queued or already in the history"""
+        if await client.queue_status([prompt_id]):
+            return True
+        return bool(await client.history([prompt_id]))
+
+    def summary(self, elapsed):
+        summary = {**self.stats, 'seconds': round(elapsed, 1),
+                   'jobs_per_minute': round(self.stats['done'] / elapsed * 60, 2) if elapsed else None}
+        # Throughput between the first and last completion, without start-up and drain
+        if len(self.finish_times) > 2:
+            window = self.finish_times[-1] - self.finish_times[0]
+            if window > 0:
+                summary['sustained_jobs_per_minute'] = round((len(self.finish_times) - 1) / window * 60, 2)
+        return summary
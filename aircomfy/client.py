@@ -0,0 +1,323 @@
+"""
+Async client for ComfyUI, directly or through the AirComfy proxy.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+import aiohttp
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, WSMsgType
+
+import proxy
+
+logger = logging.getLogger(__name__)
+
+
+class ComfyError(Exception):
+    """ComfyUI (or the proxy) refused a request"""
+
+    def __init__(self, message, status=None, node_errors=None):
+        super().__init__(message)
+        self.status = status
+        self.node_errors = node_errors or {}
+
+
+class PromptFailed(ComfyError):
+    """A queued prompt raised an error or was interrupted while running"""
+
+
+def apply_overrides(workflow, overrides):
+    """Copy of workflow with {node_id: {input: value}} applied, exactly as the proxy applies them to templates"""
+    prompt, node_errors = proxy.apply_overrides(workflow, overrides or {})
+    if node_errors:
+        raise ComfyError(f"Invalid overrides for node {', '.join(node_errors)}", node_errors=node_errors)
+    return prompt
+
+
+def output_files(outputs):
+    """Every file ({filename, subfolder, type}) in a result's node outputs"""
+    for node_output in outputs.values():
+        for items in node_output.values():
+            if isinstance(items, list):
+                for item in items:
+                    if isinstance(item, dict) and 'filename' in item:
+                        yield item
+
+
+class PendingPrompt:
+    __slots__ = ('future', 'outputs')
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.outputs = {}
+
+
+class Client:
+    """
+    One pooled HTTP session plus one WebSocket shared by every prompt.
+
+        async with Client('http://localhost:8080') as client:
+            prompt_id = await client.submit(workflow)
+            outputs = await client.result(prompt_id)
+            for item in output_files(outputs):
+                await client.download(item, item['filename'])
+    """
+
+    def __init__(self, url='http://localhost:8080', client_id=None, max_connections=16,
+                 connect_timeout=10.0, reconnect_delay=1.0):
+        self.url = url.rstrip('/')
+        self.client_id = client_id or f"aircomfy-{uuid.uuid4().hex}"
+        self.max_connections = max_connections
+        self.timeout = ClientTimeout(total=None, sock_connect=connect_timeout)
+        self.reconnect_delay = reconnect_delay
+        self.session = None
+        # Whether the server is the AirComfy proxy, learned from the first response
+        self.proxied = None
+        self._pending = {}
+        self._last_seq = None
+        self._connected = None
+        self._listener = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        self.session = ClientSession(connector=TCPConnector(limit=self.max_connections), timeout=self.timeout)
+        self._connected = asyncio.Event()
+        self._listener = asyncio.ensure_future(self._listen())
+        self._listener.add_done_callback(self._listener_stopped)
+        connected = asyncio.ensure_future(self._connected.wait())
+        await asyncio.wait([connected, self._listener], return_when=asyncio.FIRST_COMPLETED)
+        connected.cancel()
+        if self._listener.done():
+            # It failed before the first connection; say why instead of waiting forever
+            self._listener.result()
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    async def submit(self, prompt, template=None, overrides=None, **extra):
+        """
+        Queue a prompt and return its id without waiting for it to run.
+        With template (a hash from register()), only overrides are sent.
+        """
+        prompt_id = str(uuid.uuid4())
+        self._pending[prompt_id] = PendingPrompt()
+        payload = {**extra, 'client_id': self.client_id, 'prompt_id': prompt_id}
+        if template is not None:
+            url = f"{self.url}/aircomfy/templates/{template}/run"
+            payload['overrides'] = overrides or {}
+        else:
+            url = f"{self.url}/prompt"
+            payload['prompt'] = apply_overrides(prompt, overrides) if overrides else prompt
+        try:
+            body = await self._request('POST', url, payload)
+        except BaseException:
+            del self._pending[prompt_id]
+            raise
+        # Older ComfyUI ignores the requested id
+        if body.get('prompt_id', prompt_id) != prompt_id:
+            self._pending[body['prompt_id']] = self._pending.pop(prompt_id)
+            prompt_id = body['prompt_id']
+        return prompt_id
+
+    async def submit_many(self, prompts, concurrency=8):
+        """Submit prompts over up to `concurrency` parallel requests; ids come back in order"""
+        limit = asyncio.Semaphore(concurrency)
+
+        async def submit(prompt):
+            async with limit:
+                return await self.submit(prompt)
+        return await asyncio.gather(*(submit(prompt) for prompt in prompts))
+
+    async def register(self, workflow):
+        """Store workflow as a proxy template; returns its hash, or None on plain ComfyUI"""
+        async with self.session.put(f"{self.url}/aircomfy/templates", json=workflow) as resp:
+            if resp.status in (404, 405):
+                self.proxied = False
+                return None
+            body = await resp.json(content_type=None)
+            if resp.status >= 400:
+                raise ComfyError(self._error_message(body, resp.status), resp.status, body.get('node_errors'))
+        self.proxied = True
+        return body['hash']
+
+    async def result(self, prompt_id, timeout=None):
+        """Node outputs of a finished prompt, waiting for it to finish if needed"""
+        pending = self._pending.get(prompt_id)
+        if pending is None:
+            # Not submitted by this client (or already collected): ask the history
+            pending = self._pending[prompt_id] = PendingPrompt()
+            await self._check_history([prompt_id])
+        if not pending.future.done() and self._listener is not None and self._listener.done():
+            # No more events will arrive for it
+            self._pending.pop(prompt_id, None)
+            self._listener.result()
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.future), timeout)
+        finally:
+            if pending.future.done():
+                self._pending.pop(prompt_id, None)
+
+    async def download(self, item, destination=None, chunk_size=64 * 1024):
+        """
+        Stream an output file to a path or writable binary buffer; returns
+        the bytes when no destination is given.
+        """
+        params = {'filename': item['filename'], 'subfolder': item.get('subfolder', ''),
+                  'type': item.get('type', 'output')}
+        async with self.session.get(f"{self.url}/view", params=params) as resp:
+            if resp.status != 200:
+                raise ComfyError(f"Could not fetch {item['filename']}: HTTP {resp.status}", resp.status)
+            if destination is None:
+                return await resp.read()
+            if isinstance(destination, (str, os.PathLike)):
+                with open(destination, 'wb') as f:
+                    async for chunk in resp.content.iter_chunked(chunk_size):
+                        f.write(chunk)
+            else:
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    destination.write(chunk)
+        return destination
+
+    async def queue_status(self, prompt_ids):
+        """Which of prompt_ids are still queued or running on the server"""
+        async with self.session.get(f"{self.url}/queue") as resp:
+            queue = await resp.json(content_type=None)
+        queued = {item[1] for key in ('queue_running', 'queue_pending') for item in queue.get(key, [])}
+        if self.proxied:
+            # Prompts still held by the proxy are not in any backend's queue yet
+            async with self.session.get(f"{self.url}/aircomfy/queue", params={'clientId': self.client_id}) as resp:
+                held = await resp.json(content_type=None)
+            queued.update(job['prompt_id'] for job in held.get('jobs', []))
+        return {prompt_id for prompt_id in prompt_ids if prompt_id in queued}
+
+    async def _request(self, method, url, payload):
+        async with self.session.request(method, url, json=payload) as resp:
+            body = await resp.json(content_type=None)
+            if self.proxied is None:
+                self.proxied = 'Server-Timing' in resp.headers
+            if resp.status != 200:
+                raise ComfyError(self._error_message(body, resp.status), resp.status,
+                                 body.get('node_errors') if isinstance(body, dict) else None)
+        return body
+
+    @staticmethod
+    def _error_message(body, status):
+        error = body.get('error') if isinstance(body, dict) else None
+        if isinstance(error, dict):
+            return error.get('message', str(error))
+        return str(error or f"HTTP {status}")
+
+    async def _listen(self):
+        """Keep the shared WebSocket open, resolving prompts as their events arrive"""
+        ws_url = self.url.replace('http', 'ws', 1) + f"/ws?clientId={self.client_id}&resume=1"
+        while True:
+            url = ws_url if self._last_seq is None else f"{ws_url}&lastSeq={self._last_seq}"
+            try:
+                async with self.session.ws_connect(url, heartbeat=30) as ws:
+                    reconnected = self._connected.is_set()
+                    self._connected.set()
+                    if reconnected and self._last_seq is None:
+                        # No replay from plain ComfyUI; anything may have finished meanwhile
+                        asyncio.ensure_future(self._check_history(list(self._pending)))
+                    async for msg in ws:
+                        if msg.type == WSMsgType.TEXT:
+                            try:
+                                message = json.loads(msg.data)
+                            except ValueError:
+                                logger.debug(f"Skipping a non-JSON frame from {self.url}")
+                                continue
+                            if isinstance(message, dict):
+                                self._handle(message)
+                        elif msg.type == WSMsgType.ERROR:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except aiohttp.ClientError as e:
+                logger.warning(f"WebSocket to {self.url} failed: {e}")
+                if not self._connected.is_set():
+                    # Fail open() rather than hang; results then come from /history
+                    self._connected.set()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _listener_stopped(self, task):
+        """Fail the prompts waiting for events when the listener dies of an error"""
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error(f"WebSocket listener for {self.url} stopped: {task.exception()!r}")
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(task.exception())
+
+    def _handle(self, message):
+        if 'seq' in message:
+            self._last_seq = message['seq']
+        kind = message.get('type')
+        data = message.get('data') or {}
+        if kind == 'aircomfy_resume':
+            if data.get('missed'):
+                asyncio.ensure_future(self._check_history(list(self._pending)))
+            return
+        pending = self._pending.get(data.get('prompt_id'))
+        if pending is None or pending.future.done():
+            return
+        if kind == 'executed':
+            pending.outputs[data.get('node')] = data.get('output') or {}
+        elif kind == 'executing' and data.get('node') is None:
+            pending.future.set_result(pending.outputs)
+        elif kind == 'execution_success':
+            pending.future.set_result(pending.outputs)
+        elif kind == 'execution_error':
+            pending.future.set_exception(PromptFailed(
+                f"{data.get('node_type')} ({data.get('node_id')}): {data.get('exception_message')}",
+                node_errors=data.get('node_errors')))
+        elif kind == 'execution_interrupted':
+            pending.future.set_exception(PromptFailed('Interrupted'))
+
+    async def _check_history(self, prompt_ids):
+        """Resolve prompts that finished while no events could reach us"""
+        prompt_ids = [p for p in prompt_ids if p in self._pending and not self._pending[p].future.done()]
+        if not prompt_ids:
+            return
+        try:
+            history = await self.history(prompt_ids)
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.warning(f"History lookup failed: {e}")
+            return
+        for prompt_id, entry in history.items():
+            pending = self._pending.get(prompt_id)
+            if pending is None or pending.future.done():
+                continue
+            status = entry.get('status') or {}
+            if status.get('status_str') == 'error':
+                pending.future.set_exception(PromptFailed(f"Prompt {prompt_id} failed"))
+            else:
+                pending.future.set_result(entry.get('outputs') or {})
+
+    async def history(self, prompt_ids):
+        """History entries for prompt_ids, in one request when the proxy is present"""
+        if self.proxied is not False and len(prompt_ids) > 1:
+            async with self.session.post(f"{self.url}/aircomfy/history/bulk",
+                                         json={'prompt_ids': prompt_ids}) as resp:
+                if resp.status == 200:
+                    return await resp.json(content_type=None)
+        history = {}
+        for prompt_id in prompt_ids:
+            async with self.session.get(f"{self.url}/history/{prompt_id}") as resp:
+                history.update(await resp.json(content_type=None))
+        return history
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Overload benchmark for proxy.py against a fake ComfyUI, each in its own process.
+Usage: python bench_proxy.py [--requests 2000] [--capacity 8] [--service-ms 20] [--max-p99-ms 1000]
+
+Floods a slow API route with more concurrent requests than the backend can
+serve, with and without admission limits, while a client keeps fetching
+/view. Reports admitted/shed counts and, for admitted requests, the
+latency the proxy measured from admission (its Server-Timing total) apart
+from what the client saw after sending and while connecting. Exits
+non-zero when the limited run's admitted p99 is over --max-p99-ms.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import re
+import socket
+import sys
+import time
+
+from aiohttp import web, ClientSession, TCPConnector, TraceConfig
+
+from proxy import create_app
+
+
+def fake_comfyui(capacity, service_time):
+    """Backend that serves `capacity` requests at a time, each taking service_time"""
+    app = web.Application()
+    slots = asyncio.Semaphore(capacity)
+
+    async def slow(request):
+        async with slots:
+            await asyncio.sleep(service_time)
+        return web.json_response([])
+
+    async def view(request):
+        return web.Response(body=b'\x89PNG' + b'x' * 4096, content_type='image/png')
+
+    async def system_stats(request):
+        return web.json_response({'system': {}, 'devices': []})
+
+    async def ws(request):
+        sock = web.WebSocketResponse()
+        await sock.prepare(request)
+        await sock.send_json({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': 0}}}})
+        async for _ in sock:
+            pass
+        return sock
+
+    app.router.add_get('/embeddings', slow)
+    app.router.add_get('/view', view)
+    app.router.add_get('/system_stats', system_stats)
+    app.router.add_get('/ws', ws)
+    return app
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve_forever(make_app, port, *args, **kwargs):
+    logging.basicConfig(level=logging.WARNING, force=True)
+    web.run_app(make_app(*args, **kwargs), host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def start(make_app, *args, **kwargs):
+    """Serve an app in its own process, so it does not share the load generator's event loop"""
+    port = free_port()
+    process = multiprocessing.Process(target=serve_forever, args=(make_app, port, *args), kwargs=kwargs,
+                                      daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port}"
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def connect_timing():
+    """Trace config noting when each request got its connection and was sent, in its trace_request_ctx"""
+    trace = TraceConfig()
+
+    async def connecting(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['connect_started'] = time.perf_counter()
+
+    async def connected(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['connect'] = time.perf_counter() - ctx.trace_request_ctx['connect_started']
+
+    async def sent(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['sent'] = time.perf_counter()
+
+    trace.on_connection_create_start.append(connecting)
+    trace.on_connection_create_end.append(connected)
+    trace.on_request_headers_sent.append(sent)
+    return trace
+
+
+async def flood(session, url, requests):
+    """
+    For admitted requests, the proxy's latency from admission and the
+    client's from sending; connect times of all requests; the shed count.
+    """
+    admitted, sent, connects, shed = [], [], [], 0
+
+    async def one():
+        nonlocal shed
+        timing = {}
+        async with session.get(f"{url}/embeddings", trace_request_ctx=timing) as resp:
+            await resp.read()
+            if resp.status == 503:
+                shed += 1
+            else:
+                sent.append(time.perf_counter() - timing['sent'])
+                total = re.search(r'total;dur=([\d.]+)', resp.headers.get('Server-Timing', ''))
+                admitted.append(float(total.group(1)) / 1000 if total else sent[-1])
+        if 'connect' in timing:
+            connects.append(timing['connect'])
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return admitted, sent, connects, shed
+
+
+async def watch_results(session, url, stop):
+    """A client that has just seen `executed` and fetches its image"""
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        async with session.get(f"{url}/view", params={'filename': 'a.png', 'type': 'output'}) as resp:
+            await resp.read()
+            assert resp.status == 200, resp.status
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+    return latencies
+
+
+async def run(label, backend_url, requests, **proxy_options):
+    proxy, proxy_url = start(create_app, backend_url, prefetch_bytes=0, **proxy_options)
+    await asyncio.sleep(1.0)  # start-up and first health probe
+    async with ClientSession(connector=TCPConnector(limit=0), trace_configs=[connect_timing()]) as session:
+        stop = asyncio.Event()
+        watcher = asyncio.ensure_future(watch_results(session, proxy_url, stop))
+        started = time.perf_counter()
+        admitted, sent, connects, shed = await flood(session, proxy_url, requests)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        views = await watcher
+    proxy.terminate()
+    proxy.join()
+
+    ms = lambda seconds: f"{seconds * 1000:7.1f}"
+    print(f"{label:<10} admitted {len(admitted):5d}  shed {shed:5d}  "
+          f"p50 {ms(percentile(admitted, 0.5))}ms  p99 {ms(percentile(admitted, 0.99))}ms  "
+          f"max {ms(max(admitted, default=0))}ms  client p99 {ms(percentile(sent, 0.99))}ms  "
+          f"connect p99 {ms(percentile(connects, 0.99))}ms  /view p99 {ms(percentile(views, 0.99))}ms  "
+          f"({elapsed:.1f}s)")
+    return percentile(admitted, 0.99)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='proxy.py overload benchmark')
+    parser.add_argument('--requests', type=int, default=2000, help='Concurrent requests in the burst')
+    parser.add_argument('--capacity', type=int, default=8, help='Requests the fake backend serves at once')
+    parser.add_argument('--service-ms', type=float, default=20, help='Backend time per request')
+    parser.add_argument('--limit', type=int,
+                        help='api in-flight limit for the limited run (default: the backend capacity)')
+    parser.add_argument('--max-p99-ms', type=float, default=1000,
+                        help='Fail when the limited run\'s admitted p99 is over this (default: 1000)')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    backend, backend_url = start(fake_comfyui, args.capacity, args.service_ms / 1000)
+    await run('unlimited', backend_url, args.requests,
+              request_limits={'api': 10 ** 9}, shed_lag=0)
+    p99 = await run('limited', backend_url, args.requests,
+                    request_limits={'api': args.limit or args.capacity})
+    backend.terminate()
+    if not p99 <= args.max_p99_ms / 1000:
+        print(f"FAIL: admitted p99 {p99 * 1000:.1f}ms is over {args.max_p99_ms:g}ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+"""
+Build the AirComfy PWA into a self-contained bundle.
+Usage: python build_pwa.py [--out PWA/dist] [--petite-vue FILE] [--fetch-petite-vue]
+
+Bundles the vendored petite-vue, minifies the scripts and the stylesheet, stores them under
+assets/ with their content hash in the name, inlines the CSS the first view
+needs and rewrites the service worker's precache list from the result. Serve
+it with `python proxy.py --static-dir PWA/dist`, or deploy the generated
+dist/worker.js, which embeds the bundle.
+"""
+
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import urllib.request
+from html.parser import HTMLParser
+
+try:
+    import brotli
+except ImportError:  # The worker then serves gzip only
+    brotli = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PWA_DIR = os.path.join(REPO_DIR, 'PWA')
+
+PETITE_VUE_VERSION = '0.4.1'
+PETITE_VUE_URL = f"https://unpkg.com/petite-vue@{PETITE_VUE_VERSION}/dist/petite-vue.iife.js"
+PETITE_VUE_FILE = os.path.join(PWA_DIR, 'vendor', f"petite-vue-{PETITE_VUE_VERSION}.iife.js")
+# sha256 of the file at PETITE_VUE_URL. Not recorded yet: `--fetch-petite-vue`
+# downloads it into PWA/vendor/ and prints the digest; check it, set it here and
+# commit both. Until then nothing is downloaded without being asked for.
+PETITE_VUE_SHA256 = ''
+
+# Started by the app script with `new Worker('<name>')`
+WORKER_SCRIPTS = ['workflow-worker.js', 'preview-worker.js']
+# Copied under their own names; the manifest and its icon are looked up by URL
+PLAIN_FILES = ['manifest.json', 'icon-192.png']
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.json': 'application/json',
+    '.png': 'image/png',
+}
+# Already compressed formats are stored as-is
+PRECOMPRESSED_TYPES = {'.png'}
+
+
+class BuildError(Exception):
+    pass
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.sha256(content).hexdigest()[:10]
+
+
+def hashed_name(name, content):
+    stem, ext = os.path.splitext(name)
+    return f"assets/{stem}.{content_hash(content)}{ext}"
+
+
+# Words after which `/` starts a regular expression rather than a division
+REGEX_KEYWORDS = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+                  'throw', 'case', 'do', 'else', 'yield', 'await'}
+REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+
+
+def is_word_char(char):
+    return char.isalnum() or char in '_$' or ord(char) > 127
+
+
+def minify_js(source):
+    """
+    Drop comments, indentation, blank lines and spaces between punctuation.
+    Strings, template literals and regular expressions are copied verbatim, and
+    line breaks are kept so automatic semicolon insertion works as before.
+    """
+    out = []
+    i, n = 0, len(source)
+    prev = ''           # last token, to tell a regex from a division
+    depth = 0           # open braces
+    templates = []      # brace depth at which each open `${` returns to its template
+    space = newline = False
+
+    def emit(text):
+        nonlocal space, newline
+        if out:
+            last = out[-1][-1]
+            if newline:
+                out.append('\n')
+            elif space and (is_word_char(last) and is_word_char(text[0])
+                            or last in '+-' and text[0] == last):
+                out.append(' ')
+        space = newline = False
+        out.append(text)
+
+    def quoted(start, quote):
+        j = start + 1
+        while j < n and source[j] != quote:
+            if source[j] == '\\':
+                j += 1
+            elif source[j] == '\n':
+                raise BuildError(f"Unterminated string at offset {start}")
+            j += 1
+        return j + 1
+
+    def template(start):
+        """Copy template text from `start`; returns the end and whether `${` opened"""
+        j = start
+        while j < n:
+            if source[j] == '\\':
+                j += 2
+            elif source[j] == '`':
+                return j + 1, False
+            elif source.startswith('${', j):
+                return j + 2, True
+            else:
+                j += 1
+        raise BuildError(f"Unterminated template literal at offset {start}")
+
+    def resume_template(start):
+        nonlocal i, prev
+        end, opened = template(start)
+        out.append(source[start:end])
+        if opened:
+            templates.append(depth)
+            prev = '{'
+        else:
+            prev = 'a'
+        i = end
+
+    while i < n:
+        char = source[i]
+        if char in ' \t\r':
+            space = True
+            i += 1
+        elif char == '\n':
+            newline = True
+            i += 1
+        elif source.startswith('//', i):
+            while i < n and source[i] != '\n':
+                i += 1
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            if end < 0:
+                raise BuildError(f"Unterminated comment at offset {i}")
+            newline = newline or '\n' in source[i:end]
+            space = True
+            i = end + 2
+        elif char in '\'"':
+            end = quoted(i, char)
+            emit(source[i:end])
+            prev = 'a'
+            i = end
+        elif char == '`':
+            emit('`')
+            resume_template(i + 1)
+        elif char == '/' and (not prev or prev in REGEX_AFTER or prev in REGEX_KEYWORDS):
+            j, in_class = i + 1, False
+            while j < n and (in_class or source[j] != '/'):
+                if source[j] == '\\':
+                    j += 1
+                elif source[j] == '[':
+                    in_class = True
+                elif source[j] == ']':
+                    in_class = False
+                elif source[j] == '\n':
+                    raise BuildError(f"Unterminated regular expression at offset {i}")
+                j += 1
+            emit(source[i:j + 1])
+            prev = 'a'
+            i = j + 1
+        elif is_word_char(char):
+            j = i
+            while j < n and is_word_char(source[j]):
+                j += 1
+            word = source[i:j]
+            emit(word)
+            prev = word
+            i = j
+        elif char == '}' and templates and templates[-1] == depth:
+            templates.pop()
+            out.append('}')
+            resume_template(i + 1)
+        else:
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+            emit(char)
+            prev = char
+            i += 1
+    return ''.join(out) + '\n'
+
+
+CSS_TOKEN = re.compile(r'/\*.*?\*/|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'', re.S)
+
+
+def minify_css(source):
+    """Drop comments and the whitespace around braces, semicolons, commas and colons"""
+    parts = []
+    pos = 0
+    for match in CSS_TOKEN.finditer(source):
+        parts.append(squeeze_css(source[pos:match.start()]))
+        if not match.group().startswith('/*'):
+            parts.append(match.group())
+        pos = match.end()
+    parts.append(squeeze_css(source[pos:]))
+    return ''.join(parts).replace(';}', '}').strip()
+
+
+def squeeze_css(text):
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return re.sub(r':\s+', ':', text)
+
+
+def css_rules(css):
+    """Top-level (prelude, body) pairs of minified CSS"""
+    rules = []
+    pos = 0
+    while pos < len(css):
+        start = css.find('{', pos)
+        if start < 0:
+            break
+        level, j = 1, start + 1
+        while level:
+            if css[j] in '"\'':
+                j = CSS_TOKEN.match(css, j).end()
+                continue
+            level += {'{': 1, '}': -1}.get(css[j], 0)
+            j += 1
+        rules.append((css[pos:start].strip(), css[start + 1:j - 1]))
+        pos = j
+    return rules
+
+
+def split_selectors(prelude):
+    """Split a selector list on top-level commas"""
+    selectors, level, start = [], 0, 0
+    for j, char in enumerate(prelude):
+        level += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and level == 0:
+            selectors.append(prelude[start:j])
+            start = j + 1
+    selectors.append(prelude[start:])
+    return selectors
+
+
+def selector_matches(selector, markup):
+    """Whether every tag, class and id the selector names appears in the markup"""
+    selector = re.sub(r'"[^"]*"|\'[^\']*\'|\[[^\]]*\]', '', selector)
+    selector = re.sub(r'::?[\w-]+(\((?:[^()]|\([^()]*\))*\))?', '', selector)
+    for compound in re.split(r'[\s>+~]+', selector.strip()):
+        tag = re.match(r'[a-zA-Z][\w-]*', compound)
+        if tag and tag.group().lower() not in markup.tags:
+            return False
+        if not set(re.findall(r'\.([\w-]+)', compound)) <= markup.classes:
+            return False
+        if not set(re.findall(r'#([\w-]+)', compound)) <= markup.ids:
+            return False
+    return True
+
+
+def critical_css(css, markup):
+    """The rules that can apply to the first view; @keyframes and the like wait for the stylesheet"""
+    kept = []
+    for prelude, body in css_rules(css):
+        if prelude.startswith('@media'):
+            inner = critical_css(body, markup)
+            if inner:
+                kept.append(f"{prelude}{{{inner}}}")
+        elif not prelude.startswith('@'):
+            if any(selector_matches(selector, markup) for selector in split_selectors(prelude)):
+                kept.append(f"{prelude}{{{body}}}")
+    return ''.join(kept)
+
+
+class FirstViewMarkup(HTMLParser):
+    """Tags, classes and ids in index.html outside views other than the main one"""
+
+    VOID = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+    def __init__(self):
+        super().__init__()
+        self.tags = set()
+        self.classes = set()
+        self.ids = set()
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.skipping:
+            if tag not in self.VOID:
+                self.skipping += 1
+            return
+        view = re.search(r"currentView === '(\w+)'", attrs.get('v-if') or '')
+        if view and view.group(1) != 'main':
+            if tag not in self.VOID:
+                self.skipping = 1
+            return
+        self.tags.add(tag)
+        self.classes.update((attrs.get('class') or '').split())
+        if attrs.get('id'):
+            self.ids.add(attrs['id'])
+
+    def handle_endtag(self, tag):
+        if self.skipping and tag not in self.VOID:
+            self.skipping -= 1
+
+
+def replace_once(text, old, new, what):
+    if isinstance(old, re.Pattern):
+        result, count = old.subn(lambda match: new, text)
+    else:
+        count = text.count(old)
+        result = text.replace(old, new)
+    if count != 1:
+        raise BuildError(f"Expected one {what}, found {count}")
+    return result
+
+
+def read_text(name):
+    with open(os.path.join(PWA_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def check_petite_vue(content, source):
+    """Fail the build unless content is the petite-vue build pinned by PETITE_VUE_SHA256"""
+    digest = hashlib.sha256(content).hexdigest()
+    if digest != PETITE_VUE_SHA256:
+        raise BuildError(f"{source} has sha256 {digest}, expected {PETITE_VUE_SHA256} "
+                         f"for petite-vue {PETITE_VUE_VERSION}")
+
+
+def fetch_petite_vue():
+    """
+    Download petite-vue into PWA/vendor/ and return its sha256. With a pin the
+    download must match it; without one, the digest is for the caller to check
+    and record.
+    """
+    print(f"Downloading {PETITE_VUE_URL}")
+    try:
+        with urllib.request.urlopen(PETITE_VUE_URL, timeout=30) as resp:
+            content = resp.read()
+    except OSError as e:
+        raise BuildError(f"Could not download petite-vue ({e}); pass --petite-vue FILE") from e
+    # Nothing that fails the pin is kept for later builds
+    if PETITE_VUE_SHA256:
+        check_petite_vue(content, PETITE_VUE_URL)
+    os.makedirs(os.path.dirname(PETITE_VUE_FILE), exist_ok=True)
+    with open(PETITE_VUE_FILE, 'wb') as f:
+        f.write(content)
+    return hashlib.sha256(content).hexdigest()
+
+
+def petite_vue_source(path=None):
+    """
+    petite-vue to bundle. A file given with --petite-vue is used as it is;
+    otherwise the copy vendored in PWA/vendor/, checked against
+    PETITE_VUE_SHA256 once that is recorded, and downloaded if missing only
+    when it can be checked. None when there is nothing to bundle: the built
+    page then loads petite-vue from unpkg, as the unbuilt one does.
+    """
+    if path is not None:
+        if not os.path.exists(path):
+            raise BuildError(f"{path} does not exist")
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    if not os.path.exists(PETITE_VUE_FILE):
+        if not PETITE_VUE_SHA256:
+            return None
+        fetch_petite_vue()
+    with open(PETITE_VUE_FILE, 'rb') as f:
+        content = f.read()
+    if PETITE_VUE_SHA256:
+        check_petite_vue(content, os.path.relpath(PETITE_VUE_FILE))
+    return content.decode('utf-8')
+
+
+def check_out_dir(out_dir):
+    """Refuse to build over the sources: out_dir may not be or contain PWA/ or the repository"""
+    out = os.path.realpath(out_dir)
+    for source in (PWA_DIR, REPO_DIR):
+        source = os.path.realpath(source)
+        if os.path.commonpath([out, source]) == out:
+            raise BuildError(f"Refusing to build into {out_dir}: it would overwrite {source}")
+
+
+def remove_previous_build(out_dir):
+    """Delete the files listed by the last build's asset-manifest.json; nothing else in out_dir"""
+    manifest_path = os.path.join(out_dir, 'asset-manifest.json')
+    try:
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        return
+    out = os.path.realpath(out_dir)
+    for path in previous.get('files', {}).values():
+        target = os.path.realpath(os.path.join(out, path))
+        # A hand-edited manifest cannot point outside the bundle
+        if os.path.commonpath([out, target]) == out and os.path.isfile(target):
+            os.remove(target)
+    os.remove(manifest_path)
+    assets = os.path.join(out, 'assets')
+    if os.path.isdir(assets) and not os.listdir(assets):
+        os.rmdir(assets)
+
+
+def build(out_dir, petite_vue=None):
+    """Write the bundle to out_dir and return its manifest"""
+    check_out_dir(out_dir)
+    files = {}      # source name -> built path
+    contents = {}   # built path -> bytes or str
+
+    def add(name, content, hashed=True):
+        path = hashed_name(name, content) if hashed else name
+        files[name] = path
+        contents[path] = content
+        return path
+
+    # Vendored petite-vue is already minified
+    vendored = petite_vue_source(petite_vue)
+    if vendored is not None:
+        add('petite-vue.js', vendored)
+    add('editor.js', minify_js(read_text('editor.js')))
+    for name in WORKER_SCRIPTS:
+        add(name, minify_js(read_text(name)))
+
+    html = read_text('index.html')
+    script = re.search(r'<script>(.*)</script>', html, re.S)
+    if not script:
+        raise BuildError('No inline app script in index.html')
+    app = script.group(1)
+    for name in WORKER_SCRIPTS:
+        app = replace_once(app, f"'{name}'", f"'{files[name]}'", f"reference to {name}")
+    add('app.js', minify_js(app))
+
+    markup = FirstViewMarkup()
+    markup.feed(html)
+    css = minify_css(read_text('style.css'))
+    style = add('style.css', css + '\n')
+
+    html = replace_once(html, script.group(0), f'<script src="{files["app.js"]}" defer></script>',
+                        'inline app script')
+    if vendored is not None:
+        html = replace_once(html, re.compile(r'<script src="https://unpkg\.com/petite-vue@[^"]+"></script>'),
+                            f'<script src="{files["petite-vue.js"]}" defer></script>', 'petite-vue script tag')
+    html = replace_once(html, '<script src="editor.js"></script>',
+                        f'<script src="{files["editor.js"]}" defer></script>', 'editor.js script tag')
+    # The full stylesheet loads without blocking the first paint
+    html = replace_once(html, '<link rel="stylesheet" href="style.css">',
+                        f'<style>{critical_css(css, markup)}</style>\n'
+                        f'    <link rel="preload" href="{style}" as="style" onload="this.onload=null;this.rel=\'stylesheet\'">\n'
+                        f'    <noscript><link rel="stylesheet" href="{style}"></noscript>',
+                        'style.css link')
+    add('index.html', html, hashed=False)
+
+    for name in PLAIN_FILES:
+        with open(os.path.join(PWA_DIR, name), 'rb') as f:
+            add(name, f.read(), hashed=False)
+
+    precache = ['./'] + [f"./{path}" for path in sorted(contents)]
+    sw = read_text('sw.js')
+    sw = replace_once(sw, re.compile(r"^const CACHE_NAME = '[^']*';", re.M),
+                      f"const CACHE_NAME = 'aircomfy-{content_hash(json.dumps(files, sort_keys=True))}';",
+                      'CACHE_NAME in sw.js')
+    sw = replace_once(sw, re.compile(r'^const CACHE_URLS = \[.*?\];', re.M | re.S),
+                      f"const CACHE_URLS = {json.dumps(precache)};", 'CACHE_URLS in sw.js')
+    add('sw.js', minify_js(sw), hashed=False)
+
+    manifest = {'files': files, 'precache': precache}
+    add('worker.js', worker_script(contents), hashed=False)
+
+    remove_previous_build(out_dir)
+    for path, content in contents.items():
+        target = os.path.join(out_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        mode = 'w' if isinstance(content, str) else 'wb'
+        with open(target, mode, **({'encoding': 'utf-8'} if mode == 'w' else {})) as f:
+            f.write(content)
+    with open(os.path.join(out_dir, 'asset-manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def worker_file(path, content):
+    """Worker table entry: type, strong ETag and base64 bodies, compressed where that pays off"""
+    if isinstance(content, str):
+        content = content.encode()
+    ext = os.path.splitext(path)[1]
+    entry = {'type': CONTENT_TYPES[ext], 'etag': f'"{hashlib.sha256(content).hexdigest()[:16]}"'}
+    if ext in PRECOMPRESSED_TYPES:
+        entry['identity'] = base64.b64encode(content).decode()
+        return entry
+    # gzip always exists; the worker inflates it for clients that accept neither
+    entry['gzip'] = base64.b64encode(gzip.compress(content, 9, mtime=0)).decode()
+    if brotli is not None:
+        compressed = brotli.compress(content, quality=11)
+        if len(compressed) < len(content):
+            entry['br'] = base64.b64encode(compressed).decode()
+    return entry
+
+
+def worker_script(contents):
+    """PWA/worker.js with its static file table generated from the bundle"""
+    routes = {'/': 'index.html'}
+    table = {}
+    for path, content in sorted(contents.items()):
+        routes[f"/{path}"] = path
+        table[path] = worker_file(path, content)
+    worker = read_text('worker.js')
+    worker = replace_once(worker, re.compile(r'^const STATIC_FILES = \{.*?^\};\n', re.M | re.S),
+                          f"const STATIC_FILES = {json.dumps(routes, indent=2)};\n", 'STATIC_FILES in worker.js')
+    worker = replace_once(worker, re.compile(r'^const PWA_FILES = \{.*?^\};\n', re.M | re.S),
+                          f"const PWA_FILES = {json.dumps(table, indent=2)};\n", 'PWA_FILES in worker.js')
+    return worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the AirComfy PWA bundle')
+    parser.add_argument('--out', default=os.path.join(PWA_DIR, 'dist'),
+                        help='Output directory; the previous build\'s files in it are replaced (default: PWA/dist)')
+    parser.add_argument('--petite-vue',
+                        help=f"petite-vue IIFE build to bundle, used unchecked (default: "
+                             f"{os.path.relpath(PETITE_VUE_FILE)}, checked by sha256 once pinned)")
+    parser.add_argument('--fetch-petite-vue', action='store_true',
+                        help=f"Download petite-vue {PETITE_VUE_VERSION} into PWA/vendor/ and print its sha256 first")
+    args = parser.parse_args()
+
+    try:
+        if args.fetch_petite_vue:
+            digest = fetch_petite_vue()
+            print(f"{os.path.relpath(PETITE_VUE_FILE)}: sha256 {digest}")
+            if not PETITE_VUE_SHA256:
+                print("Check it against the published package, set PETITE_VUE_SHA256 and commit both")
+        manifest = build(args.out, args.petite_vue)
+    except BuildError as e:
+        parser.exit(1, f"build failed: {e}\n")
+    if 'petite-vue.js' not in manifest['files']:
+        print("petite-vue is not vendored; the page loads it from unpkg (see --fetch-petite-vue)")
+    for path in sorted(manifest['files'].values()):
+        size = os.path.getsize(os.path.join(args.out, path))
+        print(f"{path:<40} {size:>9,d} bytes")
+
+
+if __name__ == '__main__':
+    main()
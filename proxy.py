@@ -6,64 +6,2584 @@ Usage: python proxy.py [--port 8080] [--comfyui http://localhost:8188]
 
 import argparse
 import asyncio
+import base64
+import bisect
+import gc
+import hashlib
+import hmac
+import io
 import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, OrderedDict, deque
 import aiohttp
-from aiohttp import web, ClientSession
+from aiohttp import web, ClientSession, ClientTimeout
 from aiohttp.web_ws import WSMsgType
 import logging
+from logging.handlers import QueueListener, RotatingFileHandler
+from urllib.parse import urlencode
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails are optional; small outputs are then inlined as-is
+    Image = None
+
+try:
+    import resource
+except ImportError:  # Not on Windows; diagnostics then omit peak RSS
+    resource = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Input types ComfyUI renders as widgets; anything else must arrive through a link
+WIDGET_TYPES = {'INT', 'FLOAT', 'STRING', 'BOOLEAN', 'COMBO'}
+
+
+def is_link(value):
+    """True for a `[node_id, output_slot]` reference to another node"""
+    return (isinstance(value, list) and len(value) == 2
+            and isinstance(value[0], (str, int)) and isinstance(value[1], int)
+            and not isinstance(value[1], bool))
+
+
+def normalize_type(io_type):
+    # Combo inputs are declared as a list of choices (or "COMBO" in newer servers)
+    return 'COMBO' if isinstance(io_type, list) else io_type
+
+
+def types_compatible(output_type, input_type):
+    output_type = normalize_type(output_type)
+    input_type = normalize_type(input_type)
+    if output_type == input_type or '*' in (output_type, input_type):
+        return True
+    if not isinstance(output_type, str) or not isinstance(input_type, str):
+        return False
+    # "IMAGE,MASK" style unions: every type produced must be accepted
+    return set(output_type.split(',')) <= set(input_type.split(','))
+
+
+def node_error(error_type, message, details='', **extra_info):
+    return {'type': error_type, 'message': message,
+            'details': details, 'extra_info': extra_info}
+
+
+def find_cycles(prompt):
+    """Return the ids of nodes that take part in a dependency cycle"""
+    WHITE, GREY, BLACK = 0, 1, 2
+    color = dict.fromkeys(prompt, WHITE)
+    in_cycle = set()
+
+    for root in prompt:
+        if color[root] != WHITE:
+            continue
+        color[root] = GREY
+        path = [root]
+        stack = [iter(upstream_ids(prompt[root]))]
+        while stack:
+            upstream = next(stack[-1], None)
+            if upstream is None:
+                color[path.pop()] = BLACK
+                stack.pop()
+            elif color.get(upstream) == WHITE:
+                color[upstream] = GREY
+                path.append(upstream)
+                stack.append(iter(upstream_ids(prompt[upstream])))
+            elif color.get(upstream) == GREY:
+                in_cycle.update(path[path.index(upstream):])
+    return in_cycle
+
+
+def upstream_ids(node):
+    inputs = node.get('inputs') if isinstance(node, dict) else None
+    if not isinstance(inputs, dict):
+        return []
+    return [str(value[0]) for value in inputs.values() if is_link(value)]
+
+
+def validate_prompt(prompt, schemas):
+    """
+    Check an API-format prompt against ComfyUI's /object_info schemas.
+    Returns (error, node_errors) shaped like ComfyUI's own /prompt rejections;
+    error is None when the graph is valid.
+    """
+    if not isinstance(prompt, dict) or not prompt:
+        return node_error('invalid_prompt', 'Prompt must be a non-empty object of nodes'), {}
+
+    node_errors = {}
+
+    def add(node_id, class_type, error):
+        entry = node_errors.setdefault(node_id, {
+            'errors': [], 'dependent_outputs': [], 'class_type': class_type})
+        entry['errors'].append(error)
+
+    has_output = False
+    for node_id, node in prompt.items():
+        if not isinstance(node, dict) or not isinstance(node.get('inputs', {}), dict):
+            add(node_id, None, node_error('invalid_node', 'Node must be an object with an inputs object'))
+            continue
+
+        class_type = node.get('class_type')
+        schema = schemas.get(class_type) if isinstance(class_type, str) else None
+        if schema is None:
+            add(node_id, class_type, node_error(
+                'missing_node_type', f"Node type '{class_type}' is not available on the server",
+                str(class_type)))
+            continue
+        has_output = has_output or bool(schema.get('output_node'))
+
+        inputs = node.get('inputs', {})
+        declared = schema.get('input', {})
+        required = declared.get('required', {})
+        optional = declared.get('optional', {})
+
+        for name in required:
+            if name not in inputs:
+                add(node_id, class_type, node_error(
+                    'required_input_missing', 'Required input is missing', name, input_name=name))
+
+        for name, value in inputs.items():
+            spec = required.get(name) or optional.get(name)
+            input_type = spec[0] if isinstance(spec, list) and spec else None
+
+            if not is_link(value):
+                if input_type is not None and normalize_type(input_type) not in WIDGET_TYPES:
+                    add(node_id, class_type, node_error(
+                        'invalid_input_type', f'Input expects a {input_type} link, got a literal value',
+                        name, input_name=name))
+                continue
+
+            source_id, slot = str(value[0]), value[1]
+            source = prompt.get(source_id)
+            source_schema = schemas.get(source.get('class_type')) if isinstance(source, dict) else None
+            if source is None:
+                add(node_id, class_type, node_error(
+                    'dangling_link', f'Linked node {source_id} does not exist',
+                    name, input_name=name, linked_node=value))
+                continue
+            if source_schema is None:
+                # Reported on the source node itself
+                continue
+
+            outputs = source_schema.get('output', [])
+            if not 0 <= slot < len(outputs):
+                add(node_id, class_type, node_error(
+                    'dangling_link', f'Node {source_id} has no output slot {slot}',
+                    name, input_name=name, linked_node=value))
+            elif input_type is not None and not types_compatible(outputs[slot], input_type):
+                add(node_id, class_type, node_error(
+                    'return_type_mismatch',
+                    f'Output type {normalize_type(outputs[slot])} does not match input type {normalize_type(input_type)}',
+                    name, input_name=name, linked_node=value,
+                    received_type=normalize_type(outputs[slot]), input_config=spec))
+
+    for node_id in find_cycles(prompt):
+        add(node_id, prompt[node_id].get('class_type'), node_error(
+            'dependency_cycle', 'Node is part of a dependency cycle'))
+
+    if node_errors:
+        return node_error('prompt_outputs_failed_validation', 'Prompt outputs failed validation'), node_errors
+    if not has_output:
+        return node_error('prompt_no_outputs', 'Prompt has no outputs'), {}
+    return None, {}
+
+
+# Used to find output nodes when /object_info is not available
+OUTPUT_NODE_TYPES = {
+    'SaveImage', 'PreviewImage', 'SaveAnimatedWEBP', 'SaveAnimatedPNG',
+    'SaveLatent', 'SaveAudio', 'PreviewAudio', 'SaveVideo', 'SaveWEBM',
+}
+
+# The only node fields ComfyUI's executor reads; `_meta` and friends are UI-only
+EXECUTION_FIELDS = ('class_type', 'inputs')
+
+
+def is_output_node(node, schemas):
+    class_type = node.get('class_type')
+    if schemas is not None:
+        schema = schemas.get(class_type)
+        # Keep unknown nodes so validation can report them
+        return schema is None or bool(schema.get('output_node'))
+    return class_type in OUTPUT_NODE_TYPES
+
+
+def optimize_prompt(prompt, schemas=None):
+    """
+    Drop nodes no output node depends on and strip UI-only fields.
+    Returns (optimized_prompt, removed_node_ids); the prompt is returned
+    untouched when it is malformed or has no recognizable output node.
+    """
+    if not isinstance(prompt, dict) or not all(isinstance(n, dict) for n in prompt.values()):
+        return prompt, []
+
+    pending = [node_id for node_id, node in prompt.items() if is_output_node(node, schemas)]
+    if not pending:
+        return prompt, []
+
+    reachable = set(pending)
+    while pending:
+        for upstream in upstream_ids(prompt[pending.pop()]):
+            if upstream in prompt and upstream not in reachable:
+                reachable.add(upstream)
+                pending.append(upstream)
+
+    optimized = {
+        node_id: {field: node[field] for field in EXECUTION_FIELDS if field in node}
+        for node_id, node in prompt.items() if node_id in reachable
+    }
+    removed = [node_id for node_id in prompt if node_id not in reachable]
+    return optimized, removed
+
+
+def apply_overrides(template, overrides):
+    """
+    The template graph with {node_id: {input: value}} overrides applied.
+    Untouched nodes are shared with the template, not copied. Returns
+    (prompt, node_errors) with node_errors shaped like validate_prompt's.
+    """
+    if not isinstance(overrides, dict):
+        return None, {'': {'errors': [node_error('invalid_prompt', 'overrides must be an object')],
+                           'dependent_outputs': [], 'class_type': None}}
+    prompt = dict(template)
+    node_errors = {}
+    for node_id, inputs in overrides.items():
+        node = template.get(node_id)
+        if node is None or not isinstance(inputs, dict):
+            node_errors[node_id] = {
+                'errors': [node_error('invalid_override', 'Override must map inputs of a node in the template',
+                                      str(node_id))],
+                'dependent_outputs': [], 'class_type': node.get('class_type') if node else None}
+            continue
+        prompt[node_id] = {**node, 'inputs': {**node.get('inputs', {}), **inputs}}
+    return prompt, node_errors
+
+
+def graph_shape(prompt):
+    """
+    What a prompt's run time mostly depends on: its node types plus total
+    sampling steps, latent size and batch size. Seeds and texts are ignored.
+    """
+    classes = {}
+    steps = width = height = 0
+    batch = 1
+    for node in prompt.values():
+        if not isinstance(node, dict):
+            continue
+        class_type = node.get('class_type')
+        classes[class_type] = classes.get(class_type, 0) + 1
+        inputs = node.get('inputs') or {}
+        if isinstance(inputs.get('steps'), int):
+            steps += inputs['steps']
+        if isinstance(inputs.get('width'), int) and isinstance(inputs.get('height'), int):
+            width, height = max(width, inputs['width']), max(height, inputs['height'])
+        if isinstance(inputs.get('batch_size'), int):
+            batch = max(batch, inputs['batch_size'])
+    return tuple(sorted(classes.items(), key=str)), steps, width, height, batch
+
+
+class NodeSchemaCache:
+    """Keeps a copy of ComfyUI's /object_info so prompts can be checked locally"""
+
+    def __init__(self, backends, ttl=300):
+        self.backends = backends
+        self.ttl = ttl
+        self.schemas = None
+        self.fetched_at = 0.0
+        self._refresh_task = None
+
+    @property
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    async def get(self):
+        # Only the very first request waits; stale schemas refresh in the background
+        if self.schemas is None:
+            await self.refresh()
+        elif self.age > self.ttl:
+            self.refresh_soon()
+        return self.schemas
+
+    def refresh_soon(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self.refresh())
+        return self._refresh_task
+
+    async def refresh(self):
+        backend = next((b for b in self.backends if b.available), None)
+        if backend is None:
+            return self.schemas
+        try:
+            async with ClientSession(timeout=ClientTimeout(total=10)) as session:
+                async with session.get(f"{backend.url}/object_info") as resp:
+                    if resp.status == 200:
+                        self.schemas = await resp.json()
+                        self.fetched_at = time.monotonic()
+                        logger.info(f"Cached {len(self.schemas)} node schemas")
+                    else:
+                        logger.warning(f"Node schema fetch returned {resp.status}")
+        except Exception as e:
+            logger.warning(f"Could not fetch node schemas: {e}")
+        return self.schemas
+
+
+class LRUDict(OrderedDict):
+    """Dict that forgets its least recently written entries beyond max_items"""
+
+    def __init__(self, max_items=10000):
+        super().__init__()
+        self.max_items = max_items
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_items:
+            self.popitem(last=False)
+
+
+class CachedResponse:
+    __slots__ = ('body', 'content_type', 'headers', 'stored_at', 'prefetched', 'used')
+
+    def __init__(self, body, content_type, headers=None, prefetched=False):
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.stored_at = time.monotonic()
+        self.prefetched = prefetched
+        self.used = False
+
+
+class OutputCache:
+    """
+    Byte-bounded LRU of /view and /history responses, filled ahead of the
+    client's own requests when ComfyUI reports that a node has finished.
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, ttl=300, concurrency=4):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        # Fetches in progress, so a request arriving mid-prefetch waits for it
+        self.pending = {}
+        self.limit = asyncio.Semaphore(concurrency)
+        self.stats = {'lookups': 0, 'hits': 0, 'waited': 0, 'prefetched': 0,
+                      'prefetched_bytes': 0, 'prefetch_failed': 0, 'evicted_unused': 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def put(self, key, entry):
+        # One file may not crowd out everything else
+        if len(entry.body) > self.max_bytes // 4:
+            return
+        self.discard(key)
+        self.entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+            if entry.prefetched and not entry.used:
+                self.stats['evicted_unused'] += 1
+
+    async def get(self, key):
+        self.stats['lookups'] += 1
+        if key in self.pending:
+            self.stats['waited'] += 1
+            await asyncio.shield(self.pending[key])
+        entry = self.peek(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        entry.used = True
+        self.stats['hits'] += 1
+        return entry
+
+    def peek(self, key):
+        """Fresh entry for key or None, without waiting or counting as a client lookup"""
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry.stored_at > self.ttl:
+            self.discard(key)
+            return None
+        return entry
+
+    def prefetch(self, key, load):
+        """Run `load()` (returning a CachedResponse or None) in the background unless key is cached"""
+        if not self.enabled or key in self.entries or key in self.pending:
+            return
+        self.pending[key] = asyncio.ensure_future(self._prefetch(key, load))
+
+    async def _prefetch(self, key, load):
+        try:
+            async with self.limit:
+                entry = await load()
+            if entry is not None:
+                entry.prefetched = True
+                self.put(key, entry)
+                self.stats['prefetched'] += 1
+                self.stats['prefetched_bytes'] += len(entry.body)
+        except Exception as e:
+            self.stats['prefetch_failed'] += 1
+            logger.debug(f"Prefetch of {key} failed: {e}")
+        finally:
+            del self.pending[key]
+
+    async def fetch(self, key, load):
+        """Cached entry for key, loading it now if needed; does not count as a client lookup"""
+        self.prefetch(key, load)
+        if key in self.pending:
+            await asyncio.shield(self.pending[key])
+        return self.entries.get(key)
+
+    def metrics(self):
+        lookups = self.stats['lookups']
+        return {
+            **self.stats,
+            'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else None,
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
+
+
+def cache_key(request):
+    """Key for GET requests the output cache can answer, else None"""
+    if request.method != 'GET':
+        return None
+    if request.path.startswith('/history/'):
+        return ('history', request.path[len('/history/'):])
+    # Previews and channel extraction are rendered per request; only plain downloads are cached
+    if request.path == '/view' and set(request.query) <= {'filename', 'subfolder', 'type'}:
+        query = request.query
+        return ('view', query.get('filename'), query.get('subfolder', ''), query.get('type', 'output'))
+    return None
+
+
+def if_none_match(request, etag):
+    """Whether the client's If-None-Match already names etag"""
+    header = request.headers.get('If-None-Match')
+    if not header or not etag:
+        return False
+    return header.strip() == '*' or any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+class OutputArchive:
+    """
+    Output files on disk, stored once per content hash. index.jsonl maps
+    (backend, filename, subfolder, type) to a hash and is replayed on start,
+    so results stay servable across restarts and while their backend is
+    offline. Disk work runs in the default executor; serving is a sendfile.
+    A file written again under its name is archived again on `executed`, and
+    its ETag follows the new object, so browser and edge caches revalidate.
+    """
+
+    def __init__(self, root=None, max_bytes=10 * 1024 ** 3, concurrency=4):
+        self.root = root
+        self.max_bytes = max_bytes
+        # (backend, filename, subfolder, type) -> record, plus the newest key per file
+        self.entries = {}
+        self.latest = {}
+        # hash -> size, least recently used first, and the keys pointing at each hash
+        self.objects = OrderedDict()
+        self.refs = {}
+        self.touched = {}
+        self.size = 0
+        self.pending = {}
+        self.limit = asyncio.Semaphore(concurrency)
+        self.stats = {'lookups': 0, 'hits': 0, 'stored': 0, 'stored_bytes': 0, 'deduplicated': 0,
+                      'replaced': 0, 'store_failed': 0, 'evicted': 0, 'evicted_bytes': 0}
+
+    @property
+    def enabled(self):
+        return self.root is not None and self.max_bytes > 0
+
+    @property
+    def index_path(self):
+        return os.path.join(self.root, 'index.jsonl')
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    async def open(self):
+        if not self.enabled:
+            return
+        objects, records = await asyncio.get_running_loop().run_in_executor(None, self._load)
+        for digest, size, mtime in objects:
+            self.objects[digest] = size
+            self.touched[digest] = mtime
+            self.size += size
+        for record in records:
+            if record['hash'] in self.objects:
+                self._index(record)
+        logger.info(f"Output archive {self.root}: {len(self.entries)} files, "
+                    f"{self.size / 1024 ** 2:.1f} MiB in {len(self.objects)} objects")
+        await self._evict()
+
+    async def close(self):
+        for task in list(self.pending.values()):
+            task.cancel()
+        await asyncio.gather(*self.pending.values(), return_exceptions=True)
+
+    def _load(self):
+        """Objects on disk, oldest first, and the last index record per key; compacts the index"""
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+        objects = []
+        for shard in os.scandir(os.path.join(self.root, 'objects')):
+            if shard.is_dir():
+                for item in os.scandir(shard.path):
+                    stat = item.stat()
+                    objects.append((item.name, stat.st_size, stat.st_mtime))
+        objects.sort(key=lambda item: item[2])
+
+        records, lines = {}, 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                        records[(record['backend'], record['filename'], record['subfolder'], record['type'])] = record
+                    except (ValueError, KeyError):
+                        pass
+        present = {item[0] for item in objects}
+        records = [r for r in records.values() if r['hash'] in present]
+        if lines > 2 * len(records):
+            with open(self.index_path + '.tmp', 'w') as f:
+                f.writelines(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+            os.replace(self.index_path + '.tmp', self.index_path)
+        return objects, records
+
+    def _index(self, record):
+        key = (record['backend'], record['filename'], record['subfolder'], record['type'])
+        previous = self.entries.get(key)
+        if previous is not None:
+            self.refs.get(previous['hash'], set()).discard(key)
+        self.entries[key] = record
+        self.refs.setdefault(record['hash'], set()).add(key)
+        self.latest[key[1:]] = key
+
+    def _find(self, file_key, backend_url=None):
+        key = (backend_url, *file_key) if backend_url is not None else self.latest.get(file_key)
+        record = self.entries.get(key)
+        if record is None or record['hash'] not in self.objects:
+            return None
+        digest = record['hash']
+        self.objects.move_to_end(digest)
+        # Keep the mtime roughly in LRU order for the next start, without a syscall per request
+        now = time.time()
+        if now - self.touched.get(digest, 0) > 3600:
+            self.touched[digest] = now
+            asyncio.get_running_loop().run_in_executor(None, self._touch, self.object_path(digest))
+        return self.object_path(digest), record
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def lookup(self, file_key, backend_url=None):
+        """(path, record) of an archived file; backend_url None means whichever stored it last"""
+        self.stats['lookups'] += 1
+        found = self._find(file_key, backend_url)
+        if found is not None:
+            self.stats['hits'] += 1
+        return found
+
+    def prefetch(self, file_key, backend_url, load, refresh=False):
+        """
+        Archive the CachedResponse from `load()` in the background. Files already
+        archived are skipped unless refresh, for when the backend has just written
+        them again: ComfyUI reuses a filename once its counter wraps or the file is
+        deleted, so a known key may now hold different bytes.
+        """
+        key = (backend_url, *file_key)
+        if not self.enabled or key in self.pending or (key in self.entries and not refresh):
+            return
+        self.pending[key] = asyncio.ensure_future(self._prefetch(key, load))
+
+    async def _prefetch(self, key, load):
+        try:
+            async with self.limit:
+                response = await load()
+            if response is not None:
+                await self.store(key[1:], key[0], response.body, response.content_type,
+                                 response.headers.get('Content-Disposition'))
+        except Exception as e:
+            self.stats['store_failed'] += 1
+            logger.warning(f"Archiving {key[1]} failed: {e}")
+        finally:
+            del self.pending[key]
+
+    async def fetch(self, file_key, backend_url, load):
+        """(path, record), archiving the file now if needed; does not count as a client lookup"""
+        self.prefetch(file_key, backend_url, load)
+        key = (backend_url, *file_key)
+        if key in self.pending:
+            await asyncio.shield(self.pending[key])
+        return self._find(file_key, backend_url)
+
+    async def store(self, file_key, backend_url, body, mime, disposition=None):
+        filename, subfolder, file_type = file_key
+        record = {'backend': backend_url, 'filename': filename, 'subfolder': subfolder, 'type': file_type,
+                  'mime': mime}
+        if disposition:
+            record['disposition'] = disposition
+        previous = self.entries.get((backend_url, *file_key))
+        digest = await asyncio.get_running_loop().run_in_executor(None, self._write, body, record)
+        if digest in self.objects:
+            self.stats['deduplicated'] += 1
+        else:
+            self.objects[digest] = len(body)
+            self.touched[digest] = time.time()
+            self.size += len(body)
+            self.stats['stored'] += 1
+            self.stats['stored_bytes'] += len(body)
+        self.objects.move_to_end(digest)
+        self._index(record)
+        if previous is not None and previous['hash'] != digest:
+            self.stats['replaced'] += 1
+            await self._release(previous['hash'])
+        await self._evict()
+
+    async def _release(self, digest):
+        """Delete an object once no key points at it any more"""
+        if self.refs.get(digest) or digest not in self.objects:
+            return
+        self.refs.pop(digest, None)
+        self.size -= self.objects.pop(digest)
+        self.touched.pop(digest, None)
+        await asyncio.get_running_loop().run_in_executor(None, self._remove, [self.object_path(digest)])
+
+    def _write(self, body, record):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temporary, 'wb') as f:
+                f.write(body)
+            os.replace(temporary, path)
+        record['hash'] = digest
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+        return digest
+
+    async def _evict(self):
+        """Drop least recently used objects until the archive fits; the newest always stays"""
+        victims = []
+        while self.size > self.max_bytes and len(self.objects) > 1:
+            digest, size = self.objects.popitem(last=False)
+            self.size -= size
+            self.touched.pop(digest, None)
+            for key in self.refs.pop(digest, ()):
+                self.entries.pop(key, None)
+                if self.latest.get(key[1:]) == key:
+                    del self.latest[key[1:]]
+            victims.append(self.object_path(digest))
+            self.stats['evicted'] += 1
+            self.stats['evicted_bytes'] += size
+        if victims:
+            await asyncio.get_running_loop().run_in_executor(None, self._remove, victims)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def metrics(self):
+        lookups = self.stats['lookups']
+        return {
+            **self.stats,
+            'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else None,
+            'files': len(self.entries),
+            'objects': len(self.objects),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class Backend:
+    """
+    A ComfyUI server the proxy can release prompts to, with a circuit breaker:
+    a failed health probe or failure_threshold consecutive request failures
+    open the circuit, and the next successful probe closes it again.
+    """
+
+    def __init__(self, url, failure_threshold=3):
+        self.url = url.rstrip('/')
+        # Live length of ComfyUI's own queue; None until a status message arrives
+        self.queue_remaining = None
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.circuit_open = False
+        self.opened_at = None
+        self.last_error = None
+        self.latency = None
+        self.checked_at = None
+        self.system_stats = None
+        # Moving average of how long a prompt runs here, in seconds
+        self.execution_time = None
+
+    def record_execution(self, seconds):
+        if self.execution_time is None:
+            self.execution_time = seconds
+        else:
+            self.execution_time = 0.8 * self.execution_time + 0.2 * seconds
+
+    @property
+    def ws_url(self):
+        return self.url.replace('http', 'ws', 1) + '/ws'
+
+    @property
+    def available(self):
+        return not self.circuit_open
+
+    def record_success(self):
+        self.failures = 0
+        self.last_error = None
+        if self.circuit_open:
+            logger.info(f"Backend {self.url} recovered after {time.monotonic() - self.opened_at:.1f}s")
+            self.circuit_open = False
+            self.opened_at = None
+
+    def record_failure(self, error, trip=False):
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+        if not self.circuit_open and (trip or self.failures >= self.failure_threshold):
+            logger.warning(f"Backend {self.url} marked unhealthy: {self.last_error}")
+            self.circuit_open = True
+            self.opened_at = time.monotonic()
+
+    def health(self):
+        return {
+            'url': self.url,
+            'healthy': self.available,
+            'circuit': 'open' if self.circuit_open else 'closed',
+            'consecutive_failures': self.failures,
+            'last_error': self.last_error,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'checked_at': self.checked_at,
+            'queue_remaining': self.queue_remaining,
+        }
+
+    def __repr__(self):
+        return f"Backend({self.url})"
+
+
+class QueuedPrompt:
+    """A /prompt submission waiting in the proxy for backend capacity"""
+
+    def __init__(self, prompt_id, client_id, body, headers=None, cost=1.0):
+        self.prompt_id = prompt_id
+        self.client_id = client_id
+        self.body = body
+        self.headers = {k: v for k, v in (headers or {}).items() if k.lower() != 'content-type'}
+        self.headers['Content-Type'] = 'application/json'
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+
+
+class DeficitRoundRobin:
+    """Per-client FIFO queues served in deficit round-robin order"""
+
+    def __init__(self, quantum=1.0):
+        self.quantum = quantum
+        self.queues = {}
+        self.active = deque()
+        self.deficits = {}
+        # Whether the client at the head of `active` still has to receive its quantum
+        self.fresh_turn = True
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def push(self, job, front=False):
+        queue = self.queues.get(job.client_id)
+        if queue is None:
+            queue = self.queues[job.client_id] = deque()
+            self.deficits[job.client_id] = 0.0
+            if front:
+                self.active.appendleft(job.client_id)
+                self.fresh_turn = True
+            else:
+                self.active.append(job.client_id)
+        if front:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+
+    def pop(self):
+        while self.active:
+            client_id = self.active[0]
+            queue = self.queues[client_id]
+            if not queue:
+                self._retire(client_id)
+                continue
+            if self.fresh_turn:
+                self.deficits[client_id] += self.quantum
+                self.fresh_turn = False
+            if queue[0].cost <= self.deficits[client_id]:
+                job = queue.popleft()
+                self.deficits[client_id] -= job.cost
+                if not queue:
+                    self._retire(client_id)
+                return job
+            self.active.rotate(-1)
+            self.fresh_turn = True
+        return None
+
+    def _retire(self, client_id):
+        self.active.remove(client_id)
+        del self.queues[client_id]
+        del self.deficits[client_id]
+        self.fresh_turn = True
+
+    def remove(self, prompt_ids):
+        removed = []
+        for queue in self.queues.values():
+            for job in [job for job in queue if job.prompt_id in prompt_ids]:
+                queue.remove(job)
+                removed.append(job)
+        return removed
+
+    def copy(self):
+        clone = DeficitRoundRobin(self.quantum)
+        clone.queues = {client_id: deque(queue) for client_id, queue in self.queues.items()}
+        clone.active = deque(self.active)
+        clone.deficits = dict(self.deficits)
+        clone.fresh_turn = self.fresh_turn
+        return clone
+
+    def order(self):
+        """Held jobs in the order they would be released"""
+        clone = self.copy()
+        jobs = []
+        job = clone.pop()
+        while job is not None:
+            jobs.append(job)
+            job = clone.pop()
+        return jobs
+
+
+class FairScheduler:
+    """
+    Holds /prompt submissions in per-client queues and releases them with
+    deficit round-robin, keeping at most max_outstanding prompts in each
+    backend's own queue so a large batch cannot starve other clients.
+    """
+
+    def __init__(self, backends, max_outstanding=2, retry_interval=2.0):
+        self.backends = backends
+        self.max_outstanding = max_outstanding
+        self.retry_interval = retry_interval
+        self.queue = DeficitRoundRobin()
+        self.prompt_backends = LRUDict()
+        # client_id of each released prompt, until it finishes
+        self.prompt_owners = LRUDict()
+        self.on_rejected = None
+        self.session = None
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def start(self):
+        self.session = ClientSession(timeout=ClientTimeout(total=None, sock_connect=10))
+        self._tasks = [asyncio.ensure_future(self.monitor(backend)) for backend in self.backends]
+        self._tasks.append(asyncio.ensure_future(self.dispatch()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.session.close()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def queue_remaining(self):
+        """Prompts ahead of a new submission: held here plus queued on backends"""
+        return len(self.queue) + sum(b.queue_remaining or 0 for b in self.backends)
+
+    def pick_backend(self):
+        candidates = [b for b in self.backends if b.available
+                      and b.queue_remaining is not None and b.queue_remaining < self.max_outstanding]
+        return min(candidates, key=lambda b: b.queue_remaining, default=None)
+
+    def positions(self, client_id=None):
+        return [(position, job) for position, job in enumerate(self.queue.order(), 1)
+                if client_id is None or job.client_id == client_id]
+
+    async def submit(self, job):
+        """Release immediately when a backend has room, otherwise hold. Returns (status, body)"""
+        if not self.queue:
+            backend = self.pick_backend()
+            if backend is not None:
+                try:
+                    return await self.release(job, backend)
+                except Exception as e:
+                    # Hold it instead; the dispatcher reroutes to a healthy backend
+                    logger.warning(f"Releasing prompt {job.prompt_id} to {backend.url} failed: {e}")
+
+        self.queue.push(job)
+        self.wake()
+        position = next(p for p, queued in self.positions(job.client_id) if queued is job)
+        logger.info(f"Holding prompt {job.prompt_id} for {job.client_id} at position {position}")
+        return 200, {'prompt_id': job.prompt_id, 'number': position,
+                     'node_errors': {}, 'queue_position': position}
+
+    async def release(self, job, backend):
+        # Reserve the slot before awaiting so concurrent releases see it
+        backend.queue_remaining += 1
+        try:
+            async with self.session.post(f"{backend.url}/prompt", data=job.body,
+                                         headers=job.headers,
+                                         timeout=ClientTimeout(total=30)) as resp:
+                status = resp.status
+                body = await resp.json(content_type=None)
+        except Exception as e:
+            backend.queue_remaining = None
+            backend.record_failure(e)
+            raise
+
+        backend.record_success()
+        if status == 200:
+            self.prompt_backends[body.get('prompt_id', job.prompt_id)] = backend
+            self.prompt_owners[body.get('prompt_id', job.prompt_id)] = job.client_id
+            waited = time.monotonic() - job.enqueued_at
+            logger.info(f"Released prompt {job.prompt_id} to {backend.url} after {waited:.1f}s")
+        elif backend.queue_remaining is not None:
+            # The monitor may have lost the backend meanwhile, and with it the count
+            backend.queue_remaining -= 1
+        return status, body
+
+    async def dispatch(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self.queue:
+                backend = self.pick_backend()
+                if backend is None:
+                    break
+                job = self.queue.pop()
+                try:
+                    status, body = await self.release(job, backend)
+                except Exception as e:
+                    logger.warning(f"Releasing prompt {job.prompt_id} to {backend.url} failed: {e}")
+                    self.queue.push(job, front=True)
+                    continue
+                if status != 200 and self.on_rejected is not None:
+                    self.on_rejected(job, status, body)
+
+    async def monitor(self, backend):
+        """Follow a backend's queue length through its broadcast status messages"""
+        url = f"{backend.ws_url}?clientId=aircomfy-monitor-{uuid.uuid4().hex}"
+        while True:
+            try:
+                async with self.session.ws_connect(url, heartbeat=30) as ws:
+                    logger.info(f"Monitoring queue of {backend.url}")
+                    async for msg in ws:
+                        if msg.type != WSMsgType.TEXT or '"status"' not in msg.data:
+                            continue
+                        message = json.loads(msg.data)
+                        if message.get('type') == 'status':
+                            exec_info = message['data']['status']['exec_info']
+                            backend.queue_remaining = exec_info['queue_remaining']
+                            self.wake()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Queue monitor for {backend.url} failed: {e}")
+            backend.queue_remaining = None
+            await asyncio.sleep(self.retry_interval)
+
+
+class HealthChecker:
+    """Probes every backend's /system_stats on an interval to drive its circuit breaker"""
+
+    def __init__(self, backends, interval=5.0, timeout=3.0):
+        self.backends = backends
+        self.interval = interval
+        self.timeout = timeout
+        self.session = None
+        self._tasks = []
+
+    async def start(self):
+        self.session = ClientSession(timeout=ClientTimeout(total=self.timeout))
+        self._tasks = [asyncio.ensure_future(self.run(backend)) for backend in self.backends]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.session.close()
+
+    async def run(self, backend):
+        while True:
+            await self.probe(backend)
+            await asyncio.sleep(self.interval)
+
+    async def probe(self, backend):
+        started = time.perf_counter()
+        try:
+            async with self.session.get(f"{backend.url}/system_stats") as resp:
+                if resp.status != 200:
+                    raise ConnectionError(f"/system_stats returned {resp.status}")
+                backend.system_stats = await resp.json(content_type=None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # A deliberate probe failing is enough to stop routing to the backend
+            backend.record_failure(e, trip=True)
+        else:
+            backend.latency = time.perf_counter() - started
+            backend.record_success()
+        backend.checked_at = time.time()
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def data_url(mime, content):
+    return f"data:{mime};base64,{base64.b64encode(content).decode()}"
+
+
+def make_thumbnail(content, max_size):
+    """JPEG thumbnail of an image, or None when Pillow cannot read it"""
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.thumbnail((max_size, max_size))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, format='JPEG', quality=80)
+            return output.getvalue()
+    except Exception:
+        return None
+
+
+class PhaseTimer:
+    """Per-phase durations of one request, reported as a Server-Timing header"""
+
+    __slots__ = ('started', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def since(self, phase, started):
+        self.add(phase, time.perf_counter() - started)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total):
+        entries = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items()]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ', '.join(entries)
+
+    def as_ms(self):
+        return {phase: round(seconds * 1000, 2) for phase, seconds in self.phases.items()}
+
+
+# Where timing_middleware keeps each request's PhaseTimer
+TIMING_KEY = web.RequestKey('timing', PhaseTimer)
+
+
+def upstream_trace_config():
+    """aiohttp hooks that charge connection setup to the PhaseTimer passed as trace_request_ctx"""
+    async def connect_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def connect_end(session, context, params):
+        if isinstance(context.trace_request_ctx, PhaseTimer):
+            context.trace_request_ctx.since('connect', context.connect_started)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(connect_start)
+    trace_config.on_connection_create_end.append(connect_end)
+    return trace_config
+
+
+class TraceLog:
+    """
+    Sampled JSON-lines trace records. Records are handed to a queue and
+    written to a rotating file by a QueueListener thread, so the event
+    loop never waits on disk. Slow requests are always recorded.
+    """
+
+    def __init__(self, path=None, sample_rate=0.01, slow_threshold=1.0,
+                 max_bytes=10 * 1024 * 1024, backup_count=3):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.listener = None
+        if path is not None:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.queue = queue.SimpleQueue()
+            self.listener = QueueListener(self.queue, handler)
+
+    @property
+    def enabled(self):
+        return self.listener is not None
+
+    def start(self):
+        if self.enabled:
+            self.listener.start()
+
+    def stop(self):
+        if self.enabled:
+            self.listener.stop()
+
+    def record(self, kind, total, **fields):
+        if not self.enabled:
+            return
+        if total < self.slow_threshold and random.random() >= self.sample_rate:
+            return
+        entry = {'ts': round(time.time(), 3), 'kind': kind, 'total_ms': round(total * 1000, 2), **fields}
+        self.queue.put_nowait(logging.makeLogRecord({'msg': json.dumps(entry, separators=(',', ':'))}))
+
+
+class NodeProfiler:
+    """
+    Times every node from ComfyUI's `executing` transitions and aggregates
+    the durations per backend and class_type.
+    """
+
+    # Histogram upper bounds in seconds; the last bucket is open-ended
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        # prompt_id -> {node_id: class_type}, from the graphs submitted through the proxy
+        self.graphs = LRUDict(max_items=1000)
+        # prompt_id -> [backend url, prompt start, current node, node start]
+        self.running = {}
+        # backend url -> {'prompts', 'seconds', 'overhead', 'nodes': {class_type: stats}}
+        self.backends = {}
+
+    def _backend(self, url):
+        return self.backends.setdefault(url, {'prompts': 0, 'seconds': 0.0, 'overhead': 0.0, 'nodes': {}})
+
+    def _node(self, url, class_type):
+        return self._backend(url)['nodes'].setdefault(class_type, {
+            'count': 0, 'cached': 0, 'seconds': 0.0, 'max': 0.0,
+            'histogram': [0] * (len(self.BUCKETS) + 1),
+        })
+
+    def class_type(self, prompt_id, node_id):
+        return self.graphs.get(prompt_id, {}).get(node_id, 'unknown')
+
+    def start(self, prompt_id, url, now=None):
+        now = time.monotonic() if now is None else now
+        self.running.setdefault(prompt_id, [url, now, None, now])
+
+    def running_since(self, prompt_id):
+        state = self.running.get(prompt_id)
+        return state[1] if state is not None else None
+
+    def cached(self, prompt_id, url, node_ids):
+        for node_id in node_ids:
+            self._node(url, self.class_type(prompt_id, node_id))['cached'] += 1
+
+    def enter(self, prompt_id, node_id, now=None):
+        """Node node_id started; the previous node (if any) ended. Returns the prompt's run time when node_id is None"""
+        state = self.running.get(prompt_id)
+        # The same event can arrive through several relays when ComfyUI broadcasts it
+        if state is None or (node_id is not None and state[2] == node_id):
+            return None
+        now = time.monotonic() if now is None else now
+        url, prompt_start, current, node_start = state
+        elapsed = now - node_start
+        if current is None:
+            self._backend(url)['overhead'] += elapsed
+        else:
+            stats = self._node(url, self.class_type(prompt_id, current))
+            stats['count'] += 1
+            stats['seconds'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['histogram'][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+        if node_id is not None:
+            state[2:] = [node_id, now]
+            return None
+
+        del self.running[prompt_id]
+        self.graphs.pop(prompt_id, None)
+        backend = self._backend(url)
+        backend['prompts'] += 1
+        backend['seconds'] += now - prompt_start
+        return now - prompt_start
+
+    def report(self):
+        buckets = [f"le_{bound:g}" for bound in self.BUCKETS] + ['inf']
+        backends = {}
+        for url, backend in self.backends.items():
+            nodes = {}
+            for class_type, stats in sorted(backend['nodes'].items(), key=lambda item: -item[1]['seconds']):
+                nodes[class_type] = {
+                    'count': stats['count'],
+                    'cached': stats['cached'],
+                    'total_s': round(stats['seconds'], 3),
+                    'mean_s': round(stats['seconds'] / stats['count'], 3) if stats['count'] else None,
+                    'max_s': round(stats['max'], 3),
+                    'share': round(stats['seconds'] / backend['seconds'], 3) if backend['seconds'] else None,
+                    'histogram': dict(zip(buckets, stats['histogram'])),
+                }
+            backends[url] = {
+                'prompts': backend['prompts'],
+                'total_s': round(backend['seconds'], 3),
+                'overhead_s': round(backend['overhead'], 3),
+                'nodes': nodes,
+            }
+        return {'backends': backends, 'running': len(self.running)}
+
+    def folded(self):
+        """Folded stacks (`backend;class_type milliseconds`) for flamegraph.pl and speedscope"""
+        lines = []
+        for url, backend in self.backends.items():
+            frames = [('(overhead)', backend['overhead'])]
+            frames += [(class_type, stats['seconds']) for class_type, stats in backend['nodes'].items()]
+            lines += [f"{url};{frame} {round(seconds * 1000)}" for frame, seconds in frames
+                      if round(seconds * 1000)]
+        return '\n'.join(lines) + '\n'
+
+
+class RuntimeEstimator:
+    """
+    Learns prompt run times from completions. An unseen graph shape is
+    estimated from the seconds per unit of work (steps x megapixels x batch)
+    of graphs with the same node types, then from the backend's average.
+    """
+
+    def __init__(self, max_shapes=1000):
+        self.shapes = LRUDict(max_items=max_shapes)
+        self.rates = LRUDict(max_items=max_shapes)
+
+    @staticmethod
+    def work(shape):
+        _, steps, width, height, batch = shape
+        return max(steps, 1) * max(width * height / (512 * 512), 0.25) * batch
+
+    @staticmethod
+    def _average(table, key, value):
+        old = table.get(key)
+        table[key] = value if old is None else 0.7 * old + 0.3 * value
+
+    def observe(self, shape, seconds):
+        self._average(self.shapes, shape, seconds)
+        self._average(self.rates, shape[0], seconds / self.work(shape))
+
+    def estimate(self, shape, fallback=None):
+        if shape is not None:
+            if shape in self.shapes:
+                return self.shapes[shape]
+            if shape[0] in self.rates:
+                return self.rates[shape[0]] * self.work(shape)
+        return fallback
+
+
+# PWA files served by the proxy itself
+STATIC_FILES = {
+    'index.html': 'text/html',
+    'style.css': 'text/css',
+    'manifest.json': 'application/json',
+    'sw.js': 'application/javascript',
+    'editor.js': 'application/javascript',
+    'workflow-worker.js': 'application/javascript',
+    'preview-worker.js': 'application/javascript',
+    'bench-editor.html': 'text/html',
+    'icon-192.png': 'image/png'
+}
+
+# Content-hashed files written by build_pwa.py
+HASHED_ASSET = re.compile(r'^assets/[\w-]+\.[0-9a-f]{10}\.(js|css)$')
+ASSET_TYPES = {'js': 'application/javascript', 'css': 'text/css'}
+
+
+class StackSampler:
+    """
+    Sampling profiler for the thread running the event loop. A helper
+    thread records that thread's Python stack every `interval` seconds, so
+    a busy production loop can be profiled without restarting or tracing it.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='aircomfy-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        """Folded stacks (`outer;inner count`) for flamegraph.pl and speedscope"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit=25):
+        """Functions by samples spent in them (self) and under them (total)"""
+        own, total, idle = Counter(), Counter(), 0
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+            # The loop waiting in select() for I/O is idle, not busy
+            if frames[-1].startswith('select (selectors.py'):
+                idle += count
+        share = lambda count: round(count / self.samples, 3) if self.samples else None
+        return {
+            'samples': self.samples,
+            'interval_ms': self.interval * 1000,
+            'idle': share(idle),
+            'self': [{'frame': frame, 'share': share(count)} for frame, count in own.most_common(limit)],
+            'total': [{'frame': frame, 'share': share(count)} for frame, count in total.most_common(limit)],
+        }
+
+
+def task_census(detail=False):
+    """Count the loop's tasks by coroutine, or with detail by where each is suspended"""
+    kinds = Counter()
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        kind = getattr(coro, '__qualname__', type(coro).__name__)
+        if detail:
+            stack = task.get_stack(limit=1)
+            if stack:
+                frame = stack[-1]
+                kind += f" @ {os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}"
+        kinds[kind] += 1
+    return dict(kinds.most_common())
+
+
+def memory_snapshot():
+    """tracemalloc snapshot without tracemalloc's own and the import system's allocations"""
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+# Requests a client needs to show finished results; they are never shed
+CRITICAL_FAMILIES = {'results', 'status'}
+
+
+def route_family(request):
+    """Group requests for admission control"""
+    path = request.path
+    if path == '/ws':
+        return 'ws'
+    if path == '/view' or path.startswith('/history') or path == '/aircomfy/history/bulk':
+        return 'results'
+    # Registering a template validates a whole graph, and running one queues it
+    if path == '/prompt' or path == '/aircomfy/templates' or path.startswith('/aircomfy/templates/'):
+        return 'prompt'
+    if path.startswith('/aircomfy/') or path.startswith('/debug'):
+        return 'status'
+    if path.lstrip('/') in STATIC_FILES or path == '/' or path.startswith('/assets/'):
+        return 'static'
+    return 'api'
+
+
+class LoadShedder:
+    """
+    Caps in-flight requests per route family and open WebSockets, and turns
+    new non-critical work away while the event loop is lagging.
+    """
+
+    def __init__(self, limits=None, max_websockets=256, lag_threshold=0.25, interval=0.05):
+        self.limits = {'prompt': 32, 'api': 64, 'static': 64, **(limits or {})}
+        self.max_websockets = max_websockets
+        self.lag_threshold = lag_threshold
+        self.interval = interval
+        self.inflight = {}
+        self.websockets = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        # Raw lag of each tick over roughly the last minute, for diagnostics
+        self.lag_history = deque(maxlen=max(int(60 / interval), 1))
+        self.shed = {}
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self.monitor())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def monitor(self):
+        """Measure how late the loop wakes a sleeper; decays so one hiccup does not shed for long"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+            self.lag = max(lag, self.lag * 0.5)
+            self.max_lag = max(self.max_lag, lag)
+            self.lag_history.append(lag)
+
+    def admit(self, family, critical=False):
+        """None when the request may proceed, else why it was refused"""
+        if critical or family in CRITICAL_FAMILIES:
+            reason = None
+        elif self.lag_threshold and self.lag > self.lag_threshold:
+            reason = f'event loop lagging {self.lag * 1000:.0f}ms'
+        elif family == 'ws':
+            reason = 'too many WebSocket connections' if self.websockets >= self.max_websockets else None
+        elif self.inflight.get(family, 0) >= self.limits.get(family, float('inf')):
+            reason = f'too many {family} requests in flight'
+        else:
+            reason = None
+
+        if reason is not None:
+            self.shed[family] = self.shed.get(family, 0) + 1
+            return reason
+        if family == 'ws':
+            self.websockets += 1
+        else:
+            self.inflight[family] = self.inflight.get(family, 0) + 1
+        return None
+
+    def release(self, family):
+        if family == 'ws':
+            self.websockets -= 1
+        else:
+            self.inflight[family] -= 1
+
+    def lag_report(self):
+        """Percentiles of the loop lag over the recent window, in milliseconds"""
+        samples = sorted(self.lag_history)
+        if not samples:
+            return {'window_s': 0}
+
+        def ms(fraction):
+            return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 1)
+        return {
+            'window_s': round(len(samples) * self.interval),
+            'current_ms': round(self.lag * 1000, 1),
+            'p50_ms': ms(0.5),
+            'p99_ms': ms(0.99),
+            'max_ms': round(samples[-1] * 1000, 1),
+            'max_since_start_ms': round(self.max_lag * 1000, 1),
+            'ticks_over_100ms': sum(1 for lag in samples if lag > 0.1),
+        }
+
+    def metrics(self):
+        return {
+            'lag_ms': round(self.lag * 1000, 1),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+            'inflight': {family: count for family, count in self.inflight.items() if count},
+            'websockets': self.websockets,
+            'limits': {**self.limits, 'ws': self.max_websockets},
+            'shed': dict(self.shed),
+        }
+
+
+class RelaySession:
+    """
+    The upstream WebSocket subscriptions of one clientId. They outlive the
+    client's own socket for a grace period, numbering and buffering text
+    events so a reconnecting client can replay only what it missed.
+    """
+
+    def __init__(self, client_id, buffer_size=256):
+        self.client_id = client_id
+        self.ws = None
+        # Whether the attached client asked for `seq` numbers on each event
+        self.sequenced = False
+        # Whether it wants finished outputs pushed as aircomfy_result messages
+        self.push = False
+        self.seq = 0
+        self.buffer = deque(maxlen=buffer_size)
+        self.http = None
+        self.upstreams = []
+        self.tasks = []
+        self.closed = False
+        self.started = time.perf_counter()
+        self.connect_time = 0.0
+        self.messages = 0
+        self.delay = 0.0
+        self.max_delay = 0.0
+        self._expiry = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def note_delay(self, seconds):
+        # Time a message spends inside the proxy before reaching the client
+        self.messages += 1
+        self.delay += seconds
+        self.max_delay = max(self.max_delay, seconds)
+
+    @staticmethod
+    def stamp(seq, text):
+        # Splice the sequence number in rather than re-serializing the event
+        if not text.startswith('{'):
+            return text
+        separator = '' if text[1:].lstrip().startswith('}') else ','
+        return f'{{"seq":{seq}{separator}{text[1:]}'
+
+    async def attach(self, ws, sequenced, push=False):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        previous, self.ws, self.sequenced, self.push = self.ws, ws, sequenced, push
+        if previous is not None and previous is not ws:
+            await previous.close()
+
+    def detach(self, ws):
+        """Forget the client socket; True when it was the attached one"""
+        if self.ws is not ws:
+            return False
+        self.ws = None
+        return True
+
+    def expire_in(self, seconds, close):
+        loop = asyncio.get_running_loop()
+        self._expiry = loop.call_later(seconds, lambda: asyncio.ensure_future(close(self)))
+
+    async def _send(self, text):
+        ws = self.ws
+        if ws is None or ws.closed:
+            return
+        try:
+            await ws.send_str(text)
+        except Exception as e:
+            logger.debug(f"Dropped event for {self.client_id}: {e}")
+
+    async def publish(self, text):
+        self.seq += 1
+        self.buffer.append((self.seq, text))
+        await self._send(self.stamp(self.seq, text) if self.sequenced else text)
+
+    async def send_bytes(self, data):
+        # Preview frames are only useful live, so they are never buffered
+        ws = self.ws
+        if ws is not None and not ws.closed:
+            try:
+                await ws.send_bytes(data)
+            except Exception as e:
+                logger.debug(f"Dropped frame for {self.client_id}: {e}")
+
+    async def send_status(self, exec_info):
+        await self._send(json.dumps({'type': 'status', 'data': {
+            'status': {'exec_info': exec_info}, 'sid': self.client_id}}))
+
+    async def replay(self, last_seq, resumed):
+        oldest = self.buffer[0][0] if self.buffer else self.seq + 1
+        for seq, text in list(self.buffer):
+            if seq > last_seq:
+                await self._send(self.stamp(seq, text))
+        # Tell the client whether events were lost, so it knows to check /history
+        missed = not resumed or last_seq + 1 < oldest
+        await self._send(json.dumps({'type': 'aircomfy_resume', 'data': {
+            'resumed': resumed, 'missed': missed, 'seq': self.seq}}))
+
+    async def close(self):
+        self.closed = True
+        if self._expiry is not None:
+            self._expiry.cancel()
+        for task in self.tasks:
+            task.cancel()
+        for _, upstream in self.upstreams:
+            await upstream.close()
+        if self.http is not None:
+            await self.http.close()
+        if self.ws is not None:
+            await self.ws.close()
+
+
+# Upstream response headers that describe the upstream framing, not the body we send
+RESPONSE_FRAMING_HEADERS = {'content-length', 'content-encoding', 'transfer-encoding', 'connection', 'keep-alive'}
+
+
+def forward_headers(request):
+    # Forward headers (except host and framing, which is recomputed for rewritten bodies)
+    return {k: v for k, v in request.headers.items()
+            if k.lower() not in ['host', 'origin', 'content-length', 'transfer-encoding', 'connection']}
+
+
 class ComfyUIProxy:
-    def __init__(self, comfyui_url="http://localhost:8188"):
-        self.comfyui_url = comfyui_url.rstrip('/')
-        self.websocket_connections = {}
+    def __init__(self, comfyui_url="http://localhost:8188", validate=True, schema_ttl=300,
+                 optimize=True, max_outstanding=2, health_interval=5.0, connect_timeout=3.0,
+                 trace_file=None, trace_sample=0.01, trace_slow=1.0,
+                 resume_grace=120.0, resume_buffer=256, push_inline_limit=128 * 1024,
+                 push_thumbnail_size=384, prefetch_bytes=128 * 1024 * 1024, prefetch_concurrency=4,
+                 orphan_grace=0, orphan_interrupt=False, request_limits=None, max_websockets=256,
+                 shed_lag=0.25, archive_dir=None, archive_bytes=10 * 1024 ** 3, admin_token=None,
+                 static_dir='.'):
+        urls = [comfyui_url] if isinstance(comfyui_url, str) else list(comfyui_url)
+        self.backends = [Backend(url) for url in urls]
+        self.health = HealthChecker(self.backends, interval=health_interval, timeout=connect_timeout)
+        self.upstream_timeout = ClientTimeout(total=None, sock_connect=connect_timeout)
+        self.trace_config = upstream_trace_config()
+        self.traces = TraceLog(trace_file, sample_rate=trace_sample, slow_threshold=trace_slow)
+        self.comfyui_url = self.backends[0].url
+        # RelaySession per clientId, kept for resume_grace seconds after a disconnect
+        self.relays = {}
+        self.resume_grace = resume_grace
+        self.resume_buffer = resume_buffer
+        self.push_inline_limit = push_inline_limit
+        self.push_thumbnail_size = push_thumbnail_size
+        # Shared session for the proxy's own upstream calls
+        self.http = None
+        self.schema_cache = NodeSchemaCache(self.backends, ttl=schema_ttl) if validate else None
+        self.optimize = optimize
+        self.scheduler = FairScheduler(self.backends, max_outstanding=max_outstanding)
+        self.scheduler.on_rejected = self.notify_rejected
+        # Which backend holds each output file, learned from `executed` messages
+        self.output_backends = LRUDict()
+        self.output_cache = OutputCache(prefetch_bytes, concurrency=prefetch_concurrency)
+        # Outputs kept on disk by content hash; when enabled it takes over /view from output_cache
+        self.archive = OutputArchive(archive_dir, archive_bytes, concurrency=prefetch_concurrency)
+        self.shedder = LoadShedder(request_limits, max_websockets=max_websockets, lag_threshold=shed_lag)
+        self.profiler = NodeProfiler()
+        self.estimator = RuntimeEstimator()
+        self.prompt_shapes = LRUDict(max_items=10000)
+        # Each backend's last status broadcast and the exec_info it was rewritten with, shared by every relay
+        self.relayed_status = {}
+        self.bulk_history_limit = 1000
+        # Normalized graphs registered through /aircomfy/templates, by content hash
+        self.templates = LRUDict(max_items=256)
+        # Cancel a client's prompts once it has been gone orphan_grace seconds; 0 disables
+        self.orphan_grace = orphan_grace
+        self.orphan_interrupt = orphan_interrupt
+        self.orphan_timers = {}
+        self.orphan_stats = {'clients_reaped': 0, 'held_dropped': 0, 'prompts_deleted': 0,
+                             'prompts_interrupted': 0, 'gpu_seconds_reclaimed': 0.0}
+        # /debug/* diagnostics are only routed when a token is configured
+        self.admin_token = admin_token
+        # PWA sources, or the output of build_pwa.py with its content-hashed assets/
+        self.static_dir = static_dir
+        self.started_at = time.time()
+        self.loop_thread = None
+        self.sampler = None
+        self.memory_baseline = None
+
+    async def start(self, app):
+        self.loop_thread = threading.get_ident()
+        self.http = ClientSession(timeout=self.upstream_timeout, trace_configs=[self.trace_config])
+        self.traces.start()
+        await self.archive.open()
+        await self.shedder.start()
+        await self.health.start()
+        await self.scheduler.start()
+
+    async def stop(self, app):
+        for timer in self.orphan_timers.values():
+            timer.cancel()
+        for relay in list(self.relays.values()):
+            await self.close_relay(relay)
+        await self.scheduler.stop()
+        await self.health.stop()
+        await self.archive.close()
+        await self.http.close()
+        await self.shedder.stop()
+        self.traces.stop()
+
+    @web.middleware
+    async def timing_middleware(self, request, handler):
+        """Time every request; handlers add their own phases to request[TIMING_KEY]"""
+        timing = request[TIMING_KEY] = PhaseTimer()
+        response = await handler(request)
+        if isinstance(response, web.WebSocketResponse):
+            return response
+
+        total = timing.elapsed()
+        if not response.prepared:
+            response.headers['Server-Timing'] = timing.server_timing(total)
+        self.traces.record('http', total, method=request.method, path=request.path,
+                           status=response.status, phases=timing.as_ms())
+        return response
+
+    @web.middleware
+    async def admission_middleware(self, request, handler):
+        """Answer excess load at once with 503 instead of letting every request slow down"""
+        family = route_family(request)
+        # Reattaching keeps a client's buffered events flowing
+        critical = family == 'ws' and request.query.get('clientId') in self.relays
+        reason = self.shedder.admit(family, critical)
+        if reason is not None:
+            logger.debug(f"Shed {request.method} {request.path}: {reason}")
+            response = self.json_response({'error': f'AirComfy proxy is overloaded: {reason}'}, 503)
+            response.headers['Retry-After'] = '1'
+            return response
+        try:
+            return await handler(request)
+        finally:
+            self.shedder.release(family)
 
     def add_cors_headers(self, response):
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+        response.headers['Access-Control-Expose-Headers'] = 'X-AirComfy-Prompt-Reduction, Server-Timing'
+        response.headers['Timing-Allow-Origin'] = '*'
         return response
 
     async def handle_preflight(self, request):
         response = web.Response()
         return self.add_cors_headers(response)
 
-    async def proxy_request(self, request):
+    def json_response(self, payload, status=200):
+        return self.add_cors_headers(web.json_response(payload, status=status))
+
+    async def handle_prompt(self, request):
+        """Validate and slim down /prompt submissions before they take a ComfyUI queue slot"""
+        timing = request[TIMING_KEY]
+        started = time.perf_counter()
+        body = await request.read()
+        timing.since('read', started)
+        try:
+            payload = json.loads(body)
+        except ValueError as e:
+            return self.json_response({'error': node_error('invalid_prompt', f'Invalid JSON: {e}'),
+                                    'node_errors': {}}, 400)
+        prompt = payload.get('prompt') if isinstance(payload, dict) else None
+        schemas = await self.schema_cache.get() if self.schema_cache else None
+
+        removed = []
+        if self.optimize:
+            started = time.perf_counter()
+            prompt, removed = optimize_prompt(prompt, schemas)
+            timing.since('optimize', started)
+
+        rejection = await self.check_prompt(request, prompt, schemas)
+        if rejection is not None:
+            return rejection
+
+        if prompt is None:
+            return await self.proxy_request(request, body)
+
+        return await self.submit_prompt(request, payload, prompt,
+                                        removed=removed, original_size=len(body) if self.optimize else None)
+
+    async def check_prompt(self, request, prompt, schemas):
+        """Validate against node schemas; returns a 400 response, or None when the prompt may go ahead"""
+        # Without schemas (ComfyUI unreachable) the backend has the final say
+        if schemas is None:
+            return None
+        started = time.perf_counter()
+        error, node_errors = validate_prompt(prompt, schemas)
+        missing_types = any(e['type'] == 'missing_node_type'
+                            for entry in node_errors.values() for e in entry['errors'])
+        if missing_types and self.schema_cache.age > 10:
+            # Custom nodes may have been installed since the last fetch
+            schemas = await self.schema_cache.refresh_soon()
+            error, node_errors = validate_prompt(prompt, schemas)
+        request[TIMING_KEY].since('validate', started)
+
+        if error is not None:
+            logger.info(f"Rejected prompt: {error['message']} ({len(node_errors)} nodes)")
+            return self.json_response({'error': error, 'node_errors': node_errors}, 400)
+        return None
+
+    async def submit_prompt(self, request, payload, prompt, removed=(), original_size=None):
+        """Hand a checked prompt to the scheduler and answer like ComfyUI's /prompt"""
+        timing = request[TIMING_KEY]
+        # The proxy names the prompt so held submissions can be answered immediately
+        payload['prompt'] = prompt
+        payload.setdefault('prompt_id', str(uuid.uuid4()))
+        cost = 1.0
+        if isinstance(prompt, dict):
+            self.profiler.graphs[payload['prompt_id']] = {
+                node_id: node.get('class_type') for node_id, node in prompt.items() if isinstance(node, dict)}
+            shape = self.prompt_shapes[payload['prompt_id']] = graph_shape(prompt)
+            # Charge clients for expected GPU time rather than prompt count
+            typical = self.expected_run_time(None)
+            estimate = self.estimator.estimate(shape)
+            if estimate is not None and typical:
+                cost = min(max(estimate / typical, 0.25), 8.0)
+        forwarded_body = json.dumps(payload, separators=(',', ':')).encode()
+
+        reduction = None
+        if original_size is not None:
+            reduction = (f"nodes={len(prompt) + len(removed)}->{len(prompt)}; "
+                         f"bytes={original_size}->{len(forwarded_body)}")
+            if removed:
+                logger.info(f"Pruned unreachable nodes {', '.join(removed)} ({reduction})")
+
+        if not any(b.available for b in self.backends):
+            return self.unavailable()
+
+        client_id = payload.get('client_id') or request.remote
+        job = QueuedPrompt(payload['prompt_id'], client_id, forwarded_body, forward_headers(request), cost=cost)
+        started = time.perf_counter()
+        try:
+            status, result = await self.scheduler.submit(job)
+            timing.since('schedule', started)
+        except Exception as e:
+            logger.error(f"Prompt submission failed: {e}")
+            return self.json_response({'error': f'Proxy failed: {str(e)}'}, 500)
+
+        response = self.json_response(result, status)
+        if reduction is not None:
+            response.headers['X-AirComfy-Prompt-Reduction'] = reduction
+        return response
+
+    async def handle_template_put(self, request):
+        """Register a workflow (bare or as {"prompt": ...}) by the hash of its normalized graph"""
+        try:
+            payload = await request.json()
+        except ValueError as e:
+            return self.json_response({'error': node_error('invalid_prompt', f'Invalid JSON: {e}'),
+                                       'node_errors': {}}, 400)
+        prompt = payload.get('prompt', payload) if isinstance(payload, dict) else None
+        schemas = await self.schema_cache.get() if self.schema_cache else None
+        if self.optimize:
+            prompt, _ = optimize_prompt(prompt, schemas)
+        if not isinstance(prompt, dict) or not prompt:
+            return self.json_response({'error': node_error('invalid_prompt', 'Template must be a non-empty graph'),
+                                       'node_errors': {}}, 400)
+        rejection = await self.check_prompt(request, prompt, schemas)
+        if rejection is not None:
+            return rejection
+
+        canonical = json.dumps(prompt, sort_keys=True, separators=(',', ':')).encode()
+        template_hash = hashlib.sha256(canonical).hexdigest()[:16]
+        created = template_hash not in self.templates
+        self.templates[template_hash] = prompt
+        return self.json_response({'hash': template_hash, 'nodes': len(prompt), 'bytes': len(canonical)},
+                                  201 if created else 200)
+
+    async def handle_template_run(self, request):
+        """Submit a registered template with {"overrides": {node_id: {input: value}}, "client_id": ...}"""
+        template = self.templates.get(request.match_info['hash'])
+        if template is None:
+            return self.json_response({'error': 'Unknown template; PUT it to /aircomfy/templates again'}, 404)
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            return self.json_response({'error': node_error('invalid_prompt', 'Body must be a JSON object'),
+                                       'node_errors': {}}, 400)
+
+        prompt, node_errors = apply_overrides(template, payload.pop('overrides', None) or {})
+        if node_errors:
+            return self.json_response({'error': node_error('invalid_prompt', 'Overrides do not match the template'),
+                                       'node_errors': node_errors}, 400)
+        # The whole graph is revalidated on every run, though only the overridden nodes can have changed
+        schemas = await self.schema_cache.get() if self.schema_cache else None
+        rejection = await self.check_prompt(request, prompt, schemas)
+        if rejection is not None:
+            return rejection
+        return await self.submit_prompt(request, payload, prompt)
+
+    def notify_rejected(self, job, status, body):
+        """Tell a client that a prompt it was told is queued was refused by ComfyUI"""
+        logger.info(f"Backend rejected held prompt {job.prompt_id} ({status})")
+        relay = self.relays.get(job.client_id)
+        if relay is None:
+            return
+        error = body.get('error') if isinstance(body, dict) else None
+        message = error.get('message') if isinstance(error, dict) else str(error or status)
+        asyncio.ensure_future(relay.publish(json.dumps({
+            'type': 'execution_error',
+            'data': {
+                'prompt_id': job.prompt_id,
+                'node_id': None,
+                'node_type': None,
+                'exception_type': 'PromptRejected',
+                'exception_message': message,
+                'node_errors': body.get('node_errors', {}) if isinstance(body, dict) else {},
+                'timestamp': int(time.time() * 1000),
+            },
+        })))
+
+    def unavailable(self, backend=None):
+        """Fail fast while circuits are open instead of waiting on connect timeouts"""
+        if backend is not None:
+            message = f'ComfyUI backend {backend.url} is unavailable: {backend.last_error}'
+        else:
+            message = 'No ComfyUI backend is available'
+        response = self.json_response({'error': message}, 503)
+        response.headers['Retry-After'] = str(max(1, round(self.health.interval)))
+        return response
+
+    async def handle_health(self, request):
+        """Cached backend health, so clients need not probe ComfyUI themselves"""
+        backends = [backend.health() for backend in self.backends]
+        healthy = any(b['healthy'] for b in backends)
+        return self.json_response({
+            'healthy': healthy,
+            'interval': self.health.interval,
+            'backends': backends,
+        }, 200 if healthy else 503)
+
+    async def handle_system_stats(self, request):
+        """Answer /system_stats from the latest health probe when it is fresh"""
+        backend = next((b for b in self.backends if b.available), None)
+        if (backend is not None and backend.system_stats is not None
+                and time.time() - backend.checked_at < self.health.interval * 2):
+            return self.json_response(backend.system_stats)
+        return await self.proxy_request(request)
+
+    async def handle_queue_status(self, request):
+        """Proxy-side queue state and, with ?clientId=, that client's positions"""
+        client_id = request.query.get('clientId')
+        data = {
+            'held': len(self.scheduler.queue),
+            'queue_remaining': self.scheduler.queue_remaining(),
+            'max_outstanding': self.scheduler.max_outstanding,
+            'backends': [{'url': b.url, 'queue_remaining': b.queue_remaining}
+                         for b in self.backends],
+        }
+        if client_id:
+            data['jobs'] = [{'prompt_id': job.prompt_id, 'position': position,
+                             'waiting': round(time.monotonic() - job.enqueued_at, 1)}
+                            for position, job in self.scheduler.positions(client_id)]
+        return self.add_cors_headers(web.json_response(data))
+
+    def backend_for(self, request):
+        """
+        Send follow-up requests to the backend that ran the prompt and
+        everything else to the first healthy backend.
+        """
+        owner = None
+        if request.path.startswith('/history/'):
+            owner = self.scheduler.prompt_backends.get(request.path[len('/history/'):])
+        elif request.path == '/view':
+            query = request.query
+            key = (query.get('filename'), query.get('subfolder', ''), query.get('type', 'output'))
+            owner = self.output_backends.get(key)
+        if owner is not None:
+            return owner
+        return next((b for b in self.backends if b.available), self.backends[0])
+
+    def note_outputs(self, backend, data):
+        if data.get('prompt_id'):
+            self.scheduler.prompt_backends[data['prompt_id']] = backend
+        for files in (data.get('output') or {}).values():
+            if not isinstance(files, list):
+                continue
+            for item in files:
+                if isinstance(item, dict) and 'filename' in item:
+                    key = (item['filename'], item.get('subfolder', ''), item.get('type', 'output'))
+                    self.output_backends[key] = backend
+
+    def relay_text(self, backend, text):
+        """
+        Inspect a backend message on its way to a client. Returns the text to
+        send and the parsed message, or None for messages not worth parsing.
+        """
+        if ('"executing"' not in text and '"executed"' not in text and '"status"' not in text
+                and '"execution_start"' not in text and '"execution_cached"' not in text):
+            return text, None
+        try:
+            message = json.loads(text)
+        except ValueError:
+            return text, None
+
+        if message.get('type') == 'executed':
+            self.note_outputs(backend, message.get('data') or {})
+            self.prefetch_outputs(backend, message.get('data') or {})
+        elif message.get('type') == 'execution_start':
+            prompt_id = (message.get('data') or {}).get('prompt_id')
+            if prompt_id:
+                self.profiler.start(prompt_id, backend.url)
+        elif message.get('type') == 'execution_cached':
+            data = message.get('data') or {}
+            if data.get('prompt_id'):
+                self.profiler.cached(data['prompt_id'], backend.url, data.get('nodes') or [])
+        elif message.get('type') == 'executing':
+            data = message.get('data') or {}
+            prompt_id = data.get('prompt_id')
+            if not prompt_id:
+                return text, message
+            duration = self.profiler.enter(prompt_id, data.get('node'))
+            if duration is not None:
+                backend.record_execution(duration)
+                shape = self.prompt_shapes.pop(prompt_id, None)
+                if shape is not None:
+                    self.estimator.observe(shape, duration)
+            if data.get('node') is None:
+                self.scheduler.prompt_owners.pop(prompt_id, None)
+                # The prompt is done, so its history entry is complete
+                self.output_cache.prefetch(('history', prompt_id),
+                                           lambda: self.load_history(backend, prompt_id))
+        elif message.get('type') == 'status':
+            # Report the whole proxy queue, not just this backend's share
+            exec_info = (message.get('data') or {}).get('status', {}).get('exec_info')
+            if isinstance(exec_info, dict) and 'queue_remaining' in exec_info:
+                backend.queue_remaining = exec_info['queue_remaining']
+                exec_info.update(self.status_exec_info(backend, text))
+                return json.dumps(message), message
+        return text, message
+
+    def prefetch_outputs(self, backend, data):
+        """Start downloading a finished node's files before the client asks for them"""
+        for files in (data.get('output') or {}).values():
+            if not isinstance(files, list):
+                continue
+            for item in files:
+                if isinstance(item, dict) and 'filename' in item:
+                    key = ('view', item['filename'], item.get('subfolder', ''), item.get('type', 'output'))
+                    if self.archive.enabled:
+                        # The node has just written this file, so an archived copy may be stale
+                        self.archive.prefetch(key[1:], backend.url, lambda key=key: self.load_view(backend, key),
+                                              refresh=True)
+                    else:
+                        self.output_cache.discard(key)
+                        self.output_cache.prefetch(key, lambda key=key: self.load_view(backend, key))
+
+    async def load_view(self, backend, key):
+        _, filename, subfolder, file_type = key
+        query = urlencode({'filename': filename, 'subfolder': subfolder, 'type': file_type})
+        async with self.http.get(f"{backend.url}/view?{query}") as resp:
+            if resp.status != 200:
+                return None
+            # The ETag lets browser and edge caches revalidate a file that may be written again
+            headers = {name: resp.headers[name] for name in ('Content-Disposition', 'ETag') if name in resp.headers}
+            return CachedResponse(await resp.read(), resp.content_type, headers)
+
+    async def load_history(self, backend, prompt_id):
+        async with self.http.get(f"{backend.url}/history/{prompt_id}") as resp:
+            body = await resp.read()
+        # An empty answer means ComfyUI has not written the entry yet
+        if resp.status != 200 or prompt_id not in json.loads(body):
+            return None
+        return CachedResponse(body, 'application/json')
+
+    async def handle_profile(self, request):
+        """Per-node timings; ?format=folded gives folded stacks for flame graph tools"""
+        if request.query.get('format') == 'folded':
+            return self.add_cors_headers(web.Response(text=self.profiler.folded()))
+        return self.json_response(self.profiler.report())
+
+    async def handle_history_bulk(self, request):
+        """
+        History of many prompts in one response: {"prompt_ids": [...], "include_prompt": false}.
+        Served from the output cache where possible, otherwise with one recent
+        /history fetch per backend and single lookups only for what that missed.
+        """
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        prompt_ids = payload.get('prompt_ids') if isinstance(payload, dict) else None
+        if not isinstance(prompt_ids, list) or not all(isinstance(p, str) for p in prompt_ids):
+            return self.json_response({'error': 'Expected {"prompt_ids": ["...", ...]}'}, 400)
+        prompt_ids = list(dict.fromkeys(prompt_ids))
+        if len(prompt_ids) > self.bulk_history_limit:
+            return self.json_response({'error': f'At most {self.bulk_history_limit} prompt_ids per request'}, 400)
+
+        history = {}
+        for prompt_id in prompt_ids:
+            # Not a client lookup of its own, so it stays out of the cache's hit rate
+            cached = self.output_cache.peek(('history', prompt_id))
+            if cached is not None:
+                history.update(json.loads(cached.body))
+
+        # Still queued or held prompts have no history yet
+        pending = {job.prompt_id for _, job in self.scheduler.positions()}
+        missing = [p for p in prompt_ids if p not in history and p not in pending]
+        if missing:
+            by_backend = {}
+            for prompt_id in missing:
+                owner = self.scheduler.prompt_backends.get(prompt_id)
+                for backend in [owner] if owner is not None else self.backends:
+                    if backend.available:
+                        by_backend.setdefault(backend, set()).add(prompt_id)
+            results = await asyncio.gather(*(self.fetch_history(backend, ids) for backend, ids in by_backend.items()),
+                                           return_exceptions=True)
+            for backend, result in zip(by_backend, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Bulk history from {backend.url} failed: {result}")
+                else:
+                    history.update(result)
+
+        if not payload.get('include_prompt'):
+            # The submitted graph is most of each entry and rarely needed
+            history = {p: {k: v for k, v in entry.items() if k != 'prompt'} for p, entry in history.items()}
+        response = web.json_response({p: history[p] for p in prompt_ids if p in history},
+                                     dumps=lambda data: json.dumps(data, separators=(',', ':')))
+        return self.add_cors_headers(response)
+
+    async def fetch_history(self, backend, prompt_ids):
+        """Entries for prompt_ids on one backend, keeping them in the output cache"""
+        window = min(max(len(prompt_ids) * 2, 64), self.bulk_history_limit)
+        async with self.http.get(f"{backend.url}/history", params={'max_items': str(window)}) as resp:
+            recent = await resp.json()
+        found = {p: recent[p] for p in prompt_ids if p in recent}
+
+        # Older than the window: look up only the ones this backend is known to have run
+        stragglers = [p for p in prompt_ids if p not in found and self.scheduler.prompt_backends.get(p) is backend]
+        async def lookup(prompt_id):
+            async with self.http.get(f"{backend.url}/history/{prompt_id}") as resp:
+                return await resp.json()
+        entries = await asyncio.gather(*(lookup(p) for p in stragglers), return_exceptions=True)
+        for prompt_id, entry in zip(stragglers, entries):
+            if isinstance(entry, Exception):
+                logger.warning(f"History of {prompt_id} from {backend.url} failed: {entry}")
+            elif isinstance(entry, dict):
+                found.update(entry)
+
+        if self.output_cache.enabled:
+            for prompt_id, entry in found.items():
+                body = json.dumps({prompt_id: entry}, separators=(',', ':')).encode()
+                self.output_cache.put(('history', prompt_id), CachedResponse(body, 'application/json'))
+        return found
+
+    async def handle_metrics(self, request):
+        return self.json_response({
+            'prefetch': self.output_cache.metrics(),
+            'archive': self.archive.metrics() if self.archive.enabled else None,
+            'admission': self.shedder.metrics(),
+            'orphans': {**self.orphan_stats,
+                        'gpu_seconds_reclaimed': round(self.orphan_stats['gpu_seconds_reclaimed'], 1),
+                        'pending_reaps': len(self.orphan_timers)},
+        })
+
+    def check_admin(self, request):
+        """None for a request carrying the admin token, else the 401 response"""
+        header = request.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else request.query.get('token', '')
+        if hmac.compare_digest(token.encode(), self.admin_token.encode()):
+            return None
+        return self.json_response({'error': 'admin token required'}, 401)
+
+    async def handle_debug(self, request):
+        """Loop lag, task and relay census, memory and GC at a glance"""
+        denied = self.check_admin(request)
+        if denied is not None:
+            return denied
+        tasks = task_census()
+        return self.json_response({
+            'uptime_s': round(time.time() - self.started_at),
+            'loop_lag': self.shedder.lag_report(),
+            'tasks': {'total': sum(tasks.values()), 'top': dict(list(tasks.items())[:10])},
+            'relays': self.relay_census(),
+            'threads': threading.active_count(),
+            'gc': {'counts': gc.get_count(), 'collections': [g['collections'] for g in gc.get_stats()]},
+            'memory': {
+                'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+                if resource is not None else None,
+                'tracemalloc': tracemalloc.is_tracing(),
+            },
+        })
+
+    def relay_census(self):
+        relays = list(self.relays.values())
+        return {
+            'sessions': len(relays),
+            'attached': sum(1 for relay in relays if relay.ws is not None),
+            'buffering': sum(1 for relay in relays if relay.ws is None),
+            'upstream_sockets': sum(1 for relay in relays for _, upstream in relay.upstreams if not upstream.closed),
+            'upstream_tasks': sum(1 for relay in relays for task in relay.tasks if not task.done()),
+            'buffered_events': sum(len(relay.buffer) for relay in relays),
+        }
+
+    async def handle_debug_tasks(self, request):
+        """asyncio tasks by coroutine; ?detail=1 splits them by where they are suspended"""
+        denied = self.check_admin(request)
+        if denied is not None:
+            return denied
+        return self.json_response({
+            'tasks': task_census(detail=request.query.get('detail') == '1'),
+            'relays': self.relay_census(),
+        })
+
+    async def handle_debug_memory(self, request):
+        """
+        The first call starts tracemalloc; each later call returns the top
+        allocation growth since the previous one. ?stop=1 stops tracing.
+        """
+        denied = self.check_admin(request)
+        if denied is not None:
+            return denied
+        if request.query.get('stop') == '1':
+            tracemalloc.stop()
+            self.memory_baseline = None
+            return self.json_response({'tracing': False})
+        try:
+            frames = int(request.query.get('frames', 1))
+            limit = int(request.query.get('limit', 25))
+        except ValueError:
+            frames = limit = 0
+        if not 0 < frames <= 100 or limit <= 0:
+            return self.json_response({'error': 'frames must be between 1 and 100 and limit at least 1'}, 400)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.memory_baseline = memory_snapshot()
+            return self.json_response({'tracing': True, 'started': True})
+
+        group = 'traceback' if request.query.get('group') == 'traceback' else 'lineno'
+        snapshot = memory_snapshot()
+        diff = snapshot.compare_to(self.memory_baseline, group) if self.memory_baseline else []
+        self.memory_baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return self.json_response({
+            'tracing': True,
+            'traced_mb': round(current / 1024 ** 2, 2),
+            'peak_mb': round(peak / 1024 ** 2, 2),
+            'growth': [{
+                'where': [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                'size_diff_kb': round(stat.size_diff / 1024, 1),
+                'size_kb': round(stat.size / 1024, 1),
+                'count_diff': stat.count_diff,
+            } for stat in diff[:limit]],
+        })
+
+    async def handle_debug_profile(self, request):
+        """
+        Sample the event loop thread for ?seconds=N (default 5, at most 60).
+        Returns folded stacks for flame graph tools, or ?format=top for JSON.
+        """
+        denied = self.check_admin(request)
+        if denied is not None:
+            return denied
+        try:
+            seconds = float(request.query.get('seconds', 5))
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= 60:
+            return self.json_response({'error': 'seconds must be between 0 and 60'}, 400)
+        if self.sampler is not None:
+            return self.json_response({'error': 'a profile is already being captured'}, 409)
+
+        self.sampler = sampler = StackSampler(self.loop_thread)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, sampler.stop)
+            self.sampler = None
+        if request.query.get('format') == 'top':
+            return self.json_response(sampler.top())
+        return self.add_cors_headers(web.Response(text=sampler.folded()))
+
+    def estimate(self, prompt_id, backend=None):
+        fallback = self.expected_run_time(backend) or None
+        return self.estimator.estimate(self.prompt_shapes.get(prompt_id), fallback)
+
+    def queue_etas(self):
+        """
+        Seconds until each known prompt finishes and until each backend's
+        queue drains, from learned run times. None where nothing is known yet.
+        """
+        now = time.monotonic()
+        etas = {}
+        drain = {}
+        for backend in self.backends:
+            outstanding = [prompt_id for prompt_id in self.scheduler.prompt_owners
+                           if self.scheduler.prompt_backends.get(prompt_id) is backend]
+            if backend.queue_remaining is not None:
+                # Entries whose completion this proxy never saw are the oldest; ComfyUI's count wins
+                outstanding = outstanding[len(outstanding) - backend.queue_remaining:] \
+                    if backend.queue_remaining < len(outstanding) else outstanding
+            clock = 0.0
+            for prompt_id in outstanding:
+                estimate = self.estimate(prompt_id, backend)
+                if estimate is None:
+                    clock = None
+                    break
+                started = self.profiler.running_since(prompt_id)
+                clock += max(estimate - (now - started), 0.0) if started is not None else estimate
+                etas[prompt_id] = round(clock, 1)
+            # Prompts queued on the backend by someone else
+            unknown = max((backend.queue_remaining or 0) - len(outstanding), 0)
+            if clock is not None and unknown:
+                typical = self.expected_run_time(backend)
+                clock = clock + unknown * typical if typical else None
+            drain[backend] = clock
+
+        # Held prompts go to whichever backend frees up first
+        complete = True
+        for job in self.scheduler.queue.order():
+            ready = [b for b in self.backends if b.available and drain[b] is not None]
+            backend = min(ready, key=lambda b: drain[b], default=None)
+            estimate = self.estimate(job.prompt_id, backend) if backend is not None else None
+            if estimate is None:
+                complete = False
+                break
+            drain[backend] += estimate
+            etas[job.prompt_id] = round(drain[backend], 1)
+
+        known = [clock for backend, clock in drain.items() if backend.available and clock is not None]
+        queue_eta = round(min(known), 1) if known and complete else None
+        return etas, {backend.url: None if clock is None else round(clock, 1)
+                      for backend, clock in drain.items()}, queue_eta
+
+    def exec_info(self):
+        """Queue state for relayed status messages: the whole proxy queue and when a new prompt would start"""
+        _, _, queue_eta = self.queue_etas()
+        return {'queue_remaining': self.scheduler.queue_remaining(), 'queue_eta': queue_eta}
+
+    def status_exec_info(self, backend, text):
+        """
+        exec_info for a backend status broadcast. Every relay receives the same
+        message at once, so the queue ETA is worked out for the first one only.
+        """
+        now = time.monotonic()
+        cached = self.relayed_status.get(backend)
+        if cached is not None and cached[0] == text and now - cached[1] < 1.0:
+            return cached[2]
+        info = self.exec_info()
+        self.relayed_status[backend] = (text, now, info)
+        return info
+
+    async def handle_eta(self, request):
+        """Estimated seconds until prompts finish; filter with ?prompt_id= or ?clientId="""
+        etas, backends, queue_eta = self.queue_etas()
+        prompt_id = request.query.get('prompt_id')
+        client_id = request.query.get('clientId')
+        if prompt_id:
+            etas = {prompt_id: etas.get(prompt_id)}
+        elif client_id:
+            owned = {job.prompt_id for _, job in self.scheduler.positions(client_id)}
+            owned.update(p for p, owner in self.scheduler.prompt_owners.items() if owner == client_id)
+            etas = {p: eta for p, eta in etas.items() if p in owned}
+        return self.json_response({'queue_eta': queue_eta, 'backends': backends, 'prompts': etas})
+
+    def watch_orphans(self, client_id):
+        """Reap client_id's prompts unless it reconnects within orphan_grace seconds"""
+        if self.orphan_grace <= 0 or client_id in self.orphan_timers:
+            return
+        loop = asyncio.get_running_loop()
+        self.orphan_timers[client_id] = loop.call_later(
+            self.orphan_grace, lambda: asyncio.ensure_future(self.reap_orphans(client_id)))
+
+    def cancel_orphan_watch(self, client_id):
+        timer = self.orphan_timers.pop(client_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def reap_orphans(self, client_id):
+        """Drop the held prompts of a client that never came back and cancel its queued ones"""
+        self.orphan_timers.pop(client_id, None)
+        relay = self.relays.get(client_id)
+        if relay is not None and relay.ws is not None:
+            return
+
+        owned = {prompt_id for prompt_id, owner in self.scheduler.prompt_owners.items()
+                 if owner == client_id}
+        held = [job.prompt_id for _, job in self.scheduler.positions(client_id)]
+        reclaimed = 0.0
+        for job in self.scheduler.queue.remove(set(held)):
+            reclaimed += self.expected_run_time(None)
+            self.orphan_stats['held_dropped'] += 1
+
+        cancelled = self.orphan_stats['prompts_deleted'] + self.orphan_stats['prompts_interrupted']
+        by_backend = {}
+        for prompt_id in owned:
+            backend = self.scheduler.prompt_backends.get(prompt_id)
+            if backend is not None:
+                by_backend.setdefault(backend, set()).add(prompt_id)
+        for backend, prompt_ids in by_backend.items():
+            try:
+                reclaimed += await self.cancel_prompts(backend, prompt_ids)
+            except Exception as e:
+                logger.warning(f"Could not cancel orphaned prompts on {backend.url}: {e}")
+
+        for prompt_id in owned:
+            self.scheduler.prompt_owners.pop(prompt_id, None)
+        cancelled = self.orphan_stats['prompts_deleted'] + self.orphan_stats['prompts_interrupted'] - cancelled
+        if held or cancelled:
+            self.orphan_stats['clients_reaped'] += 1
+            self.orphan_stats['gpu_seconds_reclaimed'] += reclaimed
+            logger.info(f"Client {client_id} gone for {self.orphan_grace:g}s; cancelled "
+                        f"{len(held)} held and {cancelled} queued prompts (~{reclaimed:.0f} GPU-s)")
+
+    async def cancel_prompts(self, backend, prompt_ids):
+        """Delete prompt_ids from a backend's queue (and interrupt the running one if enabled). Returns GPU-seconds saved"""
+        async with self.http.get(f"{backend.url}/queue") as resp:
+            queue = await resp.json()
+        pending = [item[1] for item in queue.get('queue_pending', []) if item[1] in prompt_ids]
+        running = [item[1] for item in queue.get('queue_running', []) if item[1] in prompt_ids]
+
+        reclaimed = 0.0
+        if pending:
+            async with self.http.post(f"{backend.url}/queue", json={'delete': pending}) as resp:
+                resp.raise_for_status()
+            reclaimed += len(pending) * self.expected_run_time(backend)
+            self.orphan_stats['prompts_deleted'] += len(pending)
+        if running and self.orphan_interrupt:
+            # Newer ComfyUI only interrupts when prompt_id is the one running
+            async with self.http.post(f"{backend.url}/interrupt", json={'prompt_id': running[0]}) as resp:
+                resp.raise_for_status()
+            started = self.profiler.running_since(running[0])
+            elapsed = time.monotonic() - started if started is not None else 0.0
+            reclaimed += max(self.expected_run_time(backend) - elapsed, 0.0)
+            self.orphan_stats['prompts_interrupted'] += 1
+        return reclaimed
+
+    def expected_run_time(self, backend):
+        """Typical prompt duration on backend (or across backends), 0 until one has been timed"""
+        if backend is not None and backend.execution_time is not None:
+            return backend.execution_time
+        times = [b.execution_time for b in self.backends if b.execution_time is not None]
+        return sum(times) / len(times) if times else 0.0
+
+    async def push_results(self, relay, backend, data):
+        """Send the files of an `executed` event to its client, saving the /history and /view round trips"""
+        files = [(kind, item) for kind, items in (data.get('output') or {}).items()
+                 if isinstance(items, list) for item in items
+                 if isinstance(item, dict) and 'filename' in item]
+        if not files:
+            return
+        started = time.perf_counter()
+        outputs = await asyncio.gather(*(self.fetch_result(backend, kind, item) for kind, item in files))
+        await relay.publish(json.dumps({'type': 'aircomfy_result', 'data': {
+            'prompt_id': data.get('prompt_id'),
+            'node': data.get('node'),
+            'outputs': outputs,
+        }}, separators=(',', ':')))
+        logger.debug(f"Pushed {len(outputs)} outputs to {relay.client_id} "
+                     f"in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    async def fetch_result(self, backend, kind, item):
+        key = ('view', item['filename'], item.get('subfolder', ''), item.get('type', 'output'))
+        query = urlencode({'filename': key[1], 'subfolder': key[2], 'type': key[3]})
+        entry = {'kind': kind, **item, 'url': f"/view?{query}"}
+        try:
+            # Shares the prefetch download when the cache or archive is on
+            if self.archive.enabled:
+                archived = await self.archive.fetch(key[1:], backend.url, lambda: self.load_view(backend, key))
+                if archived is not None:
+                    path, record = archived
+                    content = await asyncio.get_running_loop().run_in_executor(None, read_file, path)
+                    cached = CachedResponse(content, record['mime'])
+                else:
+                    cached = await self.load_view(backend, key)
+            else:
+                cached = await self.output_cache.fetch(key, lambda: self.load_view(backend, key))
+                if cached is None:
+                    cached = await self.load_view(backend, key)
+        except Exception as e:
+            logger.warning(f"Could not fetch {item['filename']} for push: {e}")
+            return entry
+        if cached is None:
+            return entry
+        content, mime = cached.body, cached.content_type
+
+        entry.update(mime=mime, size=len(content))
+        if Image is not None and mime.startswith('image/'):
+            thumbnail = await asyncio.get_running_loop().run_in_executor(
+                None, make_thumbnail, content, self.push_thumbnail_size)
+            if thumbnail is not None:
+                entry.update(inline=data_url('image/jpeg', thumbnail), thumbnail=True)
+                return entry
+        if len(content) <= self.push_inline_limit:
+            entry.update(inline=data_url(mime, content), thumbnail=False)
+        return entry
+
+    async def proxy_request(self, request, body=None):
         path = request.path
         method = request.method
+        timing = request[TIMING_KEY]
+
+        if self.archive.enabled:
+            response = await self.serve_archived(request)
+            if response is not None:
+                return response
+
+        key = cache_key(request) if self.output_cache.enabled else None
+        if key is not None:
+            started = time.perf_counter()
+            cached = await self.output_cache.get(key)
+            timing.since('cache', started)
+            if cached is not None:
+                if if_none_match(request, cached.headers.get('ETag')):
+                    response = web.Response(status=304, headers={'ETag': cached.headers['ETag']})
+                else:
+                    response = web.Response(body=cached.body, content_type=cached.content_type,
+                                            headers=cached.headers)
+                return self.add_cors_headers(response)
+
+        backend = self.backend_for(request)
+        if not backend.available:
+            return self.unavailable(backend)
 
         # Build target URL
-        target_url = f"{self.comfyui_url}{path}"
+        target_url = f"{backend.url}{path}"
         if request.query_string:
             target_url += f"?{request.query_string}"
 
         try:
-            async with ClientSession() as session:
-                # Forward headers (except host)
-                headers = {k: v for k, v in request.headers.items()
-                          if k.lower() not in ['host', 'origin']}
+            headers = forward_headers(request)
 
-                # Handle request body
-                data = None
-                if method in ['POST', 'PUT', 'PATCH']:
-                    data = await request.read()
+            # Handle request body
+            data = body
+            if data is None and method in ['POST', 'PUT', 'PATCH']:
+                started = time.perf_counter()
+                data = await request.read()
+                timing.since('read', started)
 
-                async with session.request(method, target_url,
-                                         headers=headers, data=data) as resp:
-                    # Read response
-                    body = await resp.read()
+            # The shared session reuses pooled connections to the backend
+            requested = time.perf_counter()
+            async with self.http.request(method, target_url, headers=headers, data=data,
+                                         trace_request_ctx=timing) as resp:
+                # Time to first byte, excluding connection setup
+                timing.add('ttfb', time.perf_counter() - requested - timing.phases.get('connect', 0.0))
 
-                    # Create response
-                    response = web.Response(
-                        body=body,
-                        status=resp.status,
-                        headers=dict(resp.headers)
-                    )
+                # Read response
+                started = time.perf_counter()
+                body = await resp.read()
+                timing.since('transfer', started)
 
-                    return self.add_cors_headers(response)
+                # Create response; the body is already decoded and will be reframed
+                response = web.Response(
+                    body=body,
+                    status=resp.status,
+                    headers={k: v for k, v in resp.headers.items() if k.lower() not in RESPONSE_FRAMING_HEADERS}
+                )
 
+                backend.record_success()
+                if self.archive.enabled and resp.status == 200:
+                    # Outputs fetched before the proxy saw them finish are archived on first download
+                    key = cache_key(request)
+                    if key is not None and key[0] == 'view':
+                        asyncio.ensure_future(self.archive_download(
+                            key[1:], backend, body, resp.content_type, resp.headers.get('Content-Disposition')))
+                return self.add_cors_headers(response)
+
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            backend.record_failure(e)
+            logger.error(f"Upstream {backend.url} failed: {e}")
+            return self.json_response({'error': f'ComfyUI backend {backend.url} failed: {e}'}, 502)
         except Exception as e:
             logger.error(f"Proxy error: {e}")
             response = web.json_response(
@@ -72,82 +2592,169 @@ class ComfyUIProxy:
             )
             return self.add_cors_headers(response)
 
+    async def serve_archived(self, request):
+        """FileResponse for an archived /view, so the kernel sends it and the backend may be offline"""
+        key = cache_key(request)
+        if key is None or key[0] != 'view':
+            return None
+        started = time.perf_counter()
+        owner = self.output_backends.get(key[1:])
+        refresh = self.archive.pending.get((owner.url, *key[1:])) if owner is not None else None
+        if refresh is not None:
+            # The file was just rewritten; the archived copy may still be the old one
+            await asyncio.shield(refresh)
+        archived = self.archive.lookup(key[1:], owner.url if owner is not None else None)
+        request[TIMING_KEY].since('archive', started)
+        if archived is None:
+            return None
+        path, record = archived
+        headers = {'Content-Type': record['mime']}
+        if 'disposition' in record:
+            headers['Content-Disposition'] = record['disposition']
+        return self.add_cors_headers(web.FileResponse(path, headers=headers))
+
+    async def archive_download(self, file_key, backend, body, content_type, disposition):
+        # Only the first download is archived; later runs that rewrite the file refresh it on `executed`
+        if (backend.url, *file_key) in self.archive.entries:
+            return
+        try:
+            await self.archive.store(file_key, backend.url, body, content_type, disposition)
+        except OSError as e:
+            self.archive.stats['store_failed'] += 1
+            logger.warning(f"Archiving {file_key[0]} failed: {e}")
+
     async def handle_websocket(self, request):
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(heartbeat=30)
         await ws.prepare(request)
 
         client_id = request.query.get('clientId', 'unknown')
-        logger.info(f"WebSocket connection from client {client_id}")
-
-        # Connect to ComfyUI WebSocket
-        try:
-            comfyui_ws_url = self.comfyui_url.replace('http', 'ws') + f"/ws?clientId={client_id}"
-
-            async with ClientSession() as session:
-                async with session.ws_connect(comfyui_ws_url) as comfyui_ws:
-                    # Store connections
-                    self.websocket_connections[client_id] = (ws, comfyui_ws)
-
-                    # Forward messages both ways
-                    async def forward_to_client():
-                        async for msg in comfyui_ws:
-                            if msg.type == WSMsgType.TEXT:
-                                await ws.send_str(msg.data)
-                            elif msg.type == WSMsgType.BINARY:
-                                await ws.send_bytes(msg.data)
-                            elif msg.type == WSMsgType.ERROR:
-                                logger.error(f'ComfyUI WS error: {comfyui_ws.exception()}')
-                                break
-
-                    async def forward_to_comfyui():
-                        async for msg in ws:
-                            if msg.type == WSMsgType.TEXT:
-                                await comfyui_ws.send_str(msg.data)
-                            elif msg.type == WSMsgType.BINARY:
-                                await comfyui_ws.send_bytes(msg.data)
-                            elif msg.type == WSMsgType.ERROR:
-                                logger.error(f'Client WS error: {ws.exception()}')
-                                break
-
-                    # Run both forwarding tasks concurrently
-                    await asyncio.gather(
-                        forward_to_client(),
-                        forward_to_comfyui(),
-                        return_exceptions=True
-                    )
+        last_seq = request.query.get('lastSeq')
+        sequenced = 'resume' in request.query or last_seq is not None
+        try:
+            last_seq = int(last_seq) if last_seq is not None else None
+        except ValueError:
+            # Resume as if the client had no position; /history covers what it missed
+            logger.info(f"Ignoring lastSeq={last_seq!r} from client {client_id}")
+            last_seq = None
+
+        # Reattach to a relay kept alive since the client's last disconnect
+        relay = self.relays.get(client_id)
+        resumed = relay is not None
+        logger.info(f"WebSocket connection from client {client_id}" + (' (resumed)' if resumed else ''))
+
+        self.cancel_orphan_watch(client_id)
+        try:
+            if relay is None:
+                relay = await self.open_relay(client_id)
+            await relay.attach(ws, sequenced, push=request.query.get('push') == '1')
+            if not relay.tasks:
+                # Start reading only once the client can receive the first events
+                relay.tasks = [asyncio.ensure_future(self.relay_upstream(relay, backend, comfyui_ws))
+                               for backend, comfyui_ws in relay.upstreams]
+            if last_seq is not None:
+                await relay.replay(last_seq, resumed)
+            elif resumed:
+                # A fresh ComfyUI socket would start with the queue status
+                await relay.send_status(self.exec_info())
+
+            async for msg in ws:
+                for _, comfyui_ws in relay.upstreams:
+                    if msg.type == WSMsgType.TEXT:
+                        await comfyui_ws.send_str(msg.data)
+                    elif msg.type == WSMsgType.BINARY:
+                        await comfyui_ws.send_bytes(msg.data)
+                if msg.type == WSMsgType.ERROR:
+                    logger.error(f'Client WS error: {ws.exception()}')
+                    break
 
         except Exception as e:
             logger.error(f"WebSocket proxy error: {e}")
         finally:
-            # Clean up
-            if client_id in self.websocket_connections:
-                del self.websocket_connections[client_id]
-            logger.info(f"WebSocket connection closed for client {client_id}")
+            if relay is not None and relay.detach(ws):
+                self.watch_orphans(client_id)
+                if self.resume_grace > 0 and not relay.closed:
+                    # Keep listening upstream so a reconnect can replay what it missed
+                    relay.expire_in(self.resume_grace, self.close_relay)
+                    logger.info(f"WebSocket client {client_id} detached; "
+                                f"buffering events for {self.resume_grace:g}s")
+                else:
+                    await self.close_relay(relay)
 
         return ws
 
+    async def open_relay(self, client_id):
+        """Subscribe to every backend for client_id, since held prompts may run on any of them"""
+        relay = RelaySession(client_id, buffer_size=self.resume_buffer)
+        relay.http = ClientSession(timeout=self.upstream_timeout)
+        for backend in self.backends:
+            if not backend.available:
+                continue
+            started = time.perf_counter()
+            try:
+                comfyui_ws = await relay.http.ws_connect(f"{backend.ws_url}?clientId={client_id}")
+            except Exception as e:
+                logger.warning(f"Could not open {backend.url} WebSocket for {client_id}: {e}")
+                continue
+            relay.connect_time += time.perf_counter() - started
+            relay.upstreams.append((backend, comfyui_ws))
+
+        if not relay.upstreams:
+            await relay.http.close()
+            raise ConnectionError('no ComfyUI backend accepted the WebSocket')
+
+        self.relays[client_id] = relay
+        return relay
+
+    async def relay_upstream(self, relay, backend, comfyui_ws):
+        try:
+            async for msg in comfyui_ws:
+                received = time.perf_counter()
+                if msg.type == WSMsgType.TEXT:
+                    text, message = self.relay_text(backend, msg.data)
+                    await relay.publish(text)
+                    if relay.push and message is not None and message.get('type') == 'executed':
+                        asyncio.ensure_future(self.push_results(relay, backend, message.get('data') or {}))
+                elif msg.type == WSMsgType.BINARY:
+                    await relay.send_bytes(msg.data)
+                elif msg.type == WSMsgType.ERROR:
+                    logger.error(f'ComfyUI WS error: {comfyui_ws.exception()}')
+                    break
+                relay.note_delay(time.perf_counter() - received)
+        finally:
+            # The relay ends once every backend has hung up
+            if all(upstream.closed for _, upstream in relay.upstreams):
+                asyncio.ensure_future(self.close_relay(relay))
+
+    async def close_relay(self, relay):
+        if relay.closed:
+            return
+        await relay.close()
+        if self.relays.get(relay.client_id) is relay:
+            del self.relays[relay.client_id]
+        logger.info(f"WebSocket connection closed for client {relay.client_id}")
+        self.traces.record('ws', relay.elapsed(), client_id=relay.client_id,
+                           connect_ms=round(relay.connect_time * 1000, 2),
+                           messages=relay.messages,
+                           relay_avg_ms=round(relay.delay / relay.messages * 1000, 3) if relay.messages else None,
+                           relay_max_ms=round(relay.max_delay * 1000, 3))
+
     async def serve_static(self, request):
         """Serve static PWA files"""
         file_path = request.path.lstrip('/')
         if file_path == '' or file_path == '/':
             file_path = 'index.html'
 
-        static_files = {
-            'index.html': 'text/html',
-            'style.css': 'text/css',
-            'manifest.json': 'application/json',
-            'sw.js': 'application/javascript',
-            'icon-192.png': 'image/png'
-        }
-
-        if file_path in static_files:
+        hashed = HASHED_ASSET.match(file_path)
+        if file_path in STATIC_FILES or hashed:
             try:
-                with open(file_path, 'rb') as f:
+                with open(os.path.join(self.static_dir, file_path), 'rb') as f:
                     content = f.read()
                 response = web.Response(
                     body=content,
-                    content_type=static_files[file_path]
+                    content_type=STATIC_FILES.get(file_path) or ASSET_TYPES[hashed.group(1)]
                 )
+                # A hashed name never changes content; everything else is revalidated
+                response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if hashed else 'no-cache'
                 return self.add_cors_headers(response)
             except FileNotFoundError:
                 pass
@@ -155,34 +2762,134 @@ class ComfyUIProxy:
         # If not a static file, proxy to ComfyUI
         return await self.proxy_request(request)
 
-def create_app(comfyui_url):
-    proxy = ComfyUIProxy(comfyui_url)
-    app = web.Application()
+def create_app(comfyui_url, **proxy_options):
+    proxy = ComfyUIProxy(comfyui_url, **proxy_options)
+    app = web.Application(middlewares=[proxy.timing_middleware, proxy.admission_middleware])
 
     # WebSocket route
     app.router.add_get('/ws', proxy.handle_websocket)
 
+    # Prompt submission (validated, then fairly scheduled)
+    app.router.add_post('/prompt', proxy.handle_prompt)
+    app.router.add_get('/aircomfy/queue', proxy.handle_queue_status)
+
+    # Cached health checks
+    app.router.add_get('/aircomfy/health', proxy.handle_health)
+    app.router.add_get('/system_stats', proxy.handle_system_stats)
+    app.router.add_get('/aircomfy/metrics', proxy.handle_metrics)
+    app.router.add_get('/aircomfy/profile', proxy.handle_profile)
+    app.router.add_get('/aircomfy/eta', proxy.handle_eta)
+    app.router.add_post('/aircomfy/history/bulk', proxy.handle_history_bulk)
+    app.router.add_put('/aircomfy/templates', proxy.handle_template_put)
+    app.router.add_post('/aircomfy/templates/{hash}/run', proxy.handle_template_run)
+
+    # Admin-only runtime diagnostics
+    if proxy.admin_token:
+        app.router.add_get('/debug', proxy.handle_debug)
+        app.router.add_get('/debug/tasks', proxy.handle_debug_tasks)
+        app.router.add_get('/debug/memory', proxy.handle_debug_memory)
+        app.router.add_get('/debug/profile', proxy.handle_debug_profile)
+
     # CORS preflight
     app.router.add_route('OPTIONS', '/{path:.*}', proxy.handle_preflight)
 
     # All other routes (static files + API proxy)
     app.router.add_route('*', '/{path:.*}', proxy.serve_static)
 
+    app.on_startup.append(proxy.start)
+    app.on_cleanup.append(proxy.stop)
+
     return app
 
 def main():
     parser = argparse.ArgumentParser(description='ComfyUI CORS Proxy')
     parser.add_argument('--port', type=int, default=8080,
                        help='Proxy server port (default: 8080)')
-    parser.add_argument('--comfyui', default='http://localhost:8188',
-                       help='ComfyUI server URL (default: http://localhost:8188)')
+    parser.add_argument('--comfyui', action='append',
+                       help='ComfyUI server URL, repeat for several backends (default: http://localhost:8188)')
+    parser.add_argument('--no-validate', action='store_true',
+                       help='Forward /prompt without checking it against node schemas')
+    parser.add_argument('--no-optimize', action='store_true',
+                       help='Forward /prompt graphs as-is instead of pruning unreachable nodes')
+    parser.add_argument('--schema-ttl', type=int, default=300,
+                       help='Seconds before cached /object_info is refreshed (default: 300)')
+
+    parser.add_argument('--max-outstanding', type=int, default=2,
+                       help='Prompts kept queued on each backend; the rest wait in the proxy (default: 2)')
+    parser.add_argument('--health-interval', type=float, default=5.0,
+                       help='Seconds between backend health probes (default: 5)')
+    parser.add_argument('--connect-timeout', type=float, default=3.0,
+                       help='Seconds to wait when connecting to a backend (default: 3)')
+    parser.add_argument('--resume-grace', type=float, default=120.0,
+                       help='Seconds to keep a disconnected client\'s events for replay; 0 disables (default: 120)')
+    parser.add_argument('--resume-buffer', type=int, default=256,
+                       help='Events buffered per client for replay (default: 256)')
+    parser.add_argument('--push-inline-limit', type=int, default=128 * 1024,
+                       help='Largest output (bytes) inlined in pushed results when Pillow is unavailable (default: 131072)')
+    parser.add_argument('--prefetch-bytes', type=int, default=128 * 1024 * 1024,
+                       help='Memory budget for outputs fetched ahead of the client; 0 disables (default: 134217728)')
+    parser.add_argument('--prefetch-concurrency', type=int, default=4,
+                       help='Parallel prefetch downloads (default: 4)')
+    parser.add_argument('--orphan-grace', type=float, default=0,
+                       help='Cancel a disconnected client\'s queued prompts after this many seconds; 0 disables (default: 0)')
+    parser.add_argument('--orphan-interrupt', action='store_true',
+                       help='Also interrupt an orphaned prompt that is already running')
+    parser.add_argument('--archive-dir',
+                       help='Keep output files in this directory, by content hash, and serve /view from it')
+    parser.add_argument('--archive-bytes', type=int, default=10 * 1024 ** 3,
+                       help='Disk budget for the output archive; least recently used files go first (default: 10737418240)')
+    parser.add_argument('--limit', action='append', default=[], metavar='FAMILY=N',
+                       help='In-flight request cap for a route family (prompt, api, static); '
+                            'repeatable (default: prompt=32 api=64 static=64)')
+    parser.add_argument('--max-websockets', type=int, default=256,
+                       help='Open client WebSockets before new ones are refused; resumes always pass (default: 256)')
+    parser.add_argument('--shed-lag', type=float, default=0.25,
+                       help='Refuse non-critical requests while event-loop lag exceeds this many seconds; 0 disables (default: 0.25)')
+    parser.add_argument('--admin-token', default=os.environ.get('AIRCOMFY_ADMIN_TOKEN'),
+                       help='Enable /debug diagnostics for requests bearing this token (default: $AIRCOMFY_ADMIN_TOKEN)')
+    parser.add_argument('--static-dir', default='.',
+                       help='Directory the PWA is served from, e.g. PWA/dist after build_pwa.py (default: .)')
+    parser.add_argument('--trace-file',
+                       help='Write sampled per-request trace records (JSON lines) to this rotating file')
+    parser.add_argument('--trace-sample', type=float, default=0.01,
+                       help='Fraction of requests to trace; slow ones are always traced (default: 0.01)')
+    parser.add_argument('--trace-slow', type=float, default=1.0,
+                       help='Requests slower than this many seconds are always traced (default: 1)')
 
     args = parser.parse_args()
+    try:
+        request_limits = {family: int(limit) for family, limit in (item.split('=', 1) for item in args.limit)}
+    except ValueError:
+        parser.error('--limit takes FAMILY=N, e.g. --limit api=32')
+    comfyui_urls = args.comfyui or ['http://localhost:8188']
 
-    app = create_app(args.comfyui)
+    app = create_app(comfyui_urls,
+                     validate=not args.no_validate,
+                     schema_ttl=args.schema_ttl,
+                     optimize=not args.no_optimize,
+                     max_outstanding=args.max_outstanding,
+                     health_interval=args.health_interval,
+                     connect_timeout=args.connect_timeout,
+                     trace_file=args.trace_file,
+                     trace_sample=args.trace_sample,
+                     trace_slow=args.trace_slow,
+                     resume_grace=args.resume_grace,
+                     resume_buffer=args.resume_buffer,
+                     push_inline_limit=args.push_inline_limit,
+                     prefetch_bytes=args.prefetch_bytes,
+                     prefetch_concurrency=args.prefetch_concurrency,
+                     orphan_grace=args.orphan_grace,
+                     orphan_interrupt=args.orphan_interrupt,
+                     request_limits=request_limits,
+                     max_websockets=args.max_websockets,
+                     shed_lag=args.shed_lag,
+                     archive_dir=args.archive_dir,
+                     archive_bytes=args.archive_bytes,
+                     admin_token=args.admin_token,
+                     static_dir=args.static_dir)
 
     logger.info(f"Starting CORS proxy on port {args.port}")
-    logger.info(f"Proxying to ComfyUI at {args.comfyui}")
+    logger.info(f"Proxying to ComfyUI at {', '.join(comfyui_urls)}")
     logger.info(f"Open http://localhost:{args.port} in your browser")
 
     web.run_app(app, host='0.0.0.0', port=args.port)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Unit tests for build_pwa.py. The build runs offline with a stand-in petite-vue.
+Usage: python -m pytest test_build_pwa.py
+"""
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+
+import pytest
+
+import build_pwa
+from build_pwa import (BuildError, FirstViewMarkup, build, critical_css, minify_css, minify_js, petite_vue_source,
+                       worker_file)
+
+
+def test_minify_js_keeps_strings_templates_and_regexes():
+    source = r'''
+        // comment
+        const a = 'x // not a comment', b = "/* nor this */";
+        const re = /^\/history\/[^/]+$/;   /* trailing */
+        const t = `line ${ `${a}/${b}` }  {kept}
+            ${ { k: 1 }.k }`;
+        let c = a + +b, d = c - -1, e = 4 / 2 / 1;
+        return typeof x / 2
+    '''
+    assert minify_js(source) == (
+        "const a='x // not a comment',b=\"/* nor this */\";\n"
+        "const re=/^\\/history\\/[^/]+$/;\n"
+        "const t=`line ${`${a}/${b}`}  {kept}\n            ${{k:1}.k}`;\n"
+        "let c=a+ +b,d=c- -1,e=4/2/1;\n"
+        "return typeof x/2\n"
+    )
+
+
+def test_critical_css_keeps_rules_for_the_first_view():
+    markup = FirstViewMarkup()
+    markup.feed('<body><header class="top"><h1>A</h1></header>'
+                '<div v-if="currentView === \'main\'"><input class="field"></div>'
+                '<div v-if="currentView === \'stats\'"><p class="stat">x</p></div></body>')
+    css = minify_css('''
+        h1, .stat { color: red; }
+        .top > h1:hover { color: blue; }
+        .stat { margin: 0; }
+        input.field:not(:disabled) { width: 1px; }
+        @keyframes pulse { 0% { opacity: 1; } }
+        @media (max-width: 768px) { .stat { padding: 0; } .field { padding: 1px; } }
+        .top:has(.stat:contains("a, b")) { color: green; }
+    ''')
+    assert critical_css(css, markup) == (
+        'h1,.stat{color:red}.top>h1:hover{color:blue}input.field:not(:disabled){width:1px}'
+        '@media (max-width:768px){.field{padding:1px}}.top:has(.stat:contains("a, b")){color:green}'
+    )
+
+
+def test_build_hashes_assets_and_rewrites_precache(tmp_path):
+    petite_vue = tmp_path / 'petite-vue.js'
+    petite_vue.write_text('window.PetiteVue = {};\n')
+    out = tmp_path / 'dist'
+    manifest = build(str(out), str(petite_vue))
+
+    files = manifest['files']
+    for name in ('app.js', 'editor.js', 'workflow-worker.js', 'preview-worker.js', 'style.css', 'petite-vue.js'):
+        assert re.fullmatch(r'assets/[\w-]+\.[0-9a-f]{10}\.(js|css)', files[name]), name
+        assert (out / files[name]).exists()
+
+    html = (out / 'index.html').read_text()
+    assert 'unpkg.com' not in html and '<style>' in html
+    assert f'<script src="{files["app.js"]}" defer></script>' in html
+    assert files['workflow-worker.js'] in (out / files['app.js']).read_text()
+
+    sw = (out / 'sw.js').read_text()
+    precache = json.loads(re.search(r'const CACHE_URLS=(\[.*?\]);', sw).group(1))
+    assert precache == manifest['precache'] and f"./{files['style.css']}" in precache
+    assert json.loads((out / 'asset-manifest.json').read_text()) == manifest
+
+    # Same sources, same names; stale assets from the last build are gone
+    assert build(str(out), str(petite_vue))['files'] == files
+    assert sorted(os.listdir(out / 'assets')) == sorted(os.path.basename(path) for path in files.values()
+                                                       if path.startswith('assets/'))
+
+
+def test_build_leaves_sources_and_other_files_alone(tmp_path):
+    petite_vue = tmp_path / 'petite-vue.js'
+    petite_vue.write_text('window.PetiteVue = {};\n')
+    for out_dir in (build_pwa.PWA_DIR, build_pwa.REPO_DIR, os.path.dirname(build_pwa.REPO_DIR)):
+        with pytest.raises(BuildError, match='Refusing'):
+            build(out_dir, str(petite_vue))
+
+    out = tmp_path / 'site'
+    (out / 'assets').mkdir(parents=True)
+    (out / 'notes.txt').write_text('keep')
+    (out / 'assets' / 'logo.svg').write_text('<svg/>')
+    build(str(out), str(petite_vue))
+    build(str(out), str(petite_vue))
+    assert (out / 'notes.txt').read_text() == 'keep' and (out / 'assets' / 'logo.svg').exists()
+
+
+def test_worker_file_stores_compressed_text_and_plain_images():
+    text = 'body { color: red; }\n' * 50
+    entry = worker_file('assets/style.0123456789.css', text)
+    assert entry['type'].startswith('text/css') and re.fullmatch(r'"[0-9a-f]{16}"', entry['etag'])
+    assert gzip.decompress(base64.b64decode(entry['gzip'])).decode() == text
+    assert 'identity' not in entry
+    assert worker_file('other.css', text)['etag'] == entry['etag']
+
+    png = b'\x89PNG\r\n\x1a\n' + bytes(100)
+    entry = worker_file('icon-192.png', png)
+    assert base64.b64decode(entry['identity']) == png and 'gzip' not in entry and 'br' not in entry
+
+
+def test_petite_vue_is_checked_against_the_pinned_hash(tmp_path, monkeypatch):
+    content = b'window.PetiteVue = {};\n'
+    vendored = tmp_path / 'vendor' / 'petite-vue.js'
+    downloads = []
+
+    def urlopen(url, timeout):
+        downloads.append(url)
+        return io.BytesIO(content)
+    monkeypatch.setattr(build_pwa, 'PETITE_VUE_FILE', str(vendored))
+    monkeypatch.setattr(build_pwa.urllib.request, 'urlopen', urlopen)
+
+    # Without a pin nothing is downloaded unasked
+    monkeypatch.setattr(build_pwa, 'PETITE_VUE_SHA256', '')
+    assert petite_vue_source() is None and downloads == []
+
+    monkeypatch.setattr(build_pwa, 'PETITE_VUE_SHA256', '0' * 64)
+    with pytest.raises(BuildError, match=hashlib.sha256(content).hexdigest()):
+        petite_vue_source()
+    assert not vendored.exists()
+
+    monkeypatch.setattr(build_pwa, 'PETITE_VUE_SHA256', hashlib.sha256(content).hexdigest())
+    assert petite_vue_source() == content.decode() and vendored.read_bytes() == content
+    vendored.write_text('window.PetiteVue = evil();\n')
+    with pytest.raises(BuildError, match='expected'):
+        petite_vue_source()
+
+
+def test_fetched_petite_vue_is_bundled_and_a_missing_one_stays_on_the_cdn(tmp_path, monkeypatch):
+    content = b'window.PetiteVue = {};\n'
+    vendored = tmp_path / 'vendor' / 'petite-vue.js'
+    monkeypatch.setattr(build_pwa, 'PETITE_VUE_FILE', str(vendored))
+    monkeypatch.setattr(build_pwa, 'PETITE_VUE_SHA256', '')
+    monkeypatch.setattr(build_pwa.urllib.request, 'urlopen', lambda url, timeout: io.BytesIO(content))
+
+    manifest = build(str(tmp_path / 'cdn'))
+    assert 'petite-vue.js' not in manifest['files']
+    assert 'https://unpkg.com/petite-vue@' in (tmp_path / 'cdn' / 'index.html').read_text()
+
+    assert build_pwa.fetch_petite_vue() == hashlib.sha256(content).hexdigest()
+    manifest = build(str(tmp_path / 'dist'))
+    assert (tmp_path / 'dist' / manifest['files']['petite-vue.js']).read_bytes() == content
+    assert 'unpkg.com' not in (tmp_path / 'dist' / 'index.html').read_text()
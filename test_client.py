@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the aircomfy client that run without a ComfyUI server.
+Usage: python -m pytest test_client.py
+"""
+
+import asyncio
+import os
+
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from aircomfy import Client, ComfyError, PromptFailed, apply_overrides, output_files
+from aircomfy.batch import BatchRunner, output_path, read_jobs, read_records
+from aircomfy.client import PendingPrompt
+
+
+def test_events_resolve_pending_prompts():
+    async def scenario():
+        client = Client()
+        client._pending['ok'] = PendingPrompt()
+        client._pending['bad'] = PendingPrompt()
+        images = {'images': [{'filename': 'a.png', 'subfolder': '', 'type': 'output'}]}
+        client._handle({'seq': 3, 'type': 'executed', 'data': {'prompt_id': 'ok', 'node': '9', 'output': images}})
+        client._handle({'seq': 4, 'type': 'executing', 'data': {'prompt_id': 'ok', 'node': None}})
+        client._handle({'type': 'execution_error', 'data': {
+            'prompt_id': 'bad', 'node_id': '3', 'node_type': 'KSampler', 'exception_message': 'OOM'}})
+
+        outputs = await client.result('ok')
+        assert [f['filename'] for f in output_files(outputs)] == ['a.png']
+        assert client._last_seq == 4 and 'ok' not in client._pending
+        with pytest.raises(PromptFailed, match='KSampler'):
+            await client.result('bad')
+
+    asyncio.run(scenario())
+
+
+def test_listener_skips_bad_frames_and_its_failure_reaches_waiters(monkeypatch):
+    sockets = set()
+
+    async def handle_websocket(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sockets.add(ws)
+        async for _ in ws:
+            pass
+        sockets.discard(ws)
+        return ws
+
+    async def send(*frames):
+        for ws in sockets:
+            for frame in frames:
+                await ws.send_str(frame)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/ws', handle_websocket)
+        server = TestServer(app)
+        await server.start_server()
+        client = Client(str(server.make_url('')))
+        try:
+            await client.open()
+            client._pending['p1'] = PendingPrompt()
+            await send('not json', '[1, 2]', '{"type": "executing", "data": {"prompt_id": "p1", "node": null}}')
+            assert await client.result('p1', timeout=5) == {}
+
+            def broken(message):
+                raise RuntimeError('handler bug')
+            monkeypatch.setattr(client, '_handle', broken)
+            client._pending['p2'] = PendingPrompt()
+            await send('{"type": "status"}')
+            with pytest.raises(RuntimeError, match='handler bug'):
+                await client.result('p2', timeout=5)
+            # Prompts submitted after the listener died fail too, rather than wait forever
+            client._pending['p3'] = PendingPrompt()
+            with pytest.raises(RuntimeError, match='handler bug'):
+                await client.result('p3', timeout=5)
+        finally:
+            await client.close()
+            for ws in list(sockets):
+                await ws.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+
+def test_open_fails_when_the_listener_dies_before_connecting(monkeypatch):
+    def ws_connect(self, url, **kwargs):
+        raise RuntimeError('no socket')
+    monkeypatch.setattr(ClientSession, 'ws_connect', ws_connect)
+
+    async def scenario():
+        client = Client('http://127.0.0.1:9')
+        with pytest.raises(RuntimeError, match='no socket'):
+            await asyncio.wait_for(client.open(), 5)
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_apply_overrides_rejects_unknown_nodes():
+    workflow = {'3': {'class_type': 'KSampler', 'inputs': {'seed': 1, 'steps': 20}}}
+    assert apply_overrides(workflow, {'3': {'seed': 2}})['3']['inputs'] == {'seed': 2, 'steps': 20}
+    assert workflow['3']['inputs']['seed'] == 1
+    with pytest.raises(ComfyError) as raised:
+        apply_overrides(workflow, {'4': {'seed': 2}})
+    assert raised.value.node_errors['4']['errors'][0]['type'] == 'invalid_override'
+
+
+def test_batch_jobs_and_checkpoint_records(tmp_path):
+    jobs = tmp_path / 'jobs.jsonl'
+    jobs.write_text('{"id": "a", "overrides": {"3": {"seed": 1}}}\n\n{"3": {"seed": 2}}\n')
+    assert list(read_jobs(jobs)) == [('a', {'3': {'seed': 1}}), ('3', {'3': {'seed': 2}})]
+
+    results = tmp_path / 'results.jsonl'
+    results.write_text('{"id": "a", "status": "ok"}\n{"id": "b", "sta')  # cut short by an interrupt
+    assert read_records(results) == [{'id': 'a', 'status': 'ok'}]
+
+
+def test_output_paths_keep_subfolders_and_never_collide():
+    taken = set()
+    items = [{'filename': 'a.png', 'subfolder': ''}, {'filename': 'a.png', 'subfolder': 'upscaled'},
+             {'filename': 'a.png', 'subfolder': '', 'type': 'temp'}, {'filename': 'b.png', 'subfolder': '../../etc'},
+             {'filename': '..', 'subfolder': 'x y'}]
+    assert [output_path(item, taken) for item in items] == [
+        'a.png', os.path.join('upscaled', 'a.png'), 'a_1.png', os.path.join('etc', 'b.png'),
+        os.path.join('x_y', 'output')]
+
+
+def test_batch_records_a_dropped_connection_and_carries_on(tmp_path):
+    sockets = set()
+
+    async def handle_websocket(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sockets.add(ws)
+        async for _ in ws:
+            pass
+        sockets.discard(ws)
+        return ws
+
+    async def finish(prompt_id):
+        images = {'images': [{'filename': f'{prompt_id}.png', 'subfolder': '', 'type': 'output'}]}
+        for ws in sockets:
+            await ws.send_json({'type': 'executed', 'data': {'prompt_id': prompt_id, 'node': '9', 'output': images}})
+            await ws.send_json({'type': 'executing', 'data': {'prompt_id': prompt_id, 'node': None}})
+
+    async def handle_prompt(request):
+        payload = await request.json()
+        if payload['prompt']['3']['inputs']['seed'] == 2:
+            # The backend goes away mid-request
+            request.transport.close()
+            return web.Response()
+        asyncio.get_running_loop().call_later(0.01, asyncio.ensure_future, finish(payload['prompt_id']))
+        return web.json_response({'prompt_id': payload['prompt_id'], 'number': 1, 'node_errors': {}})
+
+    async def handle_view(request):
+        return web.Response(body=b'png', content_type='image/png')
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/ws', handle_websocket)
+        app.router.add_post('/prompt', handle_prompt)
+        app.router.add_get('/view', handle_view)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            workflow = {'3': {'class_type': 'KSampler', 'inputs': {'seed': 0}}}
+            runner = BatchRunner(str(server.make_url('')), workflow, str(tmp_path), concurrency=1)
+            jobs = [(job_id, {'3': {'seed': seed}}) for job_id, seed in (('a', 1), ('b', 2), ('c', 3))]
+            return await runner.run(jobs)
+        finally:
+            for ws in list(sockets):
+                await ws.close()
+            await server.close()
+
+    summary = asyncio.run(scenario())
+    assert summary['done'] == 2 and summary['failed'] == 1
+    records = {r['id']: r for r in read_records(tmp_path / 'results.jsonl')}
+    assert records['a']['status'] == records['c']['status'] == 'ok'
+    assert records['b']['status'] == 'failed' and 'disconnected' in records['b']['error']
+    assert (tmp_path / 'c' / f"{records['c']['prompt_id']}.png").read_bytes() == b'png'
@@ -0,0 +1,915 @@
+#!/usr/bin/env python3
+"""
+Unit tests for proxy.py that run without a browser or a ComfyUI server.
+Usage: python -m pytest test_proxy.py
+"""
+
+import asyncio
+import base64
+import copy
+import hashlib
+import json
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestClient, TestServer
+
+import proxy
+from proxy import (Backend, CachedResponse, DeficitRoundRobin, FairScheduler, NodeProfiler, OutputArchive,
+                   OutputCache, PhaseTimer, QueuedPrompt, RelaySession, RuntimeEstimator, StackSampler, TraceLog,
+                   apply_overrides, create_app, graph_shape, optimize_prompt, validate_prompt)
+
+with open('SD15-basicT2I.json') as f:
+    SD15_WORKFLOW = json.load(f)
+
+# Trimmed /object_info for the nodes used by SD15-basicT2I.json
+SCHEMAS = {
+    'CheckpointLoaderSimple': {
+        'input': {'required': {'ckpt_name': [['v1-5-pruned-emaonly.safetensors']]}},
+        'output': ['MODEL', 'CLIP', 'VAE'],
+        'output_node': False,
+    },
+    'EmptyLatentImage': {
+        'input': {'required': {'width': ['INT', {}], 'height': ['INT', {}], 'batch_size': ['INT', {}]}},
+        'output': ['LATENT'],
+        'output_node': False,
+    },
+    'CLIPTextEncode': {
+        'input': {'required': {'text': ['STRING', {'multiline': True}], 'clip': ['CLIP']}},
+        'output': ['CONDITIONING'],
+        'output_node': False,
+    },
+    'KSampler': {
+        'input': {'required': {
+            'model': ['MODEL'], 'seed': ['INT', {}], 'steps': ['INT', {}], 'cfg': ['FLOAT', {}],
+            'sampler_name': [['euler', 'euler_ancestral']], 'scheduler': [['normal', 'karras']],
+            'positive': ['CONDITIONING'], 'negative': ['CONDITIONING'],
+            'latent_image': ['LATENT'], 'denoise': ['FLOAT', {}],
+        }},
+        'output': ['LATENT'],
+        'output_node': False,
+    },
+    'VAEDecode': {
+        'input': {'required': {'samples': ['LATENT'], 'vae': ['VAE']}},
+        'output': ['IMAGE'],
+        'output_node': False,
+    },
+    'SaveImage': {
+        'input': {'required': {'images': ['IMAGE'], 'filename_prefix': ['STRING', {}]}},
+        'output': [],
+        'output_node': True,
+    },
+}
+
+
+def error_types(node_errors, node_id):
+    return [e['type'] for e in node_errors[node_id]['errors']]
+
+
+class FakeComfyUI:
+    """ComfyUI stand-in on a local port that records the requests reaching it"""
+
+    def __init__(self):
+        self.requests = []
+        self.queue = {'queue_running': [], 'queue_pending': []}
+        # prompt_id -> entry, oldest first like ComfyUI's own history
+        self.history = {}
+        # Paths answered with a 500, and paths with a handler of their own
+        self.failing = set()
+        self.handlers = {}
+        # Bytes of outputs written again under their name; others read b'image:<filename>'
+        self.files = {}
+        # Open /ws connections and the clientId of each
+        self.sockets = {}
+        app = web.Application()
+        app.router.add_get('/ws', self.handle_websocket)
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        app.on_shutdown.append(self.close_sockets)
+        self.server = TestServer(app)
+
+    @property
+    def url(self):
+        return str(self.server.make_url('')).rstrip('/')
+
+    def requested(self, method, path):
+        return [body for m, p, body in self.requests if (m, p) == (method, path)]
+
+    async def handle_websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[ws] = request.query.get('clientId')
+        queue_remaining = len(self.queue['queue_running']) + len(self.queue['queue_pending'])
+        await ws.send_json({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': queue_remaining}}}})
+        async for _ in ws:
+            pass
+        self.sockets.pop(ws, None)
+        return ws
+
+    async def close_sockets(self, app):
+        for ws in list(self.sockets):
+            await ws.close()
+
+    async def send(self, client_id, message):
+        """Send message on the WebSockets of client_id, like ComfyUI's per-client events"""
+        for ws, owner in list(self.sockets.items()):
+            if owner == client_id:
+                await ws.send_json(message)
+
+    async def broadcast(self, message):
+        """Send message on every WebSocket, like ComfyUI's status updates"""
+        for ws in list(self.sockets):
+            await ws.send_json(message)
+
+    async def handle(self, request):
+        body = await request.json() if request.can_read_body else None
+        self.requests.append((request.method, request.path, body))
+        if request.path in self.failing:
+            return web.Response(status=500, text='Internal Server Error')
+        if request.path in self.handlers:
+            return await self.handlers[request.path](request)
+        if request.path == '/system_stats':
+            return web.json_response({'system': {}, 'devices': []})
+        if request.path == '/object_info':
+            return web.json_response(SCHEMAS)
+        if request.path == '/queue':
+            return web.json_response(self.queue if request.method == 'GET' else {})
+        if request.path == '/prompt':
+            self.queue['queue_pending'].append([len(self.requests), body['prompt_id'], body['prompt'], {}, []])
+            return web.json_response({'prompt_id': body['prompt_id'], 'number': 1, 'node_errors': {}})
+        if request.path == '/history':
+            recent = list(self.history.items())[-int(request.query.get('max_items', 200)):]
+            return web.json_response(dict(recent))
+        if request.path == '/view':
+            filename = request.query['filename']
+            body = self.files.get(filename, b'image:' + filename.encode())
+            etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+            if request.headers.get('If-None-Match') == etag:
+                return web.Response(status=304, headers={'ETag': etag})
+            return web.Response(body=body, content_type='image/png', headers={'ETag': etag})
+        if request.path.startswith('/history/'):
+            prompt_id = request.path[len('/history/'):]
+            return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+        return web.Response(status=404)
+
+
+@asynccontextmanager
+async def proxy_for(comfyui, *more, **options):
+    """A started proxy in front of comfyui (and more backends), as a test client"""
+    backends = [comfyui, *more]
+    for backend in backends:
+        await backend.server.start_server()
+    options = {'validate': False, 'optimize': False, **options}
+    client = TestClient(TestServer(create_app([backend.url for backend in backends], **options)))
+    await client.start_server()
+    try:
+        # Prompts are only released once the queue monitor has heard from the backend
+        for _ in range(100):
+            status = await (await client.get('/aircomfy/queue')).json()
+            if status['backends'][0]['queue_remaining'] is not None:
+                break
+            await asyncio.sleep(0.02)
+        yield client
+    finally:
+        await client.close()
+        for backend in backends:
+            await backend.server.close()
+
+
+async def submit(client, client_id, prompt_id):
+    prompt = {'1': {'class_type': 'SaveImage', 'inputs': {}}}
+    resp = await client.post('/prompt', json={'prompt': prompt, 'client_id': client_id, 'prompt_id': prompt_id})
+    assert resp.status == 200
+
+
+def test_valid_workflow_passes():
+    error, node_errors = validate_prompt(SD15_WORKFLOW, SCHEMAS)
+    assert error is None
+    assert node_errors == {}
+
+
+def test_unknown_class_type():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    prompt['8']['class_type'] = 'VAEDecodeTiledTypo'
+    error, node_errors = validate_prompt(prompt, SCHEMAS)
+    assert error['type'] == 'prompt_outputs_failed_validation'
+    assert error_types(node_errors, '8') == ['missing_node_type']
+
+
+def test_missing_required_input():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    del prompt['3']['inputs']['steps']
+    _, node_errors = validate_prompt(prompt, SCHEMAS)
+    assert error_types(node_errors, '3') == ['required_input_missing']
+    assert node_errors['3']['errors'][0]['details'] == 'steps'
+
+
+def test_dangling_links():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    prompt['3']['inputs']['model'] = ['42', 0]
+    prompt['8']['inputs']['vae'] = ['4', 7]
+    _, node_errors = validate_prompt(prompt, SCHEMAS)
+    assert error_types(node_errors, '3') == ['dangling_link']
+    assert error_types(node_errors, '8') == ['dangling_link']
+
+
+def test_type_mismatch():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    prompt['8']['inputs']['vae'] = ['4', 1]  # CLIP into a VAE input
+    _, node_errors = validate_prompt(prompt, SCHEMAS)
+    error = node_errors['8']['errors'][0]
+    assert error['type'] == 'return_type_mismatch'
+    assert error['extra_info']['received_type'] == 'CLIP'
+
+
+def test_cycle_detected():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    prompt['3']['inputs']['latent_image'] = ['3', 0]
+    _, node_errors = validate_prompt(prompt, SCHEMAS)
+    assert 'dependency_cycle' in error_types(node_errors, '3')
+
+
+def test_no_output_nodes():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    del prompt['9']
+    error, node_errors = validate_prompt(prompt, SCHEMAS)
+    assert error['type'] == 'prompt_no_outputs'
+    assert node_errors == {}
+
+
+def test_validation_is_fast():
+    started = time.perf_counter()
+    for _ in range(1000):
+        validate_prompt(SD15_WORKFLOW, SCHEMAS)
+    per_call = (time.perf_counter() - started) / 1000
+    assert per_call < 0.001
+
+
+def test_optimize_prunes_unreachable_nodes_and_meta():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    prompt['99'] = {'inputs': {'samples': ['3', 0], 'vae': ['4', 2]},
+                    'class_type': 'VAEDecode', '_meta': {'title': 'Unused decode'}}
+    optimized, removed = optimize_prompt(prompt, SCHEMAS)
+    assert removed == ['99']
+    assert set(optimized) == set(SD15_WORKFLOW)
+    assert all(set(node) == {'class_type', 'inputs'} for node in optimized.values())
+    assert '_meta' in prompt['3']  # input left untouched
+
+
+def test_optimize_without_schemas_uses_known_output_types():
+    prompt = copy.deepcopy(SD15_WORKFLOW)
+    prompt['99'] = {'inputs': {'text': 'orphan', 'clip': ['4', 1]}, 'class_type': 'CLIPTextEncode'}
+    _, removed = optimize_prompt(prompt)
+    assert removed == ['99']
+
+    del prompt['9']
+    optimized, removed = optimize_prompt(prompt)
+    assert optimized is prompt and removed == []
+
+
+def test_round_robin_interleaves_clients():
+    queue = DeficitRoundRobin()
+    for i in range(4):
+        queue.push(QueuedPrompt(f'batch-{i}', 'batch', b'{}'))
+    queue.push(QueuedPrompt('solo-0', 'solo', b'{}'))
+
+    assert [job.prompt_id for job in queue.order()] == ['batch-0', 'solo-0', 'batch-1', 'batch-2', 'batch-3']
+    assert len(queue) == 5  # order() does not consume
+
+    assert queue.pop().prompt_id == 'batch-0'
+    queue.push(QueuedPrompt('late-0', 'late', b'{}'))
+    # batch already had its turn, so the newcomer goes ahead of it
+    assert [job.prompt_id for job in queue.order()] == ['solo-0', 'late-0', 'batch-1', 'batch-2', 'batch-3']
+
+
+def test_round_robin_respects_cost():
+    queue = DeficitRoundRobin(quantum=1.0)
+    queue.push(QueuedPrompt('big', 'a', b'{}', cost=2.0))
+    queue.push(QueuedPrompt('small-0', 'b', b'{}'))
+    queue.push(QueuedPrompt('small-1', 'b', b'{}'))
+    assert [job.prompt_id for job in queue.order()] == ['small-0', 'big', 'small-1']
+
+
+def test_round_robin_remove():
+    queue = DeficitRoundRobin()
+    queue.push(QueuedPrompt('a-0', 'a', b'{}'))
+    queue.push(QueuedPrompt('b-0', 'b', b'{}'))
+    assert [job.prompt_id for job in queue.remove({'a-0'})] == ['a-0']
+    assert queue.pop().prompt_id == 'b-0'
+    assert queue.pop() is None and len(queue) == 0
+
+
+def test_release_survives_losing_the_queue_count():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        await comfyui.server.start_server()
+        backend = Backend(comfyui.url)
+
+        async def reject(request):
+            # The queue monitor drops its connection while the release is in flight
+            backend.queue_remaining = None
+            return web.json_response({'error': 'invalid prompt', 'node_errors': {}}, status=400)
+        comfyui.handlers['/prompt'] = reject
+        scheduler = FairScheduler([backend])
+        scheduler.session = ClientSession()
+        backend.queue_remaining = 0
+        try:
+            return await scheduler.release(QueuedPrompt('p1', 'c', b'{}'), backend), backend
+        finally:
+            await scheduler.session.close()
+            await comfyui.server.close()
+
+    (status, body), backend = asyncio.run(scenario())
+    assert status == 400 and body['error'] == 'invalid prompt'
+    assert backend.queue_remaining is None and backend.available
+
+
+def test_circuit_opens_and_recovers():
+    backend = Backend('http://gpu:8188/', failure_threshold=2)
+    assert backend.available and backend.url == 'http://gpu:8188'
+
+    backend.record_failure(ConnectionError('refused'))
+    assert backend.available
+    backend.record_failure(ConnectionError('refused'))
+    assert not backend.available
+    assert backend.health()['circuit'] == 'open'
+
+    backend.record_success()
+    assert backend.available and backend.failures == 0 and backend.last_error is None
+
+    backend.record_failure(TimeoutError(), trip=True)
+    assert not backend.available
+    assert backend.last_error == 'TimeoutError'
+
+
+def test_server_timing_header():
+    timing = PhaseTimer()
+    timing.add('connect', 0.0012)
+    timing.add('ttfb', 0.030)
+    timing.add('ttfb', 0.005)
+    assert timing.server_timing(0.0401) == 'connect;dur=1.2, ttfb;dur=35.0, total;dur=40.1'
+
+
+def test_proxied_response_carries_server_timing():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        comfyui.history['p1'] = {'outputs': {}}
+        async with proxy_for(comfyui) as client:
+            resp = await client.get('/history/p1')
+            assert resp.status == 200 and await resp.json() == {'p1': {'outputs': {}}}
+            return resp.headers.get('Server-Timing', '')
+
+    phases = dict(entry.split(';dur=') for entry in asyncio.run(scenario()).split(', '))
+    assert {'ttfb', 'transfer', 'total'} <= set(phases)
+    assert float(phases['total']) >= float(phases['ttfb'])
+
+
+def test_trace_log_samples_and_keeps_slow_requests(tmp_path):
+    path = tmp_path / 'trace.jsonl'
+    traces = TraceLog(str(path), sample_rate=0.0, slow_threshold=0.5)
+    traces.start()
+    traces.record('http', 0.01, path='/fast')
+    traces.record('http', 0.75, path='/slow')
+    traces.stop()
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r['path'] for r in records] == ['/slow']
+    assert records[0]['total_ms'] == 750.0
+
+
+def test_relay_stamps_sequence_numbers():
+    assert RelaySession.stamp(7, '{"type": "status"}') == '{"seq":7,"type": "status"}'
+    assert RelaySession.stamp(8, '{}') == '{"seq":8}'
+    assert json.loads(RelaySession.stamp(9, '{ "a": 1}')) == {'seq': 9, 'a': 1}
+
+
+def test_output_cache_budget_and_hit_rate():
+    async def scenario():
+        cache = OutputCache(max_bytes=400)
+
+        async def load(size):
+            return CachedResponse(b'x' * size, 'image/png')
+
+        for name in ('a', 'b', 'c'):
+            cache.prefetch(('view', name), lambda: load(100))
+        cache.prefetch(('view', 'huge'), lambda: load(101))  # over a quarter of the budget
+        await asyncio.sleep(0)
+        await asyncio.gather(*cache.pending.values())
+
+        assert await cache.get(('view', 'a')) is not None
+        assert await cache.get(('view', 'huge')) is None
+        cache.put(('view', 'd'), CachedResponse(b'x' * 100, 'image/png'))
+        cache.put(('view', 'e'), CachedResponse(b'x' * 100, 'image/png'))
+        return cache.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics['hit_rate'] == 0.5
+    assert metrics['bytes'] == 400 and metrics['entries'] == 4
+    assert metrics['evicted_unused'] == 1  # 'b' went first; 'a' had been read
+
+
+def test_output_archive_dedupes_evicts_and_reloads(tmp_path):
+    async def scenario():
+        archive = OutputArchive(str(tmp_path), max_bytes=250)
+        await archive.open()
+        await archive.store(('a.png', '', 'output'), 'http://gpu1', b'a' * 100, 'image/png')
+        await archive.store(('copy.png', '', 'output'), 'http://gpu2', b'a' * 100, 'image/png')
+        await archive.store(('b.png', '', 'output'), 'http://gpu1', b'b' * 100, 'image/png')
+        assert archive.lookup(('a.png', '', 'output'), 'http://gpu1') is not None  # now most recent
+        await archive.store(('c.png', '', 'output'), 'http://gpu1', b'c' * 100, 'image/png')
+        assert archive.lookup(('b.png', '', 'output')) is None
+        assert archive.metrics()['deduplicated'] == 1 and archive.size == 200
+
+        reopened = OutputArchive(str(tmp_path), max_bytes=250)
+        await reopened.open()
+        path, record = reopened.lookup(('copy.png', '', 'output'))
+        with open(path, 'rb') as f:
+            assert f.read() == b'a' * 100
+        assert record['mime'] == 'image/png' and reopened.size == 200
+        assert reopened.lookup(('c.png', '', 'output'), 'http://gpu2') is None
+
+    asyncio.run(scenario())
+
+
+def test_output_archive_refreshes_a_rewritten_file(tmp_path):
+    async def scenario():
+        archive = OutputArchive(str(tmp_path))
+        await archive.open()
+        key = ('ComfyUI_00001_.png', '', 'output')
+
+        async def archived(body, refresh):
+            async def load():
+                return CachedResponse(body, 'image/png')
+            archive.prefetch(key, 'http://gpu', load, refresh=refresh)
+            path, _ = await archive.fetch(key, 'http://gpu', load)
+            with open(path, 'rb') as f:
+                return f.read()
+
+        assert await archived(b'first', refresh=True) == b'first'
+        # A client's own download of a known file keeps what was archived
+        assert await archived(b'unexpected', refresh=False) == b'first'
+        # The same name written again by a later prompt
+        assert await archived(b'second', refresh=True) == b'second'
+        path, _ = archive.lookup(key)
+        with open(path, 'rb') as f:
+            assert f.read() == b'second'
+        assert len(archive.objects) == 1 and archive.size == len(b'second')
+        assert archive.metrics()['replaced'] == 1
+
+        reopened = OutputArchive(str(tmp_path))
+        await reopened.open()
+        path, _ = reopened.lookup(key, 'http://gpu')
+        with open(path, 'rb') as f:
+            assert f.read() == b'second'
+        stored = [p.name for p in (tmp_path / 'objects').rglob('*') if p.is_file()]
+        assert stored == [reopened.lookup(key)[1]['hash']]
+
+    asyncio.run(scenario())
+
+
+def test_rewritten_output_gets_a_new_etag(tmp_path):
+    async def scenario(options):
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, **options) as client:
+            ws = await client.ws_connect('/ws?clientId=c')
+            assert (await ws.receive_json())['type'] == 'status'
+            executed = {'type': 'executed', 'data': {'prompt_id': 'p1', 'node': '9', 'output': {
+                'images': [{'filename': 'out.png', 'subfolder': '', 'type': 'output'}]}}}
+            view = '/view?filename=out.png&subfolder=&type=output'
+
+            await comfyui.send('c', executed)
+            await ws.receive_json()
+            resp = await client.get(view)
+            assert await resp.read() == b'image:out.png'
+            etag = resp.headers['ETag']
+            resp = await client.get(view, headers={'If-None-Match': etag})
+            assert resp.status == 304
+
+            # A later prompt writes the same name
+            comfyui.files['out.png'] = b'rewritten'
+            await comfyui.send('c', executed)
+            await ws.receive_json()
+            resp = await client.get(view, headers={'If-None-Match': etag})
+            assert resp.status == 200 and await resp.read() == b'rewritten'
+            assert resp.headers['ETag'] != etag
+            await ws.close()
+
+    asyncio.run(scenario({}))
+    asyncio.run(scenario({'archive_dir': str(tmp_path)}))
+
+
+def test_profiler_times_nodes_by_class_type():
+    profiler = NodeProfiler()
+    profiler.graphs['p1'] = {node_id: node['class_type'] for node_id, node in SD15_WORKFLOW.items()}
+    profiler.start('p1', 'http://gpu', now=0.0)
+    profiler.cached('p1', 'http://gpu', ['4'])
+    profiler.enter('p1', '3', now=0.5)
+    profiler.enter('p1', '3', now=0.6)  # duplicate from a second relay
+    profiler.enter('p1', '8', now=4.5)
+    assert profiler.enter('p1', None, now=5.0) == 5.0
+
+    report = profiler.report()['backends']['http://gpu']
+    assert report['prompts'] == 1 and report['overhead_s'] == 0.5
+    assert list(report['nodes']) == ['KSampler', 'VAEDecode', 'CheckpointLoaderSimple']
+    assert report['nodes']['KSampler']['histogram']['le_5'] == 1
+    assert report['nodes']['CheckpointLoaderSimple']['cached'] == 1
+    assert profiler.folded().splitlines() == [
+        'http://gpu;(overhead) 500', 'http://gpu;KSampler 4000', 'http://gpu;VAEDecode 500']
+
+
+def test_runtime_estimator_scales_unseen_shapes():
+    estimator = RuntimeEstimator()
+    shape = graph_shape(SD15_WORKFLOW)
+    assert shape[1:] == (20, 512, 512, 1)
+    estimator.observe(shape, 4.0)
+    assert estimator.estimate(shape) == 4.0
+
+    bigger = copy.deepcopy(SD15_WORKFLOW)
+    bigger['3']['inputs']['steps'] = 40
+    bigger['3']['inputs']['seed'] = 1  # seeds do not change the shape
+    assert estimator.estimate(graph_shape(bigger)) == 8.0
+
+    other = {'1': {'class_type': 'SaveImage', 'inputs': {}}}
+    assert estimator.estimate(graph_shape(other), fallback=3.0) == 3.0
+
+
+def test_apply_overrides_copies_only_changed_nodes():
+    prompt, node_errors = apply_overrides(SD15_WORKFLOW, {'3': {'seed': 7}, '6': {'text': 'a fox'}})
+    assert node_errors == {}
+    assert prompt['3']['inputs']['seed'] == 7 and prompt['3']['inputs']['steps'] == 20
+    assert SD15_WORKFLOW['3']['inputs']['seed'] != 7  # template untouched
+    assert prompt['4'] is SD15_WORKFLOW['4']
+
+    _, node_errors = apply_overrides(SD15_WORKFLOW, {'42': {'seed': 1}})
+    assert node_errors['42']['errors'][0]['type'] == 'invalid_override'
+
+
+def test_stack_sampler_finds_hot_function():
+    def hot_loop(deadline):
+        while time.perf_counter() < deadline:
+            sum(i * i for i in range(1000))
+
+    sampler = StackSampler(threading.get_ident(), interval=0.001)
+    sampler.start()
+    hot_loop(time.perf_counter() + 0.3)
+    sampler.stop()
+
+    assert sampler.samples > 0
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in sampler.folded().splitlines())
+    top = sampler.top()
+    assert any(entry['frame'].startswith('hot_loop (test_proxy.py') for entry in top['total'])
+    assert top['idle'] == 0
+
+
+def test_orphaned_prompts_are_cancelled_after_grace():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, max_outstanding=1, orphan_grace=0.2, resume_grace=0) as client:
+            ws = await client.ws_connect('/ws?clientId=gone')
+            assert (await ws.receive_json())['type'] == 'status'
+            await submit(client, 'gone', 'released')
+            await submit(client, 'gone', 'held')
+            status = await (await client.get('/aircomfy/queue?clientId=gone')).json()
+            assert [job['prompt_id'] for job in status['jobs']] == ['held']
+
+            await ws.close()
+            await asyncio.sleep(0.4)
+            status = await (await client.get('/aircomfy/queue?clientId=gone')).json()
+            assert status['jobs'] == [] and status['held'] == 0
+            assert comfyui.requested('POST', '/queue') == [{'delete': ['released']}]
+            orphans = (await (await client.get('/aircomfy/metrics')).json())['orphans']
+            assert orphans['clients_reaped'] == 1 and orphans['held_dropped'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_reconnecting_within_grace_keeps_prompts():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, max_outstanding=1, orphan_grace=0.2, resume_grace=0) as client:
+            ws = await client.ws_connect('/ws?clientId=back')
+            assert (await ws.receive_json())['type'] == 'status'
+            await submit(client, 'back', 'released')
+            await submit(client, 'back', 'held')
+
+            await ws.close()
+            await asyncio.sleep(0.05)
+            ws = await client.ws_connect('/ws?clientId=back')
+            await asyncio.sleep(0.4)
+            status = await (await client.get('/aircomfy/queue?clientId=back')).json()
+            assert [job['prompt_id'] for job in status['jobs']] == ['held']
+            assert comfyui.requested('POST', '/queue') == []
+            await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_eta_filters_by_prompt_and_client():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, max_outstanding=1) as client:
+            ws = await client.ws_connect('/ws?clientId=a')
+            assert (await ws.receive_json())['type'] == 'status'
+            # Time one prompt so there is a run time to estimate from
+            await submit(client, 'a', 'timed')
+            await comfyui.send('a', {'type': 'execution_start', 'data': {'prompt_id': 'timed'}})
+            await ws.receive_json()
+            await asyncio.sleep(0.05)
+            await comfyui.send('a', {'type': 'executing', 'data': {'node': None, 'prompt_id': 'timed'}})
+            await ws.receive_json()
+            await submit(client, 'a', 'mine')
+            await submit(client, 'b', 'theirs')
+
+            eta = await (await client.get('/aircomfy/eta')).json()
+            assert set(eta['prompts']) == {'mine', 'theirs'}
+            assert 0 < eta['prompts']['mine'] < eta['prompts']['theirs']
+            assert eta['queue_eta'] is not None
+            eta = await (await client.get('/aircomfy/eta?prompt_id=theirs')).json()
+            assert list(eta['prompts']) == ['theirs']
+            eta = await (await client.get('/aircomfy/eta?clientId=a')).json()
+            assert list(eta['prompts']) == ['mine']
+            eta = await (await client.get('/aircomfy/eta?clientId=b')).json()
+            assert list(eta['prompts']) == ['theirs']
+            await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_status_broadcast_works_out_the_eta_once(monkeypatch):
+    calls = []
+    exec_info = proxy.ComfyUIProxy.exec_info
+
+    def counted(self):
+        calls.append(1)
+        return exec_info(self)
+
+    monkeypatch.setattr(proxy.ComfyUIProxy, 'exec_info', counted)
+
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui) as client:
+            sockets = [await client.ws_connect(f'/ws?clientId={c}') for c in ('a', 'b', 'c')]
+            for ws in sockets:
+                assert (await ws.receive_json())['type'] == 'status'
+            calls.clear()
+            await comfyui.broadcast({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': 2}}}})
+            statuses = [(await ws.receive_json())['data']['status']['exec_info'] for ws in sockets]
+            assert statuses[0] == statuses[1] == statuses[2]
+            assert 'queue_eta' in statuses[0]
+            assert len(calls) == 1
+            for ws in sockets:
+                await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_history_bulk_uses_cache_recent_window_and_lookups():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, max_outstanding=10) as client:
+            for prompt_id in ('old', 'broken'):
+                await submit(client, 'c', prompt_id)
+                comfyui.history[prompt_id] = {'prompt': [1, prompt_id], 'outputs': {}, 'status': {}}
+            # Older than the 64 entries a three-prompt request reads from /history
+            for i in range(64):
+                comfyui.history[f'filler{i}'] = {'outputs': {}}
+            comfyui.history['recent'] = {'prompt': [2, 'recent'], 'outputs': {'9': {}}}
+            comfyui.failing.add('/history/broken')
+
+            ids = ['recent', 'old', 'broken', 'recent', 'unknown']
+            resp = await client.post('/aircomfy/history/bulk', json={'prompt_ids': ids})
+            assert resp.status == 200
+            assert await resp.json() == {'recent': {'outputs': {'9': {}}}, 'old': {'outputs': {}, 'status': {}}}
+            assert len(comfyui.requested('GET', '/history')) == 1
+            assert len(comfyui.requested('GET', '/history/old')) == 1
+            assert comfyui.requested('GET', '/history/unknown') == []
+
+            resp = await client.post('/aircomfy/history/bulk', json={'prompt_ids': ['old', 'recent'],
+                                                                     'include_prompt': True})
+            assert (await resp.json())['old']['prompt'] == [1, 'old']
+            assert len(comfyui.requested('GET', '/history')) == 1
+            prefetch = (await (await client.get('/aircomfy/metrics')).json())['prefetch']
+            assert prefetch['lookups'] == 0
+
+            for body in ({'prompt_ids': 'old'}, {'prompt_ids': ['old', 1]}, {'ids': []}, ['old']):
+                resp = await client.post('/aircomfy/history/bulk', json=body)
+                assert resp.status == 400, body
+            resp = await client.post('/aircomfy/history/bulk', data='{')
+            assert resp.status == 400
+
+    asyncio.run(scenario())
+
+
+def test_shedding_turns_away_prompts_but_serves_results():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        comfyui.history['p1'] = {'outputs': {}}
+        async with proxy_for(comfyui, request_limits={'prompt': 0}) as client:
+            workflow = {'1': {'class_type': 'SaveImage', 'inputs': {}}}
+            for method, path in (('POST', '/prompt'), ('PUT', '/aircomfy/templates'),
+                                 ('POST', '/aircomfy/templates/0123456789abcdef/run')):
+                resp = await client.request(method, path, json={'prompt': workflow})
+                assert resp.status == 503 and resp.headers['Retry-After'] == '1', path
+
+            resp = await client.get('/view?filename=a.png&type=output')
+            assert resp.status == 200 and await resp.read() == b'image:a.png'
+            resp = await client.get('/history/p1')
+            assert resp.status == 200 and await resp.json() == {'p1': {'outputs': {}}}
+            resp = await client.post('/aircomfy/history/bulk', json={'prompt_ids': ['p1']})
+            assert resp.status == 200
+            shed = (await (await client.get('/aircomfy/metrics')).json())['admission']
+            assert shed['shed'] == {'prompt': 3}
+
+    asyncio.run(scenario())
+
+
+def test_debug_memory_rejects_bad_parameters():
+    async def scenario():
+        async with proxy_for(FakeComfyUI(), admin_token='secret') as client:
+            headers = {'Authorization': 'Bearer secret'}
+            for query in ('frames=x', 'frames=0', 'frames=1000', 'limit=many', 'limit=-1'):
+                resp = await client.get(f'/debug/memory?{query}', headers=headers)
+                assert resp.status == 400, query
+            resp = await client.get('/debug/memory?frames=2', headers=headers)
+            assert await resp.json() == {'tracing': True, 'started': True}
+            resp = await client.get('/debug/memory?limit=3', headers=headers)
+            assert len((await resp.json())['growth']) <= 3
+            resp = await client.get('/debug/memory?stop=1', headers=headers)
+            assert await resp.json() == {'tracing': False}
+
+    asyncio.run(scenario())
+
+
+def test_template_endpoints_register_check_and_queue():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, validate=True) as client:
+            resp = await client.put('/aircomfy/templates', json={'prompt': SD15_WORKFLOW})
+            assert resp.status == 201
+            template_hash = (await resp.json())['hash']
+            resp = await client.put('/aircomfy/templates', json=SD15_WORKFLOW)
+            assert resp.status == 200 and (await resp.json())['hash'] == template_hash
+            for body in ('{', '[]', '{}'):
+                resp = await client.put('/aircomfy/templates', data=body)
+                assert resp.status == 400, body
+
+            resp = await client.post('/aircomfy/templates/0123456789abcdef/run', json={})
+            assert resp.status == 404
+            run = f'/aircomfy/templates/{template_hash}/run'
+            for body in ('{', '[1]', '"overrides"'):
+                resp = await client.post(run, data=body)
+                assert resp.status == 400, body
+            resp = await client.post(run, json={'overrides': {'42': {'seed': 1}}})
+            assert resp.status == 400
+            assert error_types((await resp.json())['node_errors'], '42') == ['invalid_override']
+            # The whole graph is checked again, overrides included
+            resp = await client.post(run, json={'overrides': {'3': {'model': ['99', 0]}}})
+            assert resp.status == 400 and '3' in (await resp.json())['node_errors']
+            assert comfyui.requested('POST', '/prompt') == []
+
+            resp = await client.post(run, json={'overrides': {'3': {'seed': 7}}, 'client_id': 'c'})
+            assert resp.status == 200
+            prompt_id = (await resp.json())['prompt_id']
+            [queued] = comfyui.requested('POST', '/prompt')
+            assert queued['prompt_id'] == prompt_id and queued['client_id'] == 'c'
+            assert queued['prompt']['3']['inputs']['seed'] == 7
+            assert queued['prompt']['3']['inputs']['steps'] == SD15_WORKFLOW['3']['inputs']['steps']
+
+    asyncio.run(scenario())
+
+
+def test_resumed_client_replays_what_it_missed():
+    def progress(value):
+        return {'type': 'progress', 'data': {'value': value, 'max': 10}}
+
+    async def scenario():
+        comfyui = FakeComfyUI()
+        async with proxy_for(comfyui, resume_grace=5, resume_buffer=4) as client:
+            ws = await client.ws_connect('/ws?clientId=r&resume=1')
+            assert (await ws.receive_json())['seq'] == 1  # the backend's status
+            await comfyui.send('r', progress(1))
+            assert await ws.receive_json() == {'seq': 2, **progress(1)}
+
+            await ws.close()
+            await asyncio.sleep(0.05)
+            await comfyui.send('r', progress(2))
+            await comfyui.send('r', progress(3))
+            await asyncio.sleep(0.05)
+            ws = await client.ws_connect('/ws?clientId=r&lastSeq=2')
+            assert [await ws.receive_json() for _ in range(3)] == [
+                {'seq': 3, **progress(2)}, {'seq': 4, **progress(3)},
+                {'type': 'aircomfy_resume', 'data': {'resumed': True, 'missed': False, 'seq': 4}}]
+
+            # More events than the buffer holds: the oldest are lost and the client is told so
+            await ws.close()
+            await asyncio.sleep(0.05)
+            for value in range(4, 10):
+                await comfyui.send('r', progress(value))
+            await asyncio.sleep(0.05)
+            ws = await client.ws_connect('/ws?clientId=r&lastSeq=4')
+            replayed = [await ws.receive_json() for _ in range(5)]
+            assert [message.get('seq') for message in replayed[:4]] == [7, 8, 9, 10]
+            assert replayed[4]['data'] == {'resumed': True, 'missed': True, 'seq': 10}
+
+            # A malformed lastSeq resumes without a replay instead of dropping the socket
+            await ws.close()
+            await asyncio.sleep(0.05)
+            ws = await client.ws_connect('/ws?clientId=r&lastSeq=latest')
+            assert (await ws.receive_json())['type'] == 'status'
+            await comfyui.send('r', progress(10))
+            assert await ws.receive_json() == {'seq': 11, **progress(10)}
+            await ws.close()
+
+            # No relay left to resume: everything may have been missed
+            ws = await client.ws_connect('/ws?clientId=new&lastSeq=3')
+            messages = {message['type']: message for message in [await ws.receive_json() for _ in range(2)]}
+            resume = messages['aircomfy_resume']['data']
+            assert resume['resumed'] is False and resume['missed'] is True
+            await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_push_sends_finished_outputs_over_the_socket(monkeypatch):
+    monkeypatch.setattr(proxy, 'Image', None)  # no thumbnails without Pillow
+    bodies = {'small.png': b'\x89PNG small', 'big.png': b'\x89PNG' + bytes(100)}
+
+    async def view(request):
+        return web.Response(body=bodies[request.query['filename']], content_type='image/png')
+
+    async def scenario():
+        comfyui = FakeComfyUI()
+        comfyui.handlers['/view'] = view
+        async with proxy_for(comfyui, push_inline_limit=64) as client:
+            ws = await client.ws_connect('/ws?clientId=p&push=1')
+            assert (await ws.receive_json())['type'] == 'status'
+            images = [{'filename': name, 'subfolder': 'run', 'type': 'output'} for name in bodies]
+            executed = {'type': 'executed', 'data': {'prompt_id': 'p1', 'node': '9', 'output': {'images': images}}}
+            await comfyui.send('p', executed)
+            assert await ws.receive_json() == executed
+            result = await ws.receive_json()
+            await ws.close()
+            return result
+
+    result = asyncio.run(scenario())
+    assert result['type'] == 'aircomfy_result'
+    assert result['data']['prompt_id'] == 'p1' and result['data']['node'] == '9'
+    small, big = result['data']['outputs']
+    assert small['kind'] == 'images' and small['url'] == '/view?filename=small.png&subfolder=run&type=output'
+    assert small['mime'] == 'image/png' and small['thumbnail'] is False
+    header, encoded = small['inline'].split(',', 1)
+    assert header == 'data:image/png;base64' and base64.b64decode(encoded) == bodies['small.png']
+    # Over --push-inline-limit: the client fetches it from the URL instead
+    assert big['url'] == '/view?filename=big.png&subfolder=run&type=output'
+    assert big['size'] == len(bodies['big.png']) and 'inline' not in big
+
+
+async def wait_for_health(client, healthy):
+    """/aircomfy/health once its first backend's circuit is closed (healthy) or open"""
+    for _ in range(100):
+        resp = await client.get('/aircomfy/health')
+        report = await resp.json()
+        if report['backends'][0]['healthy'] is healthy:
+            return resp.status, report
+        await asyncio.sleep(0.02)
+    raise AssertionError(f'backend never became {"healthy" if healthy else "unhealthy"}')
+
+
+def test_failed_probes_open_the_circuit_and_fail_fast():
+    async def scenario():
+        comfyui = FakeComfyUI()
+        comfyui.history['p1'] = {'outputs': {}}
+        comfyui.failing.add('/system_stats')
+        async with proxy_for(comfyui, health_interval=0.05) as client:
+            status, report = await wait_for_health(client, False)
+            assert status == 503 and report['healthy'] is False
+            assert report['backends'][0]['circuit'] == 'open' and '500' in report['backends'][0]['last_error']
+
+            resp = await client.get('/history/p1')
+            assert resp.status == 503 and resp.headers['Retry-After'] == '1'
+            assert comfyui.requested('GET', '/history/p1') == []
+
+            comfyui.failing.clear()
+            status, report = await wait_for_health(client, True)
+            assert status == 200 and report['backends'][0]['last_error'] is None
+            resp = await client.get('/history/p1')
+            assert resp.status == 200 and await resp.json() == {'p1': {'outputs': {}}}
+
+    asyncio.run(scenario())
+
+
+def test_requests_fail_over_to_a_healthy_backend():
+    async def scenario():
+        down, up = FakeComfyUI(), FakeComfyUI()
+        down.failing.add('/system_stats')
+        up.history['p1'] = {'outputs': {}}
+        async with proxy_for(down, up, health_interval=0.05) as client:
+            status, report = await wait_for_health(client, False)
+            assert status == 200 and report['healthy'] is True
+            assert [b['circuit'] for b in report['backends']] == ['open', 'closed']
+
+            resp = await client.get('/history/p1')
+            assert resp.status == 200 and await resp.json() == {'p1': {'outputs': {}}}
+            assert down.requested('GET', '/history/p1') == []
+
+    asyncio.run(scenario())